@@ -5,18 +5,134 @@ import streamlit as st
 import sqlite3
 import hashlib
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime
-from pulp import LpProblem, LpMinimize, LpVariable, PULP_CBC_CMD, LpStatus, value, lpSum, const
+import importlib
+from datetime import datetime, timedelta
 import math
-from fpdf import FPDF 
+import bisect
+import heapq
+import unicodedata
+import time
 import io
-import shutil 
+import re
+import tempfile
+import shutil
+import threading
+import warnings
+import queue
+import atexit
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+class LazyModule:
+    """Importa o módulo só no primeiro acesso a um atributo (thread-safe).
+
+    pandas, numpy, matplotlib e Pillow somam boa parte do tempo de inicialização e não são
+    necessários para a tela de login nem para o registro de água. pulp e fpdf são importados
+    dentro das funções que os usam (otimizador e PDFs).
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+            module = self._module
+        return getattr(module, attr)
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+matplotlib = LazyModule('matplotlib')
+plt = LazyModule('matplotlib.pyplot')
+Image = LazyModule('PIL.Image')
+ImageOps = LazyModule('PIL.ImageOps')
+
+logger = logging.getLogger('evefii')
 
 # --- Configuração e Funções de Utilitário ---
 DB_PATH = "evefii_v4.db"
-PHOTOS_DIR = "photos" 
+PHOTOS_DIR = "photos"
+
+# Miniaturas das fotos de evolução: lado maior em pixels por tamanho, geradas no upload e guardadas
+# em PHOTOS_DIR/thumbs com o hash do arquivo original no nome
+THUMBNAIL_SIZES = {'sm': 240, 'md': 720}
+THUMBNAIL_QUALITY = 82
+GALLERY_PAGE_SIZE = 10
+
+# Ingestão das fotos enviadas: guardadas uma vez por conteúdo (PHOTOS_DIR/ab/<hash>.jpg), sem EXIF,
+# reduzidas e recomprimidas até caber no orçamento, em threads fora do submit do formulário
+PHOTO_MAX_SIDE = 2048
+PHOTO_MAX_BYTES = 800_000
+PHOTO_JPEG_QUALITIES = (88, 80, 72, 64, 56)
+PHOTO_INGEST_WORKERS = 2
+
+# Pool de conexões SQLite (compartilhado por todas as sessões do processo)
+DB_POOL_SIZE = 5
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE = 128
+
+# Cache em memória de usuários (username -> id) e perfis; o TTL limita quanto tempo outro processo
+# (outra réplica do app) pode ver um perfil desatualizado
+USER_CACHE_TTL = 300  # segundos
+USER_CACHE_MAX_ENTRIES = 1024
+
+# Histórico de métricas corporais em memória (usuários mantidos); save_body_metric atualiza o cache
+METRICS_CACHE_MAX_USERS = 64
+
+# Cache em memória dos catálogos de alimentos (número máximo de usuários mantidos)
+FOOD_CACHE_MAX_USERS = 64
+
+# Catálogo de referência (TACO) compartilhado, somente leitura, gerado por build_reference_catalog()
+REFERENCE_CATALOG_PATH = "taco_reference.npz"
+REFERENCE_CHECK_INTERVAL = 1.0  # s entre verificações do mtime do arquivo (feitas a cada leitura do catálogo)
+
+# Quantos alimentos o seletor do planejador envia ao navegador por busca
+FOOD_PICKER_TOP_K = 50
+
+# Cache dos PDFs gerados (por hash do conteúdo), compartilhado pelas sessões do processo
+PDF_CACHE_MAX_ENTRIES = 32
+
+# Fonte Unicode dos PDFs (DejaVu Sans): procurada em PDF_FONT_DIR e depois na cópia do matplotlib;
+# sem ela os relatórios voltam à Arial com texto convertido para latin-1
+PDF_FONT_DIR = "fonts"
+PDF_FONT_FAMILY = "dejavu"
+PDF_FONT_FILES = {'': 'DejaVuSans.ttf', 'B': 'DejaVuSans-Bold.ttf', 'I': 'DejaVuSans-Oblique.ttf'}
+FPDF_VERSION = "1.7.2"  # o registro das fontes usa o estado interno desta versão (fixada no requirements.txt)
+PDF_TABLE_CHUNK_ROWS = 500  # linhas formatadas por vez nas tabelas dos relatórios
+
+# Gráficos de evolução: pontos máximos por gráfico (LTTB) e intervalos oferecidos ao usuário (dias)
+CHART_MAX_POINTS = 300
+METRIC_CHART_RANGES = {'3 meses': 90, '6 meses': 182, '1 ano': 365, 'Tudo': None}
+METRIC_CHART_GRANULARITIES = {'Diário': None, 'Semanal': 'weekly', 'Mensal': 'monthly'}
+
+# Hidratação: os cliques em "Adicionar" ficam num buffer e são gravados juntos após este atraso (s)
+WATER_FLUSH_DELAY = 2.0
+WATER_FLUSH_MAX_DELAY = 60.0  # teto do intervalo entre novas tentativas quando a gravação falha
+WATER_HISTORY_DAYS = 30   # dias no gráfico de histórico
+WATER_STREAK_MAX_DAYS = 365  # janela lida para calcular a sequência de dias com a meta atingida
+
+# Cache dos gráficos do relatório (PNG por hash dos dados de entrada)
+CHART_CACHE_MAX_ENTRIES = 64
+CHART_DPI = 100
+
+# Paginação da tabela de alimentos
+FOOD_TABLE_PAGE_SIZES = [25, 50, 100]
+FOOD_TABLE_SORT_COLUMNS = {
+    'Nome': 'name', 'Calorias': 'calories', 'Proteína': 'protein', 'Carboidratos': 'carbs',
+    'Gordura': 'fat', 'Fibra': 'fiber', 'Sódio': 'sodium'
+}
+
+# Importação de CSV em blocos (memória limitada mesmo para tabelas TACO/USDA completas)
+CSV_IMPORT_CHUNK_ROWS = 5000
+CSV_IMPORT_MAX_ERRORS = 100
+CSV_IMPORT_ENCODINGS = ('utf-8-sig', 'latin-1')  # tentadas em ordem; exportações do TACO/Excel costumam vir em latin-1
 
 # Fatores para cálculo do Gasto Energético Total (GET) / TDEE
 TDEE_FACTORS = {
@@ -27,66 +143,228 @@ TDEE_FACTORS = {
     "Extremamente Ativo (treino diário intenso e trabalho físico)": 1.9
 }
 
+# Distribuição padrão das calorias entre as refeições (por número de refeições/dia)
+MEAL_CALORIE_SPLITS = {
+    2: [0.45, 0.55],
+    3: [0.30, 0.40, 0.30],
+    4: [0.25, 0.35, 0.15, 0.25],
+    5: [0.20, 0.10, 0.35, 0.10, 0.25],
+    6: [0.20, 0.10, 0.30, 0.10, 0.20, 0.10],
+}
+
+# Parâmetros do otimizador automático (CBC)
+OPTIMIZER_TIME_LIMIT = 5      # segundos
+OPTIMIZER_GAP = 0.02          # gap relativo aceito na solução MIP
+OPTIMIZER_MAX_CANDIDATES = 120  # alimentos considerados pelo modelo (pré-seleção por densidade de nutrientes)
+
+# Planejamento semanal
+WEEK_DAYS = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
+WEEK_MAX_REPEATS = 3  # máximo de dias da semana em que um mesmo alimento pode aparecer
+
+@st.cache_resource
+def shared_resource(name, _factory):
+    """Objeto único por processo, preservado entre os reruns do script.
+
+    O Streamlit reexecuta este arquivo a cada interação, recriando as variáveis globais; caches,
+    pools e locks compartilhados precisam vir daqui para sobreviver entre reruns e sessões.
+    """
+    return _factory()
+
 # 1. Conexão do Banco de Dados
 def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    """Abre uma conexão nova já configurada (WAL, synchronous=NORMAL, busy timeout e cache de statements)."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=DB_STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    # WAL permite leitores simultâneos a um escritor; NORMAL é seguro em WAL e evita fsync a cada commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
     return conn
 
-# Funções de Usuário e Perfil 
-def get_user_id(username):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user = cur.fetchone()
-    conn.close()
+class ConnectionPool:
+    """Pool pequeno de conexões reutilizáveis para um arquivo SQLite.
+
+    As conexões são abertas sob demanda (até max_size ficam guardadas) e devolvidas
+    ao pool ao final de cada uso, evitando abrir/fechar uma conexão por consulta.
+    """
+    def __init__(self, db_path, max_size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=max_size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return get_conn()
+
+    def release(self, conn):
+        # Nunca devolve ao pool uma conexão com transação pendente
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_POOLS = shared_resource('db_pools', dict)
+_POOLS_LOCK = shared_resource('db_pools_lock', threading.Lock)
+
+def get_pool():
+    """Retorna o pool do DB_PATH atual (um pool por arquivo de banco)."""
+    with _POOLS_LOCK:
+        pool = _POOLS.get(DB_PATH)
+        if pool is None:
+            pool = _POOLS[DB_PATH] = ConnectionPool(DB_PATH)
+        return pool
+
+@contextmanager
+def db_conn():
+    """Empresta uma conexão do pool: `with db_conn() as conn: ...`."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+# Funções de Usuário e Perfil
+class TTLCache:
+    """Cache LRU com expiração por entrada; invalidate() descarta uma chave depois de uma escrita."""
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chave -> (expira_em, valor)
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = loader(key)
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, key, fn):
+        """Aplica fn ao valor em cache (se houver e não tiver expirado), sem recarregar."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries[key] = (entry[0], fn(entry[1]))
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] > time.monotonic() else None
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+USER_ID_CACHE = shared_resource('user_id_cache', TTLCache)
+PROFILE_CACHE = shared_resource('profile_cache', TTLCache)
+
+def _load_user_id(username):
+    with db_conn() as conn:
+        user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
     return user['id'] if user else None
 
+def get_user_id(username):
+    return USER_ID_CACHE.get(username, _load_user_id)
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def verify_user(username, password):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
-    user = cur.fetchone()
-    conn.close()
+    with db_conn() as conn:
+        user = conn.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
     if user:
         return user[0] == hash_password(password)
     return False
-    
+
 def register_user(username, password):
-    conn = get_conn(); cur = conn.cursor()
-    try:
-        password_hash = hash_password(password)
-        cur.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        try:
+            password_hash = hash_password(password)
+            conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+            conn.commit()
+            # Uma consulta anterior pode ter guardado "usuário inexistente" para esse nome
+            USER_ID_CACHE.invalidate(username)
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def save_user_profile(user_id, gender, height, age):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO user_profile (user_id, gender, height, age) VALUES (?, ?, ?, ?)", 
-                (user_id, gender, height, age))
-    conn.commit()
-    conn.close()
+    """Grava o perfil só se algum valor mudou. Retorna True se houve escrita no banco.
+
+    A comparação é contra a linha atual do banco (não contra o cache, que pode estar desatualizado),
+    lida com um SELECT simples: no WAL ele não pega o lock de escrita, então re-renderizar a página
+    sem mudanças não escreve nem espera por outro processo. Valores NULL contam como alterados.
+    """
+    # Mesmos tipos que a leitura do banco devolve (height REAL, age INTEGER)
+    profile = {'gender': gender, 'height': float(height), 'age': int(age)}
+    with db_conn() as conn:
+        current = conn.execute("SELECT gender, height, age FROM user_profile WHERE user_id = ?", (user_id,)).fetchone()
+        if current is not None and dict(current) == profile:
+            PROFILE_CACHE.set(user_id, profile)
+            return False
+        # O WHERE repete a comparação já com o lock: outro processo pode ter gravado o mesmo perfil no meio tempo
+        cur = conn.execute("""
+            INSERT INTO user_profile (user_id, gender, height, age) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                gender=excluded.gender, height=excluded.height, age=excluded.age
+            WHERE gender IS NOT excluded.gender OR height IS NOT excluded.height OR age IS NOT excluded.age
+        """, (user_id, profile['gender'], profile['height'], profile['age']))
+        changed = cur.rowcount > 0
+        conn.commit()
+    PROFILE_CACHE.set(user_id, profile)
+    return changed
+
+def _load_user_profile(user_id):
+    with db_conn() as conn:
+        profile = conn.execute("SELECT gender, height, age FROM user_profile WHERE user_id = ?", (user_id,)).fetchone()
+    return dict(profile) if profile else None
 
 def get_user_profile(user_id):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT gender, height, age FROM user_profile WHERE user_id = ?", (user_id,))
-    profile = cur.fetchone()
-    conn.close()
+    profile = PROFILE_CACHE.get(user_id, _load_user_profile)
+    # Cópia: quem chama pode alterar o dict sem mexer no cache
     return dict(profile) if profile else None
 
-# 2. Inicialização do Banco de Dados (Com Correção de Sintaxe na Tabela Recipes)
-@st.cache_resource
-def init_db():
-    conn = get_conn(); cur = conn.cursor()
-    
+# 2. Inicialização do Banco de Dados (Migrações versionadas via PRAGMA user_version)
+def _add_column_if_missing(cur, table, column, decl):
+    """ALTER TABLE idempotente: bancos antigos podem já ter a coluna criada pelo probe-and-ALTER anterior."""
+    cols = [row[1] for row in cur.execute(f"PRAGMA table_info({table})")]
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _migration_base_tables(cur):
     # Tabela de Usuários
     cur.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password_hash TEXT)')
-    
+
     # Tabela de Perfil de Usuário
     cur.execute('''
         CREATE TABLE IF NOT EXISTS user_profile (
@@ -97,150 +375,817 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
-    
-    # Tabela de Alimentos (Adicionando FIBRA e SÓDIO) - CORREÇÃO DE SINTAXE AQUI
+
+    # Tabela de Alimentos (Adicionando FIBRA e SÓDIO)
     cur.execute('''
         CREATE TABLE IF NOT EXISTS recipes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            user_id INTEGER, 
-            name TEXT, 
-            cost REAL, 
-            calories INTEGER, 
-            protein REAL, 
-            carbs REAL, 
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            cost REAL,
+            calories INTEGER,
+            protein REAL,
+            carbs REAL,
             fat REAL,
             fiber REAL,
-            sodium REAL 
+            sodium REAL
         )
-    ''') # <--- CORREÇÃO: Removido o ')' extra que estava causando o erro
-    
+    ''')
+
     # Tabela de Métricas
     cur.execute('''
         CREATE TABLE IF NOT EXISTS body_metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            user_id INTEGER, 
-            date TEXT, 
-            weight REAL, 
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            weight REAL,
             body_fat_perc REAL,
             waist_circ REAL,
             bmi REAL,
-            photo_path TEXT  
+            photo_path TEXT
         )
     ''')
-    
-    # --- CORREÇÕES DE MIGRAÇÃO (Garantindo todas as colunas) ---
-    try: cur.execute("SELECT bmi FROM body_metrics LIMIT 1")
-    except sqlite3.OperationalError: cur.execute("ALTER TABLE body_metrics ADD COLUMN bmi REAL")
-    try: cur.execute("SELECT user_id FROM body_metrics LIMIT 1")
-    except sqlite3.OperationalError: cur.execute("ALTER TABLE body_metrics ADD COLUMN user_id INTEGER")
-    try: cur.execute("SELECT user_id FROM recipes LIMIT 1")
-    except sqlite3.OperationalError: cur.execute("ALTER TABLE recipes ADD COLUMN user_id INTEGER")
-    try: cur.execute("SELECT photo_path FROM body_metrics LIMIT 1")
-    except sqlite3.OperationalError: cur.execute("ALTER TABLE body_metrics ADD COLUMN photo_path TEXT")
-    try: cur.execute("SELECT fiber FROM recipes LIMIT 1")
-    except sqlite3.OperationalError: 
-        cur.execute("ALTER TABLE recipes ADD COLUMN fiber REAL DEFAULT 0.0")
-    # Migração de v16: Adicionar sodium
-    try: cur.execute("SELECT sodium FROM recipes LIMIT 1")
-    except sqlite3.OperationalError: 
-        cur.execute("ALTER TABLE recipes ADD COLUMN sodium REAL DEFAULT 0.0") 
 
+def _migration_seed_default_user(cur):
     # Adiciona usuário padrão se o banco estiver vazio
     cur.execute("SELECT COUNT(*) FROM users"); c = cur.fetchone()[0]
     if c == 0:
         pw = hashlib.sha256('change-me'.encode()).hexdigest()
         cur.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", ('eve', pw))
-    
-    conn.commit()
-    conn.close()
-    
+
+def _migration_recipes_unique_name(cur):
+    # Remove duplicatas (mesmo usuário e nome) antes de criar a restrição, mantendo o registro mais antigo
+    cur.execute('''
+        DELETE FROM recipes
+        WHERE user_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM recipes WHERE user_id IS NOT NULL GROUP BY user_id, name
+        )
+    ''')
+    # O índice único também atende às consultas por usuário (WHERE user_id = ?)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_recipes_user_name ON recipes (user_id, name)")
+
+def _migration_body_metrics_user_date(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_body_metrics_user_date ON body_metrics (user_id, date)")
+
+def _migration_hidden_reference_foods(cur):
+    # Alimentos do catálogo de referência que o usuário excluiu (ou renomeou) da sua visão
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS hidden_reference_foods (
+            user_id INTEGER,
+            name TEXT,
+            PRIMARY KEY (user_id, name)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_body_metrics_derived_mass(cur):
+    # Massa gorda/magra passam a ser gravadas junto com a linha (antes recalculadas a cada leitura)
+    _add_column_if_missing(cur, 'body_metrics', 'fat_mass', 'REAL')
+    _add_column_if_missing(cur, 'body_metrics', 'lean_mass', 'REAL')
+    cur.execute("""
+        UPDATE body_metrics
+        SET fat_mass = weight * body_fat_perc / 100.0,
+            lean_mass = weight - weight * body_fat_perc / 100.0
+        WHERE fat_mass IS NULL
+    """)
+
+# Agregados semanais/mensais das métricas corporais: somas e contagens, mantidas pelo save_body_metric
+# (médias = soma / n na leitura). A expressão SQL dá o início do período de uma data 'YYYY-MM-DD'.
+BODY_METRICS_ROLLUPS = {
+    'weekly': ('body_metrics_weekly', "date({}, 'weekday 0', '-6 days')"),  # segunda-feira da semana
+    'monthly': ('body_metrics_monthly', "strftime('%Y-%m-01', {})"),
+}
+
+def _migration_body_metrics_rollups(cur):
+    for table, period_sql in BODY_METRICS_ROLLUPS.values():
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id INTEGER,
+                period TEXT,
+                n INTEGER,
+                weight_sum REAL,
+                body_fat_sum REAL,
+                bmi_sum REAL,
+                fat_mass_sum REAL,
+                lean_mass_sum REAL,
+                waist_sum REAL,
+                waist_n INTEGER,
+                PRIMARY KEY (user_id, period)
+            ) WITHOUT ROWID
+        """)
+        cur.execute(f"""
+            INSERT OR REPLACE INTO {table}
+            SELECT user_id, {period_sql.format('date')}, COUNT(*), SUM(weight), SUM(body_fat_perc), SUM(bmi),
+                   SUM(fat_mass), SUM(lean_mass), TOTAL(waist_circ), COUNT(waist_circ)
+            FROM body_metrics
+            GROUP BY 1, 2
+        """)
+
+def _migration_water_intake(cur):
+    # Consumo de água: um evento por clique e o total diário mantido na mesma transação
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS water_intake (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            day TEXT,
+            ts TEXT,
+            liters REAL
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_water_intake_user_day ON water_intake (user_id, day)")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS water_daily (
+            user_id INTEGER,
+            day TEXT,
+            liters REAL,
+            entries INTEGER,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+
+# Lista ORDENADA de migrações. A posição (1-based) é a versão do schema: nunca reordene
+# nem remova itens, apenas acrescente novas migrações ao final.
+SCHEMA_MIGRATIONS = [
+    ("Tabelas base", _migration_base_tables),
+    ("body_metrics.bmi", lambda cur: _add_column_if_missing(cur, 'body_metrics', 'bmi', 'REAL')),
+    ("body_metrics.user_id", lambda cur: _add_column_if_missing(cur, 'body_metrics', 'user_id', 'INTEGER')),
+    ("recipes.user_id", lambda cur: _add_column_if_missing(cur, 'recipes', 'user_id', 'INTEGER')),
+    ("body_metrics.photo_path", lambda cur: _add_column_if_missing(cur, 'body_metrics', 'photo_path', 'TEXT')),
+    ("recipes.fiber", lambda cur: _add_column_if_missing(cur, 'recipes', 'fiber', 'REAL DEFAULT 0.0')),
+    # Migração de v16: Adicionar sodium
+    ("recipes.sodium", lambda cur: _add_column_if_missing(cur, 'recipes', 'sodium', 'REAL DEFAULT 0.0')),
+    ("Usuário padrão", _migration_seed_default_user),
+    ("recipes UNIQUE(user_id, name)", _migration_recipes_unique_name),
+    ("body_metrics índice (user_id, date)", _migration_body_metrics_user_date),
+    ("hidden_reference_foods", _migration_hidden_reference_foods),
+    ("body_metrics.fat_mass/lean_mass", _migration_body_metrics_derived_mass),
+    ("body_metrics rollups semanal/mensal", _migration_body_metrics_rollups),
+    ("water_intake/water_daily", _migration_water_intake),
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(conn):
+    """Aplica as migrações pendentes em uma única transação. Retorna a lista de migrações aplicadas."""
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return []
+
+    applied = []
+    cur = conn.cursor()
+    # BEGIN IMMEDIATE serializa workers que iniciam ao mesmo tempo; a versão é relida já com o lock
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(conn)
+        for name, migration in SCHEMA_MIGRATIONS[current:]:
+            migration(cur)
+            applied.append(name)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+@st.cache_resource
+def init_db():
+    with db_conn() as conn:
+        # Caminho rápido: com o schema em dia, a inicialização é uma única leitura de PRAGMA
+        migrate_db(conn)
+
     # Garante que a pasta de fotos exista
     os.makedirs(PHOTOS_DIR, exist_ok=True)
 
 # 3. Funções de Alimentos (CRUDS e Importação CSV)
-def save_food(user_id, name, cal, prot, carb, fat, fiber, sodium): 
-    conn = get_conn(); cur = conn.cursor()
+class FoodCatalogCache:
+    """Cache LRU, por processo, do catálogo (FoodCatalog) de cada usuário.
+
+    Cada usuário tem um contador de versão; toda escrita em `recipes` chama bump(),
+    e uma entrada só é servida se foi carregada na versão atual. A versão inclui também a
+    do catálogo de referência, então regravar o arquivo invalida o catálogo de todos.
+    """
+    def __init__(self, max_users=FOOD_CACHE_MAX_USERS):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        # Versões vêm de um relógio único, então nunca se repetem. Só ficam em _versions os usuários
+        # em cache ou com escrita recente; os demais valem _floor, que é >= toda versão já descartada
+        # (assim uma carga iniciada antes de uma escrita nunca volta a bater com a versão atual).
+        self._versions = {}
+        self._clock = 0
+        self._floor = 0
+        self._entries = OrderedDict()  # user_id -> [versão, catálogo, {estruturas derivadas}]
+
+    def _prune_versions(self):
+        # Chamado com o lock: limita _versions a ~2x max_users descartando quem não está em cache
+        if len(self._versions) <= 2 * self.max_users:
+            return
+        for user_id in [u for u in self._versions if u not in self._entries]:
+            self._floor = max(self._floor, self._versions.pop(user_id))
+
+    def version(self, user_id):
+        reference_version = reference_catalog_version()
+        with self._lock:
+            return (self._versions.get(user_id, self._floor), reference_version)
+
+    def bump(self, user_id):
+        with self._lock:
+            self._clock += 1
+            self._versions[user_id] = self._clock
+            self._entries.pop(user_id, None)
+            self._prune_versions()
+
+    def get(self, user_id, loader):
+        reference_version = reference_catalog_version()
+        with self._lock:
+            version = (self._versions.get(user_id, self._floor), reference_version)
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        # Carrega fora do lock; se houve escrita no meio tempo, a versão não bate e nada é guardado
+        df = loader(user_id)
+        with self._lock:
+            if self._versions.get(user_id, self._floor) == version[0]:
+                self._versions[user_id] = version[0]  # fixa a versão: _floor pode subir depois
+                self._entries[user_id] = [version, df, {}]
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+                self._prune_versions()
+        return df
+
+    def get_derived(self, user_id, loader, key, builder):
+        """Estrutura derivada do catálogo (ex.: matriz de nutrientes), construída uma vez por versão."""
+        df = self.get(user_id, loader)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] is df and key in entry[2]:
+                return entry[2][key]
+
+        # Constrói fora do lock (um índice de busca leva centenas de ms) para não travar os outros
+        # usuários; só guarda se a entrada ainda é a do mesmo DataFrame
+        derived = builder(df)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] is df:
+                derived = entry[2].setdefault(key, derived)
+        return derived
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+FOOD_CACHE = shared_resource('food_cache', FoodCatalogCache)
+
+_REFERENCE_LOCK = shared_resource('reference_lock', threading.Lock)
+_REFERENCE_CACHE = shared_resource('reference_cache', dict)  # caminho -> (mtime, DataFrame)
+_REFERENCE_MTIMES = shared_resource('reference_mtimes', dict)  # caminho -> (verificado_em, mtime)
+_REFERENCE_DERIVED = shared_resource('reference_derived', dict)  # caminho -> (DataFrame, {estruturas derivadas})
+
+def build_reference_catalog(csv_file, out_path=REFERENCE_CATALOG_PATH):
+    """Compila um CSV (mesmas colunas da importação) no arquivo compacto do catálogo de referência.
+
+    Retorna o número de alimentos gravados. Nomes repetidos mantêm a primeira ocorrência; linhas
+    inválidas ou malformadas são descartadas. O arquivo é lido como UTF-8 e, se não for, como latin-1.
+    """
+    for encoding in CSV_IMPORT_ENCODINGS:
+        try:
+            parts = [_validate_food_chunk(chunk)[0] for chunk, _ in _read_csv_chunks(csv_file, CSV_IMPORT_CHUNK_ROWS, encoding)]
+            break
+        except UnicodeDecodeError:
+            if encoding == CSV_IMPORT_ENCODINGS[-1]:
+                raise
+    foods = pd.concat(parts, ignore_index=True).drop_duplicates(subset='name', keep='first')
+    np.savez_compressed(
+        out_path,
+        names=foods['name'].to_numpy(dtype=str),
+        values=foods[NUTRIENT_COLUMNS].to_numpy(dtype=float),
+    )
+    # Neste processo o arquivo novo vale já, sem esperar REFERENCE_CHECK_INTERVAL
+    _REFERENCE_MTIMES.pop(out_path, None)
+    return len(foods)
+
+def reference_catalog_version(path=None):
+    """mtime do arquivo do catálogo de referência (None se não existir); muda quando ele é regravado.
+
+    O stat é refeito no máximo a cada REFERENCE_CHECK_INTERVAL s, já que toda leitura do catálogo passa aqui.
+    """
+    path = path or REFERENCE_CATALOG_PATH
+    now = time.monotonic()
+    checked = _REFERENCE_MTIMES.get(path)
+    if checked is not None and now - checked[0] < REFERENCE_CHECK_INTERVAL:
+        return checked[1]
     try:
-        cur.execute("INSERT INTO recipes (user_id, name, cost, calories, protein, carbs, fat, fiber, sodium) VALUES (?, ?, 0.0, ?, ?, ?, ?, ?, ?)", 
-                    (user_id, name, cal, prot, carb, fat, fiber, sodium)) 
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    _REFERENCE_MTIMES[path] = (now, mtime)
+    return mtime
+
+def get_reference_catalog(path=None):
+    """Catálogo de referência como DataFrame (carregado uma vez por processo; ids negativos).
+
+    Sem o arquivo, retorna um catálogo vazio e o app funciona só com os alimentos de cada usuário.
+    """
+    path = path or REFERENCE_CATALOG_PATH
+    mtime = reference_catalog_version(path)
+
+    with _REFERENCE_LOCK:
+        cached = _REFERENCE_CACHE.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        if mtime is None:
+            reference = pd.DataFrame(columns=['id', 'name', 'cost'] + NUTRIENT_COLUMNS)
+        else:
+            with np.load(path, allow_pickle=False) as data:
+                names, values = data['names'], data['values']
+            reference = pd.DataFrame(values, columns=NUTRIENT_COLUMNS)
+            reference['calories'] = reference['calories'].round().astype(int)
+            reference.insert(0, 'cost', 0.0)
+            reference.insert(0, 'name', names.astype(object))
+            # Ids negativos distinguem os itens de referência das linhas de `recipes`
+            reference.insert(0, 'id', -np.arange(1, len(reference) + 1))
+        _REFERENCE_CACHE[path] = (mtime, reference)
+        return reference
+
+def reference_derived(reference, key, builder, path=None):
+    """Estrutura derivada da referência (matriz, índice de busca), construída uma vez por versão do
+    arquivo e compartilhada por todos os usuários."""
+    path = path or REFERENCE_CATALOG_PATH
+    with _REFERENCE_LOCK:
+        entry = _REFERENCE_DERIVED.get(path)
+        if entry is not None and entry[0] is reference and key in entry[1]:
+            return entry[1][key]
+
+    # Constrói fora do lock, como FoodCatalogCache.get_derived
+    derived = builder(reference)
+    with _REFERENCE_LOCK:
+        entry = _REFERENCE_DERIVED.get(path)
+        if entry is None or entry[0] is not reference:
+            if _REFERENCE_CACHE.get(path, (None, None))[1] is not reference:
+                return derived  # referência já substituída por uma versão mais nova: não guarda
+            entry = _REFERENCE_DERIVED[path] = (reference, {})
+        return entry[1].setdefault(key, derived)
+
+def _reference_food(food_id):
+    reference = get_reference_catalog()
+    index = -food_id - 1
+    if 0 <= index < len(reference):
+        return reference.iloc[index]
+    return None
+
+def _owner_of_food(conn, food_id):
+    row = conn.execute("SELECT user_id FROM recipes WHERE id=?", (food_id,)).fetchone()
+    return row['user_id'] if row else None
+
+def save_food(user_id, name, cal, prot, carb, fat, fiber, sodium):
+    with db_conn() as conn:
+        try:
+            conn.execute("INSERT INTO recipes (user_id, name, cost, calories, protein, carbs, fat, fiber, sodium) VALUES (?, ?, 0.0, ?, ?, ?, ?, ?, ?)",
+                         (user_id, name, cal, prot, carb, fat, fiber, sodium))
+            conn.commit()
+            FOOD_CACHE.bump(user_id)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+class FoodCatalog:
+    """Catálogo de um usuário: os alimentos dele (adições e edições) sobre a referência compartilhada.
+
+    A referência não é copiada: o usuário guarda só as próprias linhas e as posições das linhas da
+    referência que continuam visíveis (não sobrescritas nem ocultas). A visão mesclada tem as linhas
+    do usuário primeiro e depois as visíveis da referência, e só é montada quando alguém a pede.
+    """
+    def __init__(self, own, reference, masked_names):
+        self.own = own
+        self.reference = reference
+        if reference.empty or not masked_names:
+            self.visible_rows = np.arange(len(reference))
+        else:
+            self.visible_rows = np.flatnonzero(~reference['name'].isin(masked_names).to_numpy())
+
+    def __len__(self):
+        return len(self.own) + len(self.visible_rows)
+
+    def _visible_reference(self):
+        if len(self.visible_rows) == len(self.reference):
+            return self.reference
+        return self.reference.iloc[self.visible_rows]
+
+    def frame(self):
+        """Visão mesclada como DataFrame (a referência inteira, sem cópia, para quem não tem alimentos próprios)."""
+        if self.reference.empty:
+            return self.own
+        if self.own.empty:
+            return self._visible_reference()
+        return pd.concat([self.own, self._visible_reference()], ignore_index=True)
+
+    def column(self, col):
+        """Valores de uma coluna na ordem da visão mesclada (array numpy)."""
+        own = self.own[col].to_numpy()
+        if not len(self.visible_rows):
+            return own
+        return np.concatenate([own, self.reference[col].to_numpy()[self.visible_rows]])
+
+    def take(self, positions):
+        """Linhas da visão mesclada nas posições dadas, nessa ordem, sem montar o catálogo inteiro."""
+        positions = np.asarray(positions, dtype=np.intp)
+        is_own = positions < len(self.own)
+        own_part = self.own.iloc[positions[is_own]]
+        reference_part = self.reference.iloc[self.visible_rows[positions[~is_own] - len(self.own)]]
+        if not is_own.any():
+            return reference_part.reset_index(drop=True)
+        if is_own.all():
+            return own_part.reset_index(drop=True)
+        # concat põe as linhas do usuário antes; a permutação devolve a ordem pedida
+        taken = pd.concat([own_part, reference_part], ignore_index=True)
+        order = np.argsort(np.concatenate([np.flatnonzero(is_own), np.flatnonzero(~is_own)]), kind='stable')
+        return taken.iloc[order].reset_index(drop=True)
+
+def _load_foods(user_id):
+    """Catálogo do usuário: as linhas dele em `recipes` mais a referência não sobrescrita nem oculta."""
+    with db_conn() as conn:
+        user_foods = pd.read_sql("SELECT id, name, cost, calories, protein, carbs, fat, fiber, sodium FROM recipes WHERE user_id = ?", conn, params=(user_id,))
+        hidden = {row[0] for row in conn.execute("SELECT name FROM hidden_reference_foods WHERE user_id = ?", (user_id,))}
+    return FoodCatalog(user_foods, get_reference_catalog(), hidden.union(user_foods['name'].tolist()))
 
 def get_all_foods(user_id):
-    conn = get_conn(); 
-    foods = pd.read_sql("SELECT id, name, cost, calories, protein, carbs, fat, fiber, sodium FROM recipes WHERE user_id = ?", conn, params=(user_id,))
-    conn.close()
-    return foods
-
-def get_food_by_id(food_id):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT id, name, calories, protein, carbs, fat, fiber, sodium FROM recipes WHERE id=?", (food_id,))
-    food = cur.fetchone()
-    conn.close()
+    # Cópia rasa: o chamador pode renomear/adicionar colunas sem afetar a entrada em cache
+    return FOOD_CACHE.get(user_id, _load_foods).frame().copy(deep=False)
+
+def get_nutrient_matrix(user_id):
+    return FOOD_CACHE.get_derived(user_id, _load_foods, 'matrix', CatalogNutrientMatrix)
+
+def normalize_food_name(text):
+    """Minúsculas, sem acentos e com espaços simples ('Feijão  Preto' -> 'feijao preto')."""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).lower().split())
+
+class FoodSearchIndex:
+    """Índice de busca em memória sobre os nomes do catálogo, insensível a acentos.
+
+    Cada termo da consulta casa por prefixo de palavra (busca binária numa lista ordenada de
+    palavras) ou, com 3+ letras, por trecho via trigramas. Os resultados são ordenados por
+    relevância: nome começando pela consulta, depois prefixo de palavra, depois trecho.
+    """
+    def __init__(self, names):
+        self.names = [str(name) for name in names]
+        self.normalized = [normalize_food_name(name) for name in self.names]
+        self.words = sorted((word, row) for row, norm in enumerate(self.normalized) for word in set(norm.split()))
+        self.word_keys = [word for word, _ in self.words]
+        trigrams = {}
+        for row, norm in enumerate(self.normalized):
+            for i in range(len(norm) - 2):
+                trigrams.setdefault(norm[i:i + 3], set()).add(row)
+        self.trigrams = trigrams
+
+    def _prefix_rows(self, token):
+        start = bisect.bisect_left(self.word_keys, token)
+        end = bisect.bisect_left(self.word_keys, token + '\uffff')
+        return {row for _, row in self.words[start:end]}
+
+    def _substring_rows(self, token):
+        postings = [self.trigrams.get(token[i:i + 3]) for i in range(len(token) - 2)]
+        if not postings or any(p is None for p in postings):
+            return set()
+        candidates = set.intersection(*sorted(postings, key=len))
+        return {row for row in candidates if token in self.normalized[row]}
+
+    def _match(self, tokens):
+        rows = None
+        prefix_hits = None
+        for token in tokens:
+            by_prefix = self._prefix_rows(token)
+            matched = by_prefix | self._substring_rows(token) if len(token) >= 3 else by_prefix
+            rows = matched if rows is None else rows & matched
+            prefix_hits = by_prefix if prefix_hits is None else prefix_hits & by_prefix
+            if not rows:
+                return set(), set()
+        return rows, prefix_hits
+
+    def match_rows(self, query):
+        """Todas as linhas (posições no catálogo) que casam com a consulta."""
+        tokens = normalize_food_name(query).split()
+        return self._match(tokens)[0] if tokens else set(range(len(self.names)))
+
+    def ranked(self, query, k=50, visible=None):
+        """Até k pares (chave de relevância, nome), só entre as linhas com visible[linha] (se dado)."""
+        tokens = normalize_food_name(query).split()
+        if not tokens:
+            return []
+
+        rows, prefix_hits = self._match(tokens)
+        if visible is not None:
+            rows = [row for row in rows if visible[row]]
+        full = ' '.join(tokens)
+
+        def rank(row):
+            norm = self.normalized[row]
+            tier = 0 if norm.startswith(full) else 1 if row in prefix_hits else 2
+            return (tier, len(norm), norm)
+
+        return [(rank(row), self.names[row]) for row in heapq.nsmallest(k, rows, key=rank)]
+
+    def search(self, query, k=50):
+        """Retorna até k nomes que casam com todos os termos da consulta."""
+        return [name for _, name in self.ranked(query, k)]
+
+class CatalogSearchIndex:
+    """Busca no catálogo de um usuário: índice próprio (só com os alimentos dele) + o índice
+    compartilhado da referência, filtrado pelas linhas visíveis. Linhas = posições na visão mesclada."""
+    def __init__(self, catalog):
+        self.n_own = len(catalog.own)
+        self.own = FoodSearchIndex(catalog.own['name'])
+        self.reference = reference_derived(catalog.reference, 'search', lambda df: FoodSearchIndex(df['name']))
+        self.visible_rows = catalog.visible_rows
+        self.visible = np.zeros(len(catalog.reference), dtype=bool)
+        self.visible[catalog.visible_rows] = True
+
+    def search(self, query, k=50):
+        ranked = self.own.ranked(query, k) + self.reference.ranked(query, k, self.visible)
+        return [name for _, name in heapq.nsmallest(k, ranked)]
+
+    def match_rows(self, query):
+        """Todas as posições (na visão mesclada) que casam com a consulta."""
+        reference_rows = np.fromiter((row for row in self.reference.match_rows(query) if self.visible[row]), dtype=np.intp)
+        positions = self.n_own + np.searchsorted(self.visible_rows, reference_rows)
+        return self.own.match_rows(query) | set(positions.tolist())
+
+    def normalized_at(self, positions):
+        """Nomes normalizados (sem acentos, minúsculos) das posições dadas da visão mesclada."""
+        own, reference = self.own.normalized, self.reference.normalized
+        return [own[pos] if pos < self.n_own else reference[self.visible_rows[pos - self.n_own]] for pos in positions]
+
+def _food_search_index(user_id):
+    return FOOD_CACHE.get_derived(user_id, _load_foods, 'search', CatalogSearchIndex)
+
+def search_foods(user_id, query, k=FOOD_PICKER_TOP_K):
+    return _food_search_index(user_id).search(query, k)
+
+def query_foods(user_id, name_query='', min_values=None, max_values=None, sort_by='name', ascending=True, page=1, page_size=50):
+    """Uma página do catálogo filtrado e ordenado: retorna (DataFrame da página, total de linhas filtradas).
+
+    Os filtros são vetorizados sobre o catálogo em cache (próprio + referência compartilhada, sem
+    montar a visão mesclada); só as linhas da página são materializadas. min_values/max_values
+    mapeiam coluna -> limite.
+    """
+    catalog = FOOD_CACHE.get(user_id, _load_foods)
+    mask = np.ones(len(catalog), dtype=bool)
+    if name_query:
+        rows = _food_search_index(user_id).match_rows(name_query)
+        name_mask = np.zeros(len(catalog), dtype=bool)
+        name_mask[list(rows)] = True
+        mask &= name_mask
+    for col, limit in (min_values or {}).items():
+        mask &= np.nan_to_num(catalog.column(col).astype(float)) >= limit
+    for col, limit in (max_values or {}).items():
+        mask &= np.nan_to_num(catalog.column(col).astype(float)) <= limit
+
+    rows = np.flatnonzero(mask)
+    if sort_by == 'name':
+        # Ordem alfabética sem acentos, usando os nomes já normalizados dos índices de busca
+        keys = np.array(_food_search_index(user_id).normalized_at(rows), dtype=object)
+    else:
+        keys = np.nan_to_num(catalog.column(sort_by).astype(float))[rows]
+    order = np.argsort(keys, kind='stable')
+    if not ascending:
+        order = order[::-1]
+
+    start = max(page - 1, 0) * page_size
+    page_rows = rows[order[start:start + page_size]]
+    return catalog.take(page_rows), len(rows)
+
+def get_food_by_id(food_id, user_id=None):
+    """Busca um alimento pelo ID. Com user_id, só retorna itens visíveis para esse usuário."""
+    if food_id < 0:
+        food = _reference_food(food_id)
+        if food is None:
+            return None
+        if user_id is not None:
+            with db_conn() as conn:
+                hidden = conn.execute("SELECT 1 FROM hidden_reference_foods WHERE user_id=? AND name=?", (user_id, str(food['name']))).fetchone()
+            if hidden:
+                return None
+        return {'id': int(food['id']), 'name': str(food['name']), 'calories': int(food['calories']),
+                **{col: float(food[col]) for col in NUTRIENT_COLUMNS[1:]}}
+    with db_conn() as conn:
+        if user_id is None:
+            food = conn.execute("SELECT id, name, calories, protein, carbs, fat, fiber, sodium FROM recipes WHERE id=?", (food_id,)).fetchone()
+        else:
+            food = conn.execute("SELECT id, name, calories, protein, carbs, fat, fiber, sodium FROM recipes WHERE id=? AND user_id=?", (food_id, user_id)).fetchone()
     return dict(food) if food else None
 
-def update_food(food_id, name, cal, prot, carb, fat, fiber, sodium): 
-    conn = get_conn(); cur = conn.cursor()
-    try:
-        cur.execute("UPDATE recipes SET name=?, calories=?, protein=?, carbs=?, fat=?, fiber=?, sodium=? WHERE id=?", 
-                    (name, cal, prot, carb, fat, fiber, sodium, food_id)) 
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+def _hide_shadowed_reference(conn, user_id, name):
+    # Uma linha do usuário com o nome de um item da referência (cópia copy-on-write) o escondia;
+    # se ela for renomeada ou excluída, o original continua oculto em vez de reaparecer
+    if (get_reference_catalog()['name'] == name).any():
+        conn.execute("INSERT OR IGNORE INTO hidden_reference_foods (user_id, name) VALUES (?, ?)", (user_id, name))
+
+def update_food(food_id, name, cal, prot, carb, fat, fiber, sodium, user_id=None):
+    """Atualiza um alimento. Itens de referência (id < 0) são copiados para o banco do usuário (copy-on-write)."""
+    with db_conn() as conn:
+        try:
+            if food_id < 0:
+                reference = _reference_food(food_id)
+                if reference is None or user_id is None:
+                    return False
+                conn.execute("INSERT INTO recipes (user_id, name, cost, calories, protein, carbs, fat, fiber, sodium) VALUES (?, ?, 0.0, ?, ?, ?, ?, ?, ?)",
+                             (user_id, name, cal, prot, carb, fat, fiber, sodium))
+                if name != reference['name']:
+                    # Renomeado: o item original da referência deixa de aparecer
+                    conn.execute("INSERT OR IGNORE INTO hidden_reference_foods (user_id, name) VALUES (?, ?)", (user_id, reference['name']))
+                owner = user_id
+            else:
+                row = conn.execute("SELECT user_id, name FROM recipes WHERE id=?", (food_id,)).fetchone()
+                if row is None:
+                    return False
+                owner = row['user_id']
+                conn.execute("UPDATE recipes SET name=?, calories=?, protein=?, carbs=?, fat=?, fiber=?, sodium=? WHERE id=?",
+                             (name, cal, prot, carb, fat, fiber, sodium, food_id))
+                if name != row['name']:
+                    _hide_shadowed_reference(conn, owner, row['name'])
+            conn.commit()
+            FOOD_CACHE.bump(owner)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+def delete_food(food_id, user_id=None):
+    """Exclui um alimento. Para itens de referência (id < 0) apenas os oculta para o usuário."""
+    with db_conn() as conn:
+        try:
+            if food_id < 0:
+                reference = _reference_food(food_id)
+                if reference is None or user_id is None:
+                    return False
+                conn.execute("INSERT OR IGNORE INTO hidden_reference_foods (user_id, name) VALUES (?, ?)", (user_id, reference['name']))
+                owner = user_id
+            else:
+                row = conn.execute("SELECT user_id, name FROM recipes WHERE id=?", (food_id,)).fetchone()
+                if row is None:
+                    return False
+                owner = row['user_id']
+                conn.execute("DELETE FROM recipes WHERE id=?", (food_id,))
+                _hide_shadowed_reference(conn, owner, row['name'])
+            conn.commit()
+            FOOD_CACHE.bump(owner)
+            return True
+        except Exception:
+            return False
+
+CSV_REQUIRED_COLS = ['name', 'calories', 'protein', 'carbs', 'fat']
+CSV_OPTIONAL_COLS = ['fiber', 'sodium']
+
+def _validate_food_chunk(chunk):
+    """Valida um bloco do CSV de forma vetorizada.
+
+    Retorna (DataFrame com as linhas válidas já convertidas, lista de (índice, motivo) das rejeitadas).
+    """
+    valid = pd.DataFrame(index=chunk.index)
+    reasons = pd.Series('', index=chunk.index, dtype=object)
+
+    names = chunk['name'].fillna('').astype(str).str.strip()
+    reasons[names == ''] = 'nome vazio'
+    valid['name'] = names
+
+    for col in CSV_REQUIRED_COLS[1:] + CSV_OPTIONAL_COLS:
+        raw = chunk[col] if col in chunk.columns else pd.Series(np.nan, index=chunk.index)
+        if pd.api.types.is_numeric_dtype(raw):
+            # Caminho rápido: o parser em C já converteu a coluna inteira (vazios viram NaN)
+            blank = raw.isna()
+            values = raw.astype(float)
+        else:
+            text = raw.astype(str).str.strip()
+            blank = raw.isna() | (text == '')
+            values = pd.to_numeric(text.str.replace(',', '.', regex=False).where(~blank), errors='coerce')
+        if col in CSV_OPTIONAL_COLS:
+            # Opcionais: em branco vale 0.0, mas texto inválido rejeita a linha
+            values = values.where(~blank, 0.0)
+        # inf/-inf passam pelo parser ('inf', '1e999'), mas não são valores nutricionais válidos
+        bad = values.isna() | ~np.isfinite(values) | (values < 0)
+        reasons[bad & (reasons == '')] = f"valor inválido em '{col}'"
+        valid[col] = values
+
+    ok = reasons == ''
+    rejected = list(reasons[~ok].items())
+    valid = valid[ok]
+    valid['calories'] = valid['calories'].round().astype(int)
+    return valid, rejected
+
+_BAD_LINE_RE = re.compile(r'Skipping line (\d+): (.*)')
+
+def _read_csv_chunks(csv_file, chunk_rows, encoding):
+    """Lê o CSV em blocos: gera (bloco, [(linha, motivo)] das linhas puladas por ter o nº errado de campos).
+
+    Com on_bad_lines='warn' o parser em C pula essas linhas (avisando o número de cada uma) em vez
+    de abortar a leitura inteira.
+    """
+    if hasattr(csv_file, 'seek'):
+        csv_file.seek(0)
+    reader = pd.read_csv(csv_file, chunksize=chunk_rows, dtype={'name': str}, skipinitialspace=True,
+                         encoding=encoding, on_bad_lines='warn')
+    columns = CSV_REQUIRED_COLS
+    while True:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', pd.errors.ParserWarning)
+            chunk = next(reader, None)
+        bad_lines = []
+        for warning in caught:
+            match = _BAD_LINE_RE.match(str(warning.message))
+            if match:
+                bad_lines.append((int(match.group(1)), f"linha malformada: {match.group(2).strip()}"))
+        if chunk is None:
+            if bad_lines:
+                yield pd.DataFrame(columns=columns), bad_lines
+            return
+        chunk.columns = columns = [str(c).strip() for c in chunk.columns]
+        yield chunk, bad_lines
+
+def _file_line(index, bad_lines):
+    """Número da linha no arquivo de uma linha de dados (índice do pandas), descontando as linhas puladas."""
+    line = index + 2  # cabeçalho e base 1
+    for bad in bad_lines:  # ordenadas
+        if bad > line:
+            break
+        line += 1
+    return line
+
+def _import_food_chunks(user_id, csv_file, sql, on_duplicate, chunk_rows, max_errors, encoding):
+    summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0, 'errors': [], 'encoding': encoding}
+    bad_line_numbers = []
+    with db_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        existing = {row[0] for row in conn.execute("SELECT name FROM recipes WHERE user_id = ?", (user_id,))}
+        for chunk, bad_lines in _read_csv_chunks(csv_file, chunk_rows, encoding):
+            missing = [col for col in CSV_REQUIRED_COLS if col not in chunk.columns]
+            if missing:
+                conn.rollback()
+                return summary, f"O arquivo CSV deve conter as colunas: {', '.join(CSV_REQUIRED_COLS)}"
+
+            valid, rejected = _validate_food_chunk(chunk)
+            bad_line_numbers.extend(line for line, _ in bad_lines)
+            errors = bad_lines + [(_file_line(index, bad_line_numbers), reason) for index, reason in rejected[:max_errors]]
+            summary['rejected'] += len(bad_lines) + len(rejected)
+            summary['errors'].extend(sorted(errors)[:max_errors - len(summary['errors'])])
+
+            # Classifica cada linha como nova ou repetida (no banco ou antes no próprio arquivo)
+            # (consulta ao set por linha: isin(set) converteria o set inteiro a cada bloco)
+            in_db = np.fromiter((name in existing for name in valid['name'].tolist()), dtype=bool, count=len(valid))
+            is_new = ~in_db & ~valid['name'].duplicated(keep='first').to_numpy()
+            existing.update(valid.loc[is_new, 'name'])
+            n_new = int(is_new.sum())
+            summary['inserted'] += n_new
+            if on_duplicate == 'upsert':
+                summary['updated'] += len(valid) - n_new
+            else:
+                summary['skipped'] += len(valid) - n_new
+                valid = valid[is_new]
 
-def delete_food(food_id):
-    conn = get_conn(); cur = conn.cursor()
-    try:
-        cur.execute("DELETE FROM recipes WHERE id=?", (food_id,))
+            valid.insert(0, 'user_id', user_id)
+            conn.executemany(sql, valid[['user_id', 'name', 'calories', 'protein', 'carbs', 'fat', 'fiber', 'sodium']].itertuples(index=False, name=None))
         conn.commit()
-        return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
-
-def import_foods_from_csv(user_id, csv_file):
-    """Importa alimentos do CSV para o banco de dados do usuário."""
-    try:
-        df = pd.read_csv(csv_file)
-        required_cols = ['name', 'calories', 'protein', 'carbs', 'fat']
-        
-        if not all(col in df.columns for col in required_cols):
-            return 0, f"O arquivo CSV deve conter as colunas: {', '.join(required_cols)}"
-        
-        df['fiber'] = df.get('fiber', 0.0)
-        df['sodium'] = df.get('sodium', 0.0) 
-        df = df[required_cols + ['fiber', 'sodium']]
-        
-        df['cost'] = 0.0 
-        df['user_id'] = user_id
-        
-        df = df.astype({
-            'name': str, 'calories': int, 'protein': float, 'carbs': float, 'fat': float,
-            'fiber': float, 'sodium': float, 'user_id': int, 'cost': float
-        })
-        
-        conn = get_conn()
-        count_before = pd.read_sql("SELECT COUNT(*) FROM recipes WHERE user_id = ?", conn, params=(user_id,)).iloc[0, 0]
-        
-        df[['user_id', 'name', 'cost', 'calories', 'protein', 'carbs', 'fat', 'fiber', 'sodium']].to_sql(
-            'recipes', conn, if_exists='append', index=False
-        )
-        
-        count_after = pd.read_sql("SELECT COUNT(*) FROM recipes WHERE user_id = ?", conn, params=(user_id,)).iloc[0, 0]
-        conn.close()
-        
-        return count_after - count_before, None
-        
-    except Exception as e:
-        return 0, f"Erro ao processar o CSV: {e}"
+    return summary, None
+
+def import_foods_from_csv(user_id, csv_file, on_duplicate='skip', chunk_rows=CSV_IMPORT_CHUNK_ROWS, max_errors=CSV_IMPORT_MAX_ERRORS):
+    """Importa alimentos do CSV para o banco de dados do usuário, em blocos e em uma única transação.
+
+    Linhas inválidas ou malformadas (nº errado de campos) são rejeitadas, com o número da linha e o
+    motivo, sem abortar a importação. O arquivo é lido como UTF-8 e, se não for, como latin-1.
+    Nomes já existentes para o usuário são ignorados (on_duplicate='skip') ou atualizados ('upsert').
+
+    Retorna (resumo, erro) onde resumo = {'inserted', 'updated', 'skipped', 'rejected', 'errors', 'encoding'};
+    'errors' guarda no máximo max_errors pares (linha, motivo).
+    """
+    if on_duplicate == 'upsert':
+        sql = """
+            INSERT INTO recipes (user_id, name, cost, calories, protein, carbs, fat, fiber, sodium)
+            VALUES (?, ?, 0.0, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, name) DO UPDATE SET
+                calories=excluded.calories, protein=excluded.protein, carbs=excluded.carbs,
+                fat=excluded.fat, fiber=excluded.fiber, sodium=excluded.sodium
+        """
+    else:
+        sql = """
+            INSERT INTO recipes (user_id, name, cost, calories, protein, carbs, fat, fiber, sodium)
+            VALUES (?, ?, 0.0, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, name) DO NOTHING
+        """
+
+    empty = {'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0, 'errors': [], 'encoding': None}
+    for encoding in CSV_IMPORT_ENCODINGS:
+        try:
+            summary, error = _import_food_chunks(user_id, csv_file, sql, on_duplicate, chunk_rows, max_errors, encoding)
+        except UnicodeDecodeError:
+            # A transação já foi desfeita pelo db_conn; relê o arquivo inteiro na próxima codificação
+            continue
+        except Exception as e:
+            return empty, f"Erro ao processar o CSV: {e}"
+        if summary['inserted'] or summary['updated']:
+            FOOD_CACHE.bump(user_id)
+        return summary, error
+    return empty, "Erro ao processar o CSV: codificação não reconhecida (tente salvar como UTF-8)"
 
 
 # 4. Funções de Planejador e Otimização 
@@ -267,36 +1212,357 @@ def calculate_smart_macros(gender, weight, height, age, activity_level_factor, g
     
     return int(final_cal), target_prot, target_carbs, target_fat, target_sodium
 
-def calculate_macros_from_plan(df_plan, df_foods):
-    """Calcula os macros totais (por 100g) de um plano manual/refeição."""
-    if df_plan.empty or df_plan['Gramas'].sum() == 0:
-        return {'cal': 0, 'prot': 0.0, 'carbs': 0.0, 'fat': 0.0, 'fiber': 0.0, 'sodium': 0.0}
+# Colunas de nutrientes do banco (por 100g) e as chaves usadas nos dicionários de totais
+NUTRIENT_COLUMNS = ['calories', 'protein', 'carbs', 'fat', 'fiber', 'sodium']
+NUTRIENT_KEYS = ['cal', 'prot', 'carbs', 'fat', 'fiber', 'sodium']
+
+class NutrientMatrix:
+    """Matriz densa alimentos x nutrientes (por 100g) com índice nome/id -> linha.
+
+    A última linha é toda zero e recebe alimentos desconhecidos ou vazios, de modo que
+    o total de qualquer conjunto de (alimento, gramas) é um gather + um produto matriz-vetor.
+    """
+    def __init__(self, df_foods):
+        values = df_foods[NUTRIENT_COLUMNS].to_numpy(dtype=float, na_value=0.0)
+        self.matrix = np.vstack([values, np.zeros((1, len(NUTRIENT_COLUMNS)))])
+        self.missing_row = len(values)
+        self.row_by_name = {}
+        # Em caso de nomes repetidos vale o primeiro
+        for row, name in enumerate(df_foods['name']):
+            self.row_by_name.setdefault(name, row)
+        self.row_by_id = {}
+        if 'id' in df_foods.columns:
+            self.row_by_id = {food_id: row for row, food_id in enumerate(df_foods['id'])}
+
+    def rows(self, foods):
+        """Converte nomes (ou ids) de alimentos em índices de linha da matriz."""
+        missing = self.missing_row
+        get_name = self.row_by_name.get
+        get_id = self.row_by_id.get
+        return np.fromiter(
+            (get_name(f, missing) if isinstance(f, str) else get_id(f, missing) for f in foods),
+            dtype=np.intp, count=len(foods)
+        )
 
-    # Remove linhas vazias ou com Gramas=0
-    df_plan = df_plan[df_plan['Gramas'] > 0].copy()
+    def totals(self, foods, grams):
+        """Vetor de totais (mesma ordem de NUTRIENT_KEYS) para os pares (alimento, gramas)."""
+        grams = np.asarray(grams, dtype=float)
+        return self.matrix[self.rows(foods)].T @ (grams / 100)
+
+    def totals_by_group(self, foods, grams, groups, n_groups):
+        """Totais de vários grupos (ex.: refeições) em uma chamada: matriz n_groups x nutrientes."""
+        grams = np.asarray(grams, dtype=float)
+        out = np.zeros((n_groups, self.matrix.shape[1]))
+        np.add.at(out, np.asarray(groups, dtype=np.intp), self.matrix[self.rows(foods)] * (grams / 100)[:, None])
+        return out
+
+class CatalogNutrientMatrix:
+    """NutrientMatrix do catálogo de um usuário sem copiar a referência.
+
+    Os alimentos do usuário ficam numa matriz própria (pequena) e os da referência na matriz
+    compartilhada; cada alimento é procurado primeiro entre os do usuário, e linhas da referência
+    sobrescritas ou ocultas caem na linha zero. O total é a soma dos dois produtos.
+    """
+    def __init__(self, catalog):
+        self.own = NutrientMatrix(catalog.own)
+        self.reference = reference_derived(catalog.reference, 'matrix', NutrientMatrix)
+        # hidden[linha da referência] = True se o usuário não a vê (a última, a linha zero, fica False)
+        self.hidden = np.ones(self.reference.missing_row + 1, dtype=bool)
+        self.hidden[catalog.visible_rows] = False
+        self.hidden[-1] = False
+        self.uses_reference = len(catalog.visible_rows) > 0
+
+    def _rows(self, foods):
+        own_rows = self.own.rows(foods)
+        reference_rows = np.where(own_rows == self.own.missing_row, self.reference.rows(foods), self.reference.missing_row)
+        reference_rows[self.hidden[reference_rows]] = self.reference.missing_row
+        return own_rows, reference_rows
+
+    def totals(self, foods, grams):
+        if not self.uses_reference:
+            return self.own.totals(foods, grams)
+        grams = np.asarray(grams, dtype=float) / 100
+        own_rows, reference_rows = self._rows(foods)
+        return self.own.matrix[own_rows].T @ grams + self.reference.matrix[reference_rows].T @ grams
+
+    def totals_by_group(self, foods, grams, groups, n_groups):
+        if not self.uses_reference:
+            return self.own.totals_by_group(foods, grams, groups, n_groups)
+        grams = np.asarray(grams, dtype=float)[:, None] / 100
+        groups = np.asarray(groups, dtype=np.intp)
+        own_rows, reference_rows = self._rows(foods)
+        out = np.zeros((n_groups, self.own.matrix.shape[1]))
+        np.add.at(out, groups, self.own.matrix[own_rows] * grams + self.reference.matrix[reference_rows] * grams)
+        return out
+
+def macros_from_vector(vector):
+    totals = dict(zip(NUTRIENT_KEYS, (float(v) for v in vector)))
+    totals['cal'] = int(totals['cal'])
+    return totals
+
+def _plan_rows(df_plan):
+    """Extrai (alimentos, gramas) das linhas válidas (Gramas > 0) de um plano do data_editor."""
     if df_plan.empty:
-        return {'cal': 0, 'prot': 0.0, 'carbs': 0.0, 'fat': 0.0, 'fiber': 0.0, 'sodium': 0.0}
+        return [], np.empty(0)
+    grams = pd.to_numeric(df_plan['Gramas'], errors='coerce').fillna(0).to_numpy(dtype=float)
+    mask = grams > 0
+    foods = df_plan['Alimento'].to_numpy(dtype=object)[mask].tolist()
+    return foods, grams[mask]
 
-    # Junta o plano com o banco de alimentos (macronutrientes por 100g)
-    df_foods = df_foods.set_index('name')
-    df_merged = df_plan.merge(df_foods[['calories', 'protein', 'carbs', 'fat', 'fiber', 'sodium']], 
-                              left_on='Alimento', right_index=True, how='left')
+def _as_nutrient_matrix(foods):
+    # Testa pelo DataFrame: matrizes vindas do FOOD_CACHE podem ser de uma execução anterior do script
+    # (classe NutrientMatrix redefinida a cada rerun), então isinstance(foods, NutrientMatrix) falharia
+    return NutrientMatrix(foods) if isinstance(foods, pd.DataFrame) else foods
 
-    # Calcula o total de macros (macro/100g * gramas / 100)
-    df_merged['Cal_Total'] = df_merged['calories'] * (df_merged['Gramas'] / 100)
-    df_merged['Prot_Total'] = df_merged['protein'] * (df_merged['Gramas'] / 100)
-    df_merged['Carbs_Total'] = df_merged['carbs'] * (df_merged['Gramas'] / 100)
-    df_merged['Fat_Total'] = df_merged['fat'] * (df_merged['Gramas'] / 100)
-    df_merged['Fiber_Total'] = df_merged['fiber'] * (df_merged['Gramas'] / 100)
-    df_merged['Sodium_Total'] = df_merged['sodium'] * (df_merged['Gramas'] / 100)
+def calculate_macros_from_plan(df_plan, df_foods):
+    """Calcula os macros totais (por 100g) de um plano manual/refeição.
+
+    df_foods pode ser o DataFrame de alimentos ou uma NutrientMatrix já construída.
+    """
+    foods, grams = _plan_rows(df_plan)
+    if not foods:
+        return macros_from_vector(np.zeros(len(NUTRIENT_KEYS)))
+    return macros_from_vector(_as_nutrient_matrix(df_foods).totals(foods, grams))
+
+def _meal_vectors(meal_plans, meal_names, nutrients):
+    """Matriz len(meal_names) x nutrientes com os totais de cada refeição, em uma única chamada."""
+    all_foods, all_grams, groups = [], [], []
+    for group, meal_name in enumerate(meal_names):
+        foods, grams = _plan_rows(meal_plans[meal_name])
+        all_foods.extend(foods)
+        all_grams.append(grams)
+        groups.append(np.full(len(foods), group, dtype=np.intp))
+
+    if not all_foods:
+        return np.zeros((len(meal_names), len(NUTRIENT_KEYS)))
+    return nutrients.totals_by_group(all_foods, np.concatenate(all_grams), np.concatenate(groups), len(meal_names))
+
+def calculate_macros_batch(meal_plans, df_foods):
+    """Avalia todas as refeições de uma vez.
+
+    Recebe {nome_refeição: df_plano} e retorna ({nome_refeição: totais}, totais_diários).
+    """
+    meal_names = list(meal_plans.keys())
+    per_meal = _meal_vectors(meal_plans, meal_names, _as_nutrient_matrix(df_foods))
+
+    meal_totals = {name: macros_from_vector(per_meal[i]) for i, name in enumerate(meal_names)}
+    return meal_totals, macros_from_vector(per_meal.sum(axis=0))
+
+def meal_rows_digest(df_plan, catalog_version=0):
+    """Hash das linhas válidas de uma refeição (e da versão do catálogo usada para avaliá-las)."""
+    foods, grams = _plan_rows(df_plan)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(catalog_version).encode())
+    h.update(repr(foods).encode())
+    h.update(grams.tobytes())
+    return h.hexdigest()
+
+def calculate_macros_incremental(vector_cache, meal_plans, df_foods, catalog_version=0):
+    """Como calculate_macros_batch, mas reaproveita os vetores das refeições que não mudaram.
+
+    vector_cache é um dict {nome_refeição: (digest, vetor)} mantido pelo chamador (ex.: na sessão);
+    só as refeições cujo digest mudou são recalculadas, e o total diário é a soma dos vetores.
+    """
+    digests = {name: meal_rows_digest(df_plan, catalog_version) for name, df_plan in meal_plans.items()}
+    changed = [name for name, digest in digests.items()
+               if name not in vector_cache or vector_cache[name][0] != digest]
+
+    if changed:
+        per_meal = _meal_vectors(meal_plans, changed, _as_nutrient_matrix(df_foods))
+        for i, name in enumerate(changed):
+            vector_cache[name] = (digests[name], per_meal[i])
+
+    # Descarta refeições removidas ou renomeadas
+    for name in [name for name in vector_cache if name not in meal_plans]:
+        del vector_cache[name]
+
+    vectors = [vector_cache[name][1] for name in meal_plans]
+    daily = np.sum(vectors, axis=0) if vectors else np.zeros(len(NUTRIENT_KEYS))
+    meal_totals = {name: macros_from_vector(vector_cache[name][1]) for name in meal_plans}
+    return meal_totals, macros_from_vector(daily)
+
+# 4b. Otimizador Automático (PuLP / CBC)
+def select_optimizer_candidates(df_foods, max_candidates=OPTIMIZER_MAX_CANDIDATES):
+    """Pré-seleciona as melhores fontes de cada macro para manter o modelo pequeno.
+
+    Catálogos com milhares de itens geram dezenas de milhares de variáveis; as maiores fontes
+    (por 100g) de proteína, carboidrato e gordura, mais as proteínas mais magras (por kcal),
+    bastam para fechar as metas. Alimentos acima do limite diário de sódio por 100g são ignorados.
+    """
+    foods = df_foods[df_foods['calories'].fillna(0) > 0].drop_duplicates(subset='name')
+    if len(foods) <= max_candidates:
+        return foods.reset_index(drop=True)
+
+    foods = foods.fillna({col: 0.0 for col in NUTRIENT_COLUMNS})
+    rankings = [
+        foods['protein'],
+        foods['carbs'],
+        foods['fat'],
+        foods['protein'] / foods['calories'].astype(float),
+    ]
+    # Sódio como desempate: entre fontes equivalentes, prefere as menos salgadas
+    sodium_penalty = foods['sodium'].astype(float).rank(pct=True) * 1e-6
+    per_ranking = max(1, max_candidates // len(rankings))
+    chosen = set()
+    for score in rankings:
+        chosen.update((score.astype(float) - sodium_penalty).nlargest(per_ranking).index)
+    return foods.loc[sorted(chosen)].reset_index(drop=True)
+
+def optimize_diet(targets, df_foods, num_meals, meal_names=None, meal_splits=None,
+                  tolerance=0.10, meal_tolerance=0.25, max_items_per_meal=4, max_meals_per_food=2,
+                  min_portion=30, max_portion=300,
+                  time_limit=OPTIMIZER_TIME_LIMIT, gap=OPTIMIZER_GAP, max_candidates=OPTIMIZER_MAX_CANDIDATES):
+    """Resolve as gramas de cada alimento em cada refeição para atingir as metas diárias.
+
+    Restrições: cada macro (kcal, proteína, carboidrato, gordura) dentro de ±tolerance da meta,
+    sódio abaixo do limite, calorias de cada refeição dentro de ±meal_tolerance da sua fatia
+    (meal_splits), no máximo max_items_per_meal alimentos (porções entre min_portion e
+    max_portion gramas) por refeição e cada alimento em no máximo max_meals_per_food refeições.
+    O objetivo minimiza a soma dos desvios relativos das metas; `gap` é aplicado tanto como
+    gap relativo quanto absoluto (o objetivo já é adimensional e tende a zero).
+
+    Retorna um dicionário com 'status', 'plan' (DataFrame Refeição/Alimento/Gramas), 'totals' e 'stats'.
+    """
+    from pulp import (LpProblem, LpMinimize, LpVariable, PULP_CBC_CMD, LpStatus, value, lpSum,
+                      LpAffineExpression, LpSolution, LpSolutionOptimal, LpSolutionIntegerFeasible)
+
+    t_start = time.perf_counter()
+    meal_names = meal_names or [f"Refeição {i+1}" for i in range(num_meals)]
+    meal_splits = meal_splits or MEAL_CALORIE_SPLITS.get(num_meals, [1.0 / num_meals] * num_meals)
+
+    candidates = select_optimizer_candidates(df_foods, max_candidates)
+    nutrients = NutrientMatrix(candidates)
+    per_gram = nutrients.matrix[:-1] / 100  # nutriente por grama, alinhado com `candidates`
+    n_foods = len(candidates)
+
+    prob = LpProblem("EveFii_Dieta", LpMinimize)
+    grams = {}
+    use = {}
+    for m in range(num_meals):
+        for f in range(n_foods):
+            grams[f, m] = LpVariable(f"g_{f}_{m}", lowBound=0, upBound=max_portion)
+            use[f, m] = LpVariable(f"u_{f}_{m}", cat='Binary')
+            # Porção mínima se o alimento for usado, zero caso contrário
+            prob += grams[f, m] <= max_portion * use[f, m]
+            prob += grams[f, m] >= min_portion * use[f, m]
+        prob += lpSum(use[f, m] for f in range(n_foods)) <= max_items_per_meal
+    for f in range(n_foods):
+        prob += lpSum(use[f, m] for m in range(num_meals)) <= max_meals_per_food
+
+    def nutrient_expr(col, meals):
+        return LpAffineExpression([(grams[f, m], per_gram[f, col]) for m in meals for f in range(n_foods) if per_gram[f, col]])
+
+    all_meals = range(num_meals)
+    objective = []
+    macro_targets = [('cal', 0), ('prot', 1), ('carbs', 2), ('fat', 3)]
+    for key, col in macro_targets:
+        target = float(targets[key])
+        total = nutrient_expr(col, all_meals)
+        prob += total >= target * (1 - tolerance), f"min_{key}"
+        prob += total <= target * (1 + tolerance), f"max_{key}"
+        # Desvio absoluto (normalizado pela meta) via variáveis auxiliares
+        dev = LpVariable(f"dev_{key}", lowBound=0)
+        prob += total - target <= dev
+        prob += target - total <= dev
+        objective.append(dev * (1.0 / max(target, 1.0)))
+
+    prob += nutrient_expr(5, all_meals) <= float(targets['sodium']), "max_sodium"
+
+    for m, share in enumerate(meal_splits):
+        meal_cal = nutrient_expr(0, [m])
+        meal_target = float(targets['cal']) * share
+        prob += meal_cal >= meal_target * (1 - meal_tolerance), f"min_cal_meal_{m}"
+        prob += meal_cal <= meal_target * (1 + meal_tolerance), f"max_cal_meal_{m}"
+
+    prob += lpSum(objective)
+    t_built = time.perf_counter()
+
+    solver = PULP_CBC_CMD(msg=False, timeLimit=time_limit, gapRel=gap, gapAbs=gap)
+    prob.solve(solver)
+    t_solved = time.perf_counter()
+
+    status = LpStatus[prob.status]
+    # Com limite de tempo o CBC pode parar com uma solução viável (não provada ótima): ela é aproveitada
+    has_solution = prob.sol_status in (LpSolutionOptimal, LpSolutionIntegerFeasible)
+    rows = []
+    if has_solution:
+        for m in all_meals:
+            for f in range(n_foods):
+                g = grams[f, m].varValue or 0
+                if g >= 1:
+                    rows.append({'Refeição': meal_names[m], 'Alimento': candidates.at[f, 'name'], 'Gramas': int(round(g))})
+    df_plan = pd.DataFrame(rows, columns=['Refeição', 'Alimento', 'Gramas'])
 
     return {
-        'cal': int(df_merged['Cal_Total'].sum()),
-        'prot': df_merged['Prot_Total'].sum(),
-        'carbs': df_merged['Carbs_Total'].sum(),
-        'fat': df_merged['Fat_Total'].sum(),
-        'fiber': df_merged['Fiber_Total'].sum(),
-        'sodium': df_merged['Sodium_Total'].sum()
+        'status': status,
+        'solution': LpSolution.get(prob.sol_status, status),
+        'feasible': has_solution,
+        'plan': df_plan,
+        'totals': calculate_macros_from_plan(df_plan, nutrients),
+        'stats': {
+            'candidates': n_foods,
+            'variables': len(prob.variables()),
+            'constraints': len(prob.constraints),
+            'build_time': t_built - t_start,
+            'solve_time': t_solved - t_built,
+            'total_time': t_solved - t_start,
+            'objective': value(prob.objective) if has_solution else None,
+        },
+    }
+
+def assign_week_pools(candidates, days, max_repeats, seed=0):
+    """Distribui os alimentos entre os dias: cada alimento fica disponível em no máximo max_repeats dias.
+
+    A limitação de repetições é garantida pela distribuição, o que torna os dias subproblemas
+    independentes (resolvidos em paralelo).
+    """
+    order = np.random.default_rng(seed).permutation(len(candidates))
+    repeats = min(max_repeats, days)
+    pools = [[] for _ in range(days)]
+    for k, row in enumerate(order):
+        for r in range(repeats):
+            pools[(k * repeats + r) % days].append(row)
+    return [candidates.iloc[sorted(pool)].reset_index(drop=True) for pool in pools]
+
+def optimize_week(targets, df_foods, num_meals, day_names=None, max_repeats=WEEK_MAX_REPEATS,
+                  max_workers=None, seed=0, **optimizer_kwargs):
+    """Gera um plano de vários dias distintos (uma semana por padrão) com optimize_diet.
+
+    Cada dia recebe um subconjunto do catálogo (assign_week_pools) e é resolvido em paralelo.
+    O CBC roda como processo externo, então um pool de threads já ocupa vários núcleos sem
+    precisar serializar o catálogo para outros processos Python.
+
+    Retorna {'days': [resultado por dia], 'plan': DataFrame com a coluna 'Dia', 'wall_time', 'solve_time_sum'}.
+    """
+    day_names = day_names or WEEK_DAYS
+    days = len(day_names)
+    max_candidates = optimizer_kwargs.pop('max_candidates', OPTIMIZER_MAX_CANDIDATES)
+
+    # Pool da semana grande o suficiente para que cada dia tenha ~max_candidates alimentos
+    week_candidates = select_optimizer_candidates(df_foods, max_candidates * days // max(1, min(max_repeats, days)))
+    pools = assign_week_pools(week_candidates, days, max_repeats, seed)
+
+    def solve_day(day_index):
+        t0 = time.perf_counter()
+        result = optimize_diet(targets, pools[day_index], num_meals, max_candidates=len(pools[day_index]), **optimizer_kwargs)
+        result['day'] = day_names[day_index]
+        result['wall_time'] = time.perf_counter() - t0
+        return result
+
+    t_start = time.perf_counter()
+    workers = max_workers or min(days, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(solve_day, range(days)))
+    wall_time = time.perf_counter() - t_start
+
+    day_plans = [r['plan'].assign(Dia=r['day']) for r in results if r['feasible']]
+    week_plan = pd.concat(day_plans, ignore_index=True) if day_plans else pd.DataFrame(columns=['Refeição', 'Alimento', 'Gramas', 'Dia'])
+    return {
+        'days': results,
+        'plan': week_plan[['Dia', 'Refeição', 'Alimento', 'Gramas']],
+        'wall_time': wall_time,
+        'solve_time_sum': sum(r['stats']['total_time'] for r in results),
+        'workers': workers,
     }
 
 # --- Funções de Métricas Corporais ---
@@ -327,131 +1593,508 @@ def calculate_bmi(weight, height):
     if height_m <= 0: return 0.0
     return weight / (height_m ** 2)
 
+_PHOTO_HASHES = shared_resource('photo_hashes', dict)  # caminho -> ((mtime, tamanho), hash do conteúdo)
+
+def photo_file_hash(file_path):
+    """Hash do conteúdo da foto, memorizado por (mtime, tamanho) para não reler o original a cada exibição."""
+    stat = os.stat(file_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _PHOTO_HASHES.get(file_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    _PHOTO_HASHES[file_path] = (key, h.hexdigest())
+    return _PHOTO_HASHES[file_path][1]
+
+def _thumbnail_path(digest, size):
+    return os.path.join(PHOTOS_DIR, 'thumbs', f"{digest}_{size}.jpg")
+
+def make_thumbnails(file_path):
+    """Gera (se ainda não existirem) as miniaturas de todos os THUMBNAIL_SIZES. Retorna {tamanho: caminho}."""
+    digest = photo_file_hash(file_path)
+    paths = {size: _thumbnail_path(digest, size) for size in THUMBNAIL_SIZES}
+    missing = {size: path for size, path in paths.items() if not os.path.exists(path)}
+    if missing:
+        os.makedirs(os.path.dirname(next(iter(missing.values()))), exist_ok=True)
+        with Image.open(file_path) as original:
+            # Respeita a orientação do EXIF (fotos de celular) e converte para RGB para salvar em JPEG
+            image = ImageOps.exif_transpose(original).convert('RGB')
+        # Do maior para o menor: cada miniatura é reduzida a partir da anterior, não do original
+        for size in sorted(missing, key=THUMBNAIL_SIZES.get, reverse=True):
+            image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]))
+            tmp_path = f"{missing[size]}.tmp"
+            image.save(tmp_path, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+            os.replace(tmp_path, missing[size])
+    return paths
+
+def get_thumbnail(photo_path, size='sm'):
+    """Caminho da miniatura de uma foto salva (photo_path relativo a PHOTOS_DIR); None se o original não existir."""
+    file_path = os.path.join(PHOTOS_DIR, photo_path)
+    if not os.path.exists(file_path):
+        return None
+    try:
+        return make_thumbnails(file_path)[size]
+    except OSError:
+        # Arquivo que o Pillow não consegue abrir: a galeria mostra o aviso de foto indisponível
+        return None
+
+def photo_content_path(digest):
+    """Caminho (relativo a PHOTOS_DIR) de uma foto endereçada pelo hash do conteúdo enviado."""
+    return os.path.join(digest[:2], f"{digest}.jpg")
+
+def _encode_photo(image):
+    # Reduz a qualidade até caber em PHOTO_MAX_BYTES; se nem a menor couber, fica com ela
+    for quality in PHOTO_JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+        if buffer.tell() <= PHOTO_MAX_BYTES:
+            break
+    return buffer.getvalue()
+
+def _write_photo_file(file_path, data):
+    # Grava num temporário e renomeia: quem lê o caminho nunca vê um arquivo pela metade
+    tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+def ingest_photo(relative_path):
+    """Normaliza uma foto já gravada com os bytes enviados: orientação aplicada, EXIF descartado, lado maior
+    limitado a PHOTO_MAX_SIDE e JPEG dentro de PHOTO_MAX_BYTES. Também gera as miniaturas. Retorna o caminho relativo."""
+    file_path = os.path.join(PHOTOS_DIR, relative_path)
+    with Image.open(file_path) as original:
+        # Salvar sem passar exif= descarta os metadados (GPS, aparelho...) depois de aplicar a rotação
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+    _write_photo_file(file_path, _encode_photo(image))
+    make_thumbnails(file_path)
+    return relative_path
+
+_PHOTO_INGEST_POOL = shared_resource('photo_ingest_pool', lambda: ThreadPoolExecutor(max_workers=PHOTO_INGEST_WORKERS, thread_name_prefix='photo-ingest'))
+_PHOTO_INGEST_PENDING = shared_resource('photo_ingest_pending', dict)  # caminho relativo -> Future
+_PHOTO_INGEST_LOCK = shared_resource('photo_ingest_lock', threading.Lock)
+
+def photo_ingest_pending(photo_path):
+    """True enquanto a foto ainda está sendo processada em segundo plano."""
+    with _PHOTO_INGEST_LOCK:
+        future = _PHOTO_INGEST_PENDING.get(photo_path)
+        if future is not None and future.done():
+            del _PHOTO_INGEST_PENDING[photo_path]
+            return False
+        return future is not None
+
+def _report_photo_ingest(future, relative_path):
+    # Chamado pelo pool ao terminar: sem isso a exceção ficaria guardada num Future que ninguém lê.
+    # Em caso de erro o original enviado continua no lugar, então a foto segue disponível.
+    error = future.exception()
+    if error is not None:
+        logger.error("Falha ao processar a foto %s", relative_path, exc_info=error)
+
 def save_uploaded_photo(uploaded_file, user_id):
+    """Grava a foto enviada no caminho endereçado pelo conteúdo e retorna esse caminho (ou None).
+
+    Os bytes originais vão para o disco antes de a métrica ser salva; só a recompressão e as
+    miniaturas ficam em segundo plano. Reenvios do mesmo arquivo caem no mesmo caminho e não
+    são processados de novo.
+    """
     if uploaded_file:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_extension = os.path.splitext(uploaded_file.name)[1]
-        unique_filename = f"{user_id}_{timestamp}{file_extension}"
-        file_path = os.path.join(PHOTOS_DIR, unique_filename)
-        with open(file_path, "wb") as f: f.write(uploaded_file.getbuffer())
-        return unique_filename 
+        data = uploaded_file.getvalue()
+        try:
+            # Só lê o cabeçalho: rejeita arquivos que não são imagem antes de gravar a métrica
+            Image.open(io.BytesIO(data)).close()
+        except OSError:
+            return None
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        relative_path = photo_content_path(digest)
+        file_path = os.path.join(PHOTOS_DIR, relative_path)
+        with _PHOTO_INGEST_LOCK:
+            if relative_path in _PHOTO_INGEST_PENDING or os.path.exists(file_path):
+                return relative_path
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                _write_photo_file(file_path, data)
+            except OSError as e:
+                logger.error("Falha ao gravar a foto %s: %s", relative_path, e)
+                return None
+            future = _PHOTO_INGEST_PENDING[relative_path] = _PHOTO_INGEST_POOL.submit(ingest_photo, relative_path)
+        future.add_done_callback(lambda done: _report_photo_ingest(done, relative_path))
+        return relative_path
     return None
 
-def save_body_metric(user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path): 
-    conn = get_conn(); cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO body_metrics (user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-                    (user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError: return False
-    finally: conn.close()
+BODY_METRICS_COLUMNS = ('date, weight, body_fat_perc, waist_circ, bmi, photo_path, '
+                        'fat_mass AS "Massa Gorda (kg)", lean_mass AS "Massa Magra (kg)"')
 
-def get_body_metrics(user_id):
-    conn = get_conn(); 
-    metrics = pd.read_sql("SELECT date, weight, body_fat_perc, waist_circ, bmi, photo_path FROM body_metrics WHERE user_id = ? ORDER BY date DESC", conn, params=(user_id,))
-    conn.close()
-    if metrics.empty: return metrics
-    metrics['date'] = pd.to_datetime(metrics['date'])
-    metrics['Massa Gorda (kg)'] = metrics['weight'] * (metrics['body_fat_perc'] / 100)
-    metrics['Massa Magra (kg)'] = metrics['weight'] - metrics['Massa Gorda (kg)']
+METRICS_CACHE = shared_resource('metrics_cache', lambda: TTLCache(max_entries=METRICS_CACHE_MAX_USERS))
+
+def _normalize_metrics(metrics):
+    # Tipos fixos (independentes do que o read_sql infere), para que linhas acrescentadas pelo
+    # save_body_metric e o histórico lido do banco sejam sempre compatíveis
+    metrics['date'] = pd.to_datetime(metrics['date'], format='ISO8601').astype('datetime64[ns]')
+    for col in ('weight', 'body_fat_perc', 'waist_circ', 'bmi', 'Massa Gorda (kg)', 'Massa Magra (kg)'):
+        metrics[col] = metrics[col].astype(float)
+    metrics['photo_path'] = metrics['photo_path'].astype(object).where(metrics['photo_path'].notna(), None)
     return metrics
 
+def save_body_metric(user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path):
+    fat_mass = weight * (body_fat_perc / 100)
+    lean_mass = weight - fat_mass
+    with db_conn() as conn:
+        try:
+            conn.execute("INSERT INTO body_metrics (user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path, fat_mass, lean_mass) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (user_id, date, weight, body_fat_perc, waist_circ, bmi, photo_path, fat_mass, lean_mass))
+            # Agregados atualizados na mesma transação da linha
+            for table, period_sql in BODY_METRICS_ROLLUPS.values():
+                conn.execute(f"""
+                    INSERT INTO {table} VALUES (?, {period_sql.format('?')}, 1, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, period) DO UPDATE SET
+                        n = n + 1, weight_sum = weight_sum + excluded.weight_sum,
+                        body_fat_sum = body_fat_sum + excluded.body_fat_sum, bmi_sum = bmi_sum + excluded.bmi_sum,
+                        fat_mass_sum = fat_mass_sum + excluded.fat_mass_sum, lean_mass_sum = lean_mass_sum + excluded.lean_mass_sum,
+                        waist_sum = waist_sum + excluded.waist_sum, waist_n = waist_n + excluded.waist_n
+                """, (user_id, date, weight, body_fat_perc, bmi, fat_mass, lean_mass,
+                      waist_circ or 0.0, 0 if waist_circ is None else 1))
+            conn.commit()
+        except sqlite3.IntegrityError: return False
+
+    # Acrescenta a linha ao histórico em cache em vez de descartá-lo (a próxima leitura não volta ao banco)
+    new_row = _normalize_metrics(pd.DataFrame([{
+        'date': date, 'weight': weight, 'body_fat_perc': body_fat_perc, 'waist_circ': waist_circ, 'bmi': bmi,
+        'photo_path': photo_path, 'Massa Gorda (kg)': fat_mass, 'Massa Magra (kg)': lean_mass,
+    }]))
+    def append(metrics):
+        merged = pd.concat([new_row, metrics], ignore_index=True) if not metrics.empty else new_row
+        return merged.sort_values(by='date', ascending=False, kind='stable', ignore_index=True)
+    METRICS_CACHE.update(user_id, append)
+    return True
+
+def _load_body_metrics(user_id):
+    with db_conn() as conn:
+        metrics = pd.read_sql(f"SELECT {BODY_METRICS_COLUMNS} FROM body_metrics WHERE user_id = ? ORDER BY date DESC, id DESC", conn, params=(user_id,))
+    return _normalize_metrics(metrics)
+
+def get_body_metrics(user_id):
+    """Histórico completo do usuário (mais recente primeiro), servido do cache por usuário."""
+    # Cópia rasa: quem chama pode acrescentar colunas sem alterar o cache
+    return METRICS_CACHE.get(user_id, _load_body_metrics).copy(deep=False)
+
+def get_body_metric_rollup(user_id, granularity, start=None):
+    """Médias por semana ('weekly') ou mês ('monthly'), com as mesmas colunas de get_body_metrics.
+
+    A data de cada linha é o início do período; start ('YYYY-MM-DD') filtra períodos a partir dele.
+    """
+    table, period_sql = BODY_METRICS_ROLLUPS[granularity]
+    with db_conn() as conn:
+        rollup = pd.read_sql(f"""
+            SELECT period AS date, weight_sum / n AS weight, body_fat_sum / n AS body_fat_perc,
+                   CASE WHEN waist_n > 0 THEN waist_sum / waist_n END AS waist_circ, bmi_sum / n AS bmi,
+                   NULL AS photo_path, fat_mass_sum / n AS "Massa Gorda (kg)", lean_mass_sum / n AS "Massa Magra (kg)"
+            FROM {table}
+            WHERE user_id = ? AND period >= {period_sql.format('?')}
+            ORDER BY period DESC
+        """, conn, params=(user_id, start or '0000-01-01'))
+    return _normalize_metrics(rollup)
+
+def lttb_indices(x, y, n_out):
+    """Índices de até n_out pontos escolhidos pelo Largest-Triangle-Three-Buckets.
+
+    Mantém o primeiro e o último ponto e, em cada balde intermediário, o ponto que forma o maior
+    triângulo com o ponto escolhido antes e a média do balde seguinte, preservando picos e vales.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)  # n_out - 2 baldes entre o primeiro e o último ponto
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+def downsample_metrics(df_chrono, columns, max_points=None):
+    """Reduz um histórico em ordem cronológica a no máximo max_points linhas para os gráficos.
+
+    O orçamento é dividido entre as séries (LTTB em cada uma) e as linhas escolhidas são unidas.
+    """
+    max_points = max_points or CHART_MAX_POINTS
+    if len(df_chrono) <= max_points:
+        return df_chrono
+    per_series = max(max_points // len(columns), 3)
+    x = df_chrono['date'].to_numpy(dtype='datetime64[ns]').astype('int64')
+    keep = np.unique(np.concatenate([lttb_indices(x, df_chrono[col].to_numpy(dtype=float), per_series) for col in columns]))
+    return df_chrono.iloc[keep]
+
+def get_latest_body_metric(user_id):
+    """Só a avaliação mais recente (dict ou None), sem carregar o histórico se ele não estiver em cache."""
+    metrics = METRICS_CACHE.peek(user_id)
+    if metrics is not None:
+        return None if metrics.empty else metrics.iloc[0].to_dict()
+    with db_conn() as conn:
+        row = conn.execute(f"SELECT {BODY_METRICS_COLUMNS} FROM body_metrics WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT 1", (user_id,)).fetchone()
+    if row is None:
+        return None
+    latest = dict(row)
+    latest['date'] = pd.Timestamp(latest['date'])
+    return latest
+
 # --- Geração de PDF ---
-class PDF(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 15)
-        self.cell_utf8(0, 10, 'EveFii - Relatório de Nutrição', 0, 1, 'C')
-        self.ln(5)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell_utf8(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
+_PDF_FONTS = shared_resource('pdf_fonts', dict)  # estilo -> métricas da fonte TTF, lidas uma vez por processo
+_PDF_FONTS_LOCK = shared_resource('pdf_fonts_lock', threading.Lock)
+
+def _find_pdf_font(filename):
+    # Primeiro a pasta do app; depois a cópia da DejaVu que acompanha o matplotlib
+    for folder in (PDF_FONT_DIR, os.path.join(matplotlib.get_data_path(), 'fonts', 'ttf')):
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+def get_pdf_fonts():
+    """Métricas das fontes Unicode dos relatórios ({estilo: dict}); vazio se algum TTF não for encontrado."""
+    with _PDF_FONTS_LOCK:
+        if 'styles' not in _PDF_FONTS:
+            styles = {}
+            for style, filename in PDF_FONT_FILES.items():
+                path = _find_pdf_font(filename)
+                if path is None:
+                    styles = {}
+                    break
+                from fpdf.ttfonts import TTFontFile
+                ttf = TTFontFile()
+                ttf.getMetrics(path)
+                styles[style] = {
+                    'type': 'TTF', 'name': re.sub('[ ()]', '', ttf.fullName), 'ttffile': path,
+                    'desc': {
+                        'Ascent': int(round(ttf.ascent)), 'Descent': int(round(ttf.descent)),
+                        'CapHeight': int(round(ttf.capHeight)), 'Flags': ttf.flags,
+                        'FontBBox': "[%s %s %s %s]" % tuple(int(round(b)) for b in ttf.bbox),
+                        'ItalicAngle': int(ttf.italicAngle), 'StemV': int(round(ttf.stemV)),
+                        'MissingWidth': int(round(ttf.defaultWidth)),
+                    },
+                    'up': round(ttf.underlinePosition), 'ut': round(ttf.underlineThickness),
+                    'cw': ttf.charWidths, 'originalsize': os.stat(path).st_size,
+                }
+            _PDF_FONTS['styles'] = styles
+        return _PDF_FONTS['styles']
+
+@lru_cache(maxsize=None)
+def _pdf_class():
+    """Classe dos relatórios (subclasse de FPDF), criada no primeiro uso: o fpdf só é importado ao gerar um PDF."""
+    import fpdf
+    from fpdf import FPDF
+
+    if fpdf.__version__ != FPDF_VERSION:
+        raise RuntimeError(f"Os relatórios em PDF exigem fpdf=={FPDF_VERSION} (instalado: {fpdf.__version__})")
+
+    class PDF(FPDF):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.unicode = self._register_fonts()
+
+        def _register_fonts(self):
+            # Mesmo registro que add_font(..., uni=True) faz, mas com as métricas já em memória:
+            # add_font releria o TTF (ou um .pkl gravado ao lado dele) a cada documento.
+            # Escreve em self.fonts/self.font_files, estado interno do fpdf 1.7.2 (ver FPDF_VERSION).
+            fonts = get_pdf_fonts()
+            for style, font in fonts.items():
+                fontkey = PDF_FONT_FAMILY + style
+                self.fonts[fontkey] = {
+                    **{k: font[k] for k in ('type', 'name', 'desc', 'up', 'ut', 'cw', 'ttffile')},
+                    'i': len(self.fonts) + 1, 'fontkey': fontkey, 'subset': list(range(32)), 'unifilename': None,
+                }
+                self.font_files[fontkey] = {'length1': font['originalsize'], 'type': 'TTF', 'ttffile': font['ttffile']}
+            return bool(fonts)
+
+        def use_font(self, style='', size=10):
+            # Sem o TTF, cai para a Arial padrão (latin-1), como antes
+            self.set_font(PDF_FONT_FAMILY if self.unicode else 'Arial', style, size)
+
+        def header(self):
+            self.use_font('B', 15)
+            self.cell_utf8(0, 10, 'EveFii - Relatório de Nutrição', 0, 1, 'C')
+            self.ln(5)
+
+        def footer(self):
+            self.set_y(-15)
+            self.use_font('I', 8)
+            self.cell_utf8(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
         
-    def cell_utf8(self, w, h, txt, border=0, ln=0, align=''):
-        self.cell(w, h, txt.encode('latin-1', 'replace').decode('latin-1'), border, ln, align)
+        def cell_utf8(self, w, h, txt, border=0, ln=0, align='', fill=0):
+            if not self.unicode:
+                txt = txt.encode('latin-1', 'replace').decode('latin-1')
+            self.cell(w, h, txt, border, ln, align, fill)
+
+        def _table_header(self, columns, height):
+            self.set_fill_color(220, 220, 220)
+            self.use_font('B', self._table_font_size)
+            for i, (title, width, _, _) in enumerate(columns):
+                self.cell_utf8(width, height, title, 1, 1 if i == len(columns) - 1 else 0, 'C', 1)
+            self.use_font('', self._table_font_size)
+
+        def table(self, df, columns, row_height=6, header_height=7, font_size=10, chunk_rows=PDF_TABLE_CHUNK_ROWS):
+            """Tabela com cabeçalho repetido a cada quebra de página.
+
+            columns é uma lista de (título, largura, alinhamento, formatador); o formatador recebe a coluna
+            inteira (Series) e devolve os textos já formatados. O DataFrame é formatado em blocos de
+            chunk_rows linhas, então a memória não cresce com o tamanho do histórico.
+            """
+            self._table_font_size = font_size
+            self._table_header(columns, header_height)
+            for start in range(0, len(df), chunk_rows):
+                chunk = df.iloc[start:start + chunk_rows]
+                texts = [list(fmt(chunk)) for _, _, _, fmt in columns]
+                for row in zip(*texts):
+                    if self.get_y() + row_height > self.page_break_trigger:
+                        self.add_page()
+                        self._table_header(columns, header_height)
+                    for i, (txt, (_, width, align, _)) in enumerate(zip(row, columns)):
+                        self.cell_utf8(width, row_height, txt, 1, 1 if i == len(columns) - 1 else 0, align)
+
+        def image_bytes(self, data, image_type='jpg', w=0, h=0):
+            # O FPDF 1.7 só lê imagens de arquivo; a imagem é lida por inteiro na chamada, então o temporário pode sair logo
+            with tempfile.NamedTemporaryFile(suffix=f'.{image_type}', delete=False) as tmp:
+                tmp.write(data)
+            try:
+                self.image(tmp.name, x=self.l_margin, w=w, h=h)
+            finally:
+                os.unlink(tmp.name)
+
+    return PDF
+
+def new_pdf(*args, **kwargs):
+    return _pdf_class()(*args, **kwargs)
+
+_PDF_CACHE = shared_resource('pdf_cache', OrderedDict)  # digest -> bytes do PDF (LRU)
+_PDF_CACHE_LOCK = shared_resource('pdf_cache_lock', threading.Lock)
+
+def report_digest(kind, username, *parts):
+    """Hash do conteúdo de um relatório: DataFrames entram pelo hash de linhas do pandas, o resto por repr."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{kind}|{username}".encode())
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            h.update(repr(list(part.columns)).encode())
+            h.update(pd.util.hash_pandas_object(part, index=False).to_numpy().tobytes())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+def get_cached_pdf(digest):
+    with _PDF_CACHE_LOCK:
+        pdf_bytes = _PDF_CACHE.get(digest)
+        if pdf_bytes is not None:
+            _PDF_CACHE.move_to_end(digest)
+        return pdf_bytes
+
+def render_cached_pdf(digest, render):
+    """Retorna o PDF do cache ou o gera com render() e o guarda (descartando os menos usados)."""
+    pdf_bytes = get_cached_pdf(digest)
+    if pdf_bytes is None:
+        pdf_bytes = render()
+        with _PDF_CACHE_LOCK:
+            _PDF_CACHE[digest] = pdf_bytes
+            while len(_PDF_CACHE) > PDF_CACHE_MAX_ENTRIES:
+                _PDF_CACHE.popitem(last=False)
+    return pdf_bytes
+
+def metrics_pdf_digest(username, df_metrics):
+    return report_digest('metrics', username, df_metrics)
+
+def diet_pdf_digest(username, targets, df_plan, final_totals):
+    return report_digest('diet', username, df_plan, sorted(targets.items()), sorted(final_totals.items()))
 
 def generate_diet_pdf(username, targets, df_plan, final_totals):
-    pdf = PDF('P', 'mm', 'A4')
+    pdf = new_pdf('P', 'mm', 'A4')
     pdf.add_page()
     
-    pdf.set_font('Arial', 'B', 16)
+    pdf.use_font('B', 16)
     pdf.cell_utf8(0, 10, f'Plano de Dieta para {username}', 0, 1)
     pdf.ln(2)
 
-    pdf.set_fill_color(220, 220, 220)
-    pdf.set_font('Arial', 'B', 9)
-    pdf.cell_utf8(25, 7, 'Calorias', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Proteína', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Carboidratos', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Gordura', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Fibra', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Sódio', 1, 1, 'C', 1) 
-
-    pdf.set_font('Arial', '', 9)
-    pdf.cell_utf8(25, 7, f'{final_totals["cal"]} kcal', 1, 0, 'C')
-    pdf.cell_utf8(25, 7, f'{final_totals["prot"]:.1f} g', 1, 0, 'C')
-    pdf.cell_utf8(25, 7, f'{final_totals["carbs"]:.1f} g', 1, 0, 'C')
-    pdf.cell_utf8(25, 7, f'{final_totals["fat"]:.1f} g', 1, 0, 'C')
-    pdf.cell_utf8(25, 7, f'{final_totals["fiber"]:.1f} g', 1, 0, 'C')
-    pdf.cell_utf8(25, 7, f'{final_totals["sodium"]:.0f} mg', 1, 1, 'C') 
+    totals = pd.DataFrame([final_totals])
+    pdf.table(totals, [
+        ('Calorias', 25, 'C', lambda d: d['cal'].map('{} kcal'.format)),
+        ('Proteína', 25, 'C', lambda d: d['prot'].map('{:.1f} g'.format)),
+        ('Carboidratos', 25, 'C', lambda d: d['carbs'].map('{:.1f} g'.format)),
+        ('Gordura', 25, 'C', lambda d: d['fat'].map('{:.1f} g'.format)),
+        ('Fibra', 25, 'C', lambda d: d['fiber'].map('{:.1f} g'.format)),
+        ('Sódio', 25, 'C', lambda d: d['sodium'].map('{:.0f} mg'.format)),
+    ], row_height=7, font_size=9)
     
     pdf.ln(5)
     
-    pdf.set_font('Arial', 'B', 12)
+    pdf.use_font('B', 12)
     pdf.cell_utf8(0, 10, 'Detalhes da Dieta:', 0, 1)
     
-    pdf.set_fill_color(220, 220, 220)
-    pdf.set_font('Arial', 'B', 10)
-    pdf.cell_utf8(50, 7, 'Refeição', 1, 0, 'C', 1)
-    pdf.cell_utf8(90, 7, 'Alimento', 1, 0, 'C', 1)
-    pdf.cell_utf8(30, 7, 'Quantidade', 1, 1, 'C', 1)
-    
-    pdf.set_font('Arial', '', 10)
-    for index, row in df_plan.iterrows():
-        pdf.cell_utf8(50, 6, str(row['Refeição']), 1, 0, 'L')
-        pdf.cell_utf8(90, 6, str(row['Alimento']), 1, 0, 'L')
-        pdf.cell_utf8(30, 6, f"{row['Gramas']} g", 1, 1, 'R')
+    pdf.table(df_plan, [
+        ('Refeição', 50, 'L', lambda d: d['Refeição'].astype(str)),
+        ('Alimento', 90, 'L', lambda d: d['Alimento'].astype(str)),
+        ('Quantidade', 30, 'R', lambda d: d['Gramas'].astype(str) + ' g'),
+    ])
         
     return pdf.output(dest='S').encode('latin-1')
 
+def render_metrics_chart(df_metrics, width_in=7.5, height_in=3.2, dpi=110):
+    """Gráfico de peso e massa gorda ao longo do tempo, em JPEG, para embutir no relatório.
+
+    JPEG e não PNG: o FPDF 1.7 separa o canal alfa do PNG do matplotlib linha a linha em Python puro.
+    """
+    df_chrono = downsample_metrics(df_metrics.sort_values(by='date'), ['weight', 'Massa Gorda (kg)'])
+    fig, ax = plt.subplots(figsize=(width_in, height_in), dpi=dpi)
+    try:
+        ax.plot(df_chrono['date'], df_chrono['weight'], color='#2196F3', label='Peso (kg)')
+        ax.plot(df_chrono['date'], df_chrono['Massa Gorda (kg)'], color='#FFC107', label='Massa Gorda (kg)')
+        ax.set_ylabel('kg')
+        ax.grid(alpha=0.3)
+        ax.legend(loc='upper right', fontsize=8)
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='jpg', pil_kwargs={'quality': 90})
+    finally:
+        plt.close(fig)
+    return buffer.getvalue()
+
 def generate_metrics_pdf(username, df_metrics):
-    pdf = PDF('P', 'mm', 'A4')
+    pdf = new_pdf('P', 'mm', 'A4')
     pdf.add_page()
     
-    pdf.set_font('Arial', 'B', 16)
+    pdf.use_font('B', 16)
     pdf.cell_utf8(0, 10, f'Relatório de Evolução Corporal de {username}', 0, 1)
     pdf.ln(5)
 
-    pdf.set_fill_color(220, 220, 220)
-    pdf.set_font('Arial', 'B', 10)
-    pdf.cell_utf8(20, 7, 'Data', 1, 0, 'C', 1)
-    pdf.cell_utf8(25, 7, 'Peso (kg)', 1, 0, 'C', 1)
-    pdf.cell_utf8(20, 7, '% Gord.', 1, 0, 'C', 1)
-    pdf.cell_utf8(30, 7, 'Massa Gorda', 1, 0, 'C', 1)
-    pdf.cell_utf8(30, 7, 'Massa Magra', 1, 0, 'C', 1)
-    pdf.cell_utf8(20, 7, 'Cintura', 1, 0, 'C', 1)
-    pdf.cell_utf8(15, 7, 'IMC', 1, 1, 'C', 1)
-
-    pdf.set_font('Arial', '', 8)
     df_metrics_chrono = df_metrics.sort_values(by='date')
-    
-    for index, row in df_metrics_chrono.iterrows():
-        pdf.cell_utf8(20, 6, row['date'].strftime('%d/%m/%Y'), 1, 0, 'C')
-        pdf.cell_utf8(25, 6, f"{row['weight']:.1f}", 1, 0, 'R')
-        pdf.cell_utf8(20, 6, f"{row['body_fat_perc']:.1f}", 1, 0, 'R')
-        pdf.cell_utf8(30, 6, f"{row['Massa Gorda (kg)']:.1f} kg", 1, 0, 'R')
-        pdf.cell_utf8(30, 6, f"{row['Massa Magra (kg)']:.1f} kg", 1, 0, 'R')
-        pdf.cell_utf8(20, 6, f"{row['waist_circ']:.1f} cm", 1, 0, 'R')
-        pdf.cell_utf8(15, 6, f"{row['bmi']:.1f}", 1, 1, 'R')
+
+    if len(df_metrics_chrono) > 1:
+        pdf.image_bytes(render_metrics_chart(df_metrics_chrono), w=pdf.w - pdf.l_margin - pdf.r_margin)
+        pdf.ln(3)
+
+    pdf.table(df_metrics_chrono, [
+        ('Data', 20, 'C', lambda d: d['date'].dt.strftime('%d/%m/%Y')),
+        ('Peso (kg)', 25, 'R', lambda d: d['weight'].map('{:.1f}'.format)),
+        ('% Gord.', 20, 'R', lambda d: d['body_fat_perc'].map('{:.1f}'.format)),
+        ('Massa Gorda', 30, 'R', lambda d: d['Massa Gorda (kg)'].map('{:.1f} kg'.format)),
+        ('Massa Magra', 30, 'R', lambda d: d['Massa Magra (kg)'].map('{:.1f} kg'.format)),
+        ('Cintura', 20, 'R', lambda d: d['waist_circ'].map('{:.1f} cm'.format)),
+        ('IMC', 15, 'R', lambda d: d['bmi'].map('{:.1f}'.format)),
+    ], font_size=8)
         
     if len(df_metrics_chrono) > 1:
         first = df_metrics_chrono.iloc[0]
         last = df_metrics_chrono.iloc[-1]
         
         pdf.ln(5)
-        pdf.set_font('Arial', 'B', 12)
+        pdf.use_font('B', 12)
         pdf.cell_utf8(0, 10, 'Resumo da Evolução (Total):', 0, 1)
         
         def format_diff_pdf(start, end, metric_name, unit):
@@ -466,30 +2109,74 @@ def generate_metrics_pdf(username, df_metrics):
             pdf.cell_utf8(0, 7, f"De {start:.1f} para {end:.1f} {unit} ({diff_str})", 0, 1)
             pdf.set_text_color(0, 0, 0) 
         
-        pdf.set_font('Arial', 'B', 10)
+        pdf.use_font('B', 10)
         pdf.cell_utf8(50, 7, 'Peso Corporal:', 0, 0)
-        pdf.set_font('Arial', '', 10)
+        pdf.use_font('', 10)
         format_diff_pdf(first['weight'], last['weight'], 'Peso', 'kg')
         
-        pdf.set_font('Arial', 'B', 10)
+        pdf.use_font('B', 10)
         pdf.cell_utf8(50, 7, '% Gordura:', 0, 0)
-        pdf.set_font('Arial', '', 10)
+        pdf.use_font('', 10)
         format_diff_pdf(first['body_fat_perc'], last['body_fat_perc'], '% Gordura', '%')
         
-        pdf.set_font('Arial', 'B', 10)
+        pdf.use_font('B', 10)
         pdf.cell_utf8(50, 7, 'Massa Gorda:', 0, 0)
-        pdf.set_font('Arial', '', 10)
+        pdf.use_font('', 10)
         format_diff_pdf(first['Massa Gorda (kg)'], last['Massa Gorda (kg)'], 'Massa Gorda', 'kg')
 
-        pdf.set_font('Arial', 'B', 10)
+        pdf.use_font('B', 10)
         pdf.cell_utf8(50, 7, 'Massa Magra:', 0, 0)
-        pdf.set_font('Arial', '', 10)
+        pdf.use_font('', 10)
         format_diff_pdf(first['Massa Magra (kg)'], last['Massa Magra (kg)'], 'Massa Magra', 'kg')
 
         
     return pdf.output(dest='S').encode('latin-1')
 
 
+# --- Gráficos (matplotlib renderizado para PNG, com cache) ---
+_CHART_CACHE = shared_resource('chart_cache', OrderedDict)  # digest -> bytes do PNG (LRU)
+_CHART_CACHE_LOCK = shared_resource('chart_cache_lock', threading.Lock)
+
+def render_cached_chart(draw, *inputs):
+    """PNG do gráfico desenhado por draw(ax, *inputs), reaproveitado enquanto os dados não mudarem.
+
+    A figura é sempre fechada depois de salva, para não acumular no estado global do pyplot.
+    """
+    digest = report_digest('chart', draw.__name__, *inputs)
+    with _CHART_CACHE_LOCK:
+        png = _CHART_CACHE.get(digest)
+        if png is not None:
+            _CHART_CACHE.move_to_end(digest)
+            return png
+
+    fig, ax = plt.subplots(figsize=(8, 4), dpi=CHART_DPI)
+    try:
+        draw(ax, *inputs)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+    finally:
+        plt.close(fig)
+    png = buffer.getvalue()
+
+    with _CHART_CACHE_LOCK:
+        _CHART_CACHE[digest] = png
+        while len(_CHART_CACHE) > CHART_CACHE_MAX_ENTRIES:
+            _CHART_CACHE.popitem(last=False)
+    return png
+
+def draw_targets_chart(ax, df_plot):
+    df_plot.plot(kind='bar', ax=ax, rot=0)
+    ax.set_title('Comparação: Metas Diárias vs. Plano Otimizado (Macros)')
+    ax.set_ylabel('Valor (kcal/g)')
+    ax.legend(loc='upper right')
+
+def draw_nutrient_pie(ax, data, labels):
+    ax.pie(data, labels=labels, autopct='%1.1f%%', startangle=90, colors=['#4CAF50', '#2196F3', '#FFC107', '#9E9E9E'])
+    ax.axis('equal')
+    ax.set_title('Distribuição Total dos Nutrientes (Por 100g de Alimento)')
+
+
 # --- Funções Específicas da V17 (Hidratação) ---
 
 def calculate_water_goal(weight_kg, age_years):
@@ -508,18 +2195,144 @@ def calculate_water_goal(weight_kg, age_years):
     
     return goal_liters, ml_per_kg
 
+def _new_water_buffer():
+    # pending/in_flight: (user_id, dia, timestamp, litros); in_flight é o lote sendo gravado agora
+    buffer = {'pending': [], 'in_flight': [], 'timer': None, 'failures': 0}
+    atexit.register(lambda: flush_water_intake())
+    return buffer
+
+_WATER_BUFFER = shared_resource('water_buffer', _new_water_buffer)
+_WATER_LOCK = shared_resource('water_lock', threading.Lock)
+_WATER_FLUSH_LOCK = shared_resource('water_flush_lock', threading.Lock)  # um flush por vez
+
+def add_water_intake(user_id, liters, when=None):
+    """Registra um consumo de água sem tocar no banco.
+
+    O registro entra no buffer e é gravado por flush_water_intake após WATER_FLUSH_DELAY s, de modo
+    que cliques seguidos (de qualquer sessão) viram um único commit. As leituras já somam o buffer.
+    """
+    when = when or datetime.now()
+    with _WATER_LOCK:
+        _WATER_BUFFER['pending'].append((user_id, when.strftime('%Y-%m-%d'), when.isoformat(timespec='seconds'), float(liters)))
+        if _WATER_BUFFER['timer'] is None:
+            _arm_water_flush(WATER_FLUSH_DELAY)
+
+def _arm_water_flush(delay):
+    # Chamado com _WATER_LOCK adquirido
+    timer = threading.Timer(delay, flush_water_intake)
+    timer.daemon = True
+    _WATER_BUFFER['timer'] = timer
+    timer.start()
+
+def flush_water_intake():
+    """Grava o buffer numa transação (eventos + totais diários). Retorna o nº de registros gravados.
+
+    O lote sai de `pending` para `in_flight` e é gravado sem _WATER_LOCK, então add_water_intake
+    não espera pelo banco. Se a gravação falhar (ex.: banco bloqueado), os registros voltam para o
+    buffer e uma nova tentativa é agendada com espera crescente (até WATER_FLUSH_MAX_DELAY); nesse
+    caso retorna 0.
+    """
+    with _WATER_FLUSH_LOCK:
+        with _WATER_LOCK:
+            timer = _WATER_BUFFER['timer']
+            if timer is not None:
+                timer.cancel()
+                _WATER_BUFFER['timer'] = None
+            batch = _WATER_BUFFER['pending']
+            if not batch:
+                return 0
+            _WATER_BUFFER['pending'] = []
+            _WATER_BUFFER['in_flight'] = batch
+
+        daily = {}
+        for user_id, day, _, liters in batch:
+            total, entries = daily.get((user_id, day), (0.0, 0))
+            daily[(user_id, day)] = (total + liters, entries + 1)
+        try:
+            with db_conn() as conn:
+                # Os INSERTs pegam o lock de escrita do SQLite (e podem esperar por ele) fora do _WATER_LOCK
+                conn.executemany("INSERT INTO water_intake (user_id, day, ts, liters) VALUES (?, ?, ?, ?)", batch)
+                conn.executemany('''
+                    INSERT INTO water_daily (user_id, day, liters, entries) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, day) DO UPDATE SET
+                        liters = liters + excluded.liters, entries = entries + excluded.entries
+                ''', [(user_id, day, total, entries) for (user_id, day), (total, entries) in daily.items()])
+                # Só o commit (o lock de escrita já é nosso) fica sob o _WATER_LOCK: uma leitura nunca
+                # vê o lote no banco e em in_flight ao mesmo tempo
+                with _WATER_LOCK:
+                    conn.commit()
+                    _WATER_BUFFER['in_flight'] = []
+        except sqlite3.Error as e:
+            with _WATER_LOCK:
+                _WATER_BUFFER['pending'] = batch + _WATER_BUFFER['pending']
+                _WATER_BUFFER['in_flight'] = []
+                failures = _WATER_BUFFER['failures'] = _WATER_BUFFER.get('failures', 0) + 1
+                delay = min(WATER_FLUSH_DELAY * 2 ** failures, WATER_FLUSH_MAX_DELAY)
+                logger.warning("Falha ao gravar %d registro(s) de água (%s); nova tentativa em %.0f s", len(batch), e, delay)
+                if _WATER_BUFFER['timer'] is not None:
+                    _WATER_BUFFER['timer'].cancel()
+                _arm_water_flush(delay)
+            return 0
+        with _WATER_LOCK:
+            _WATER_BUFFER['failures'] = 0
+    return len(batch)
+
+def get_water_daily(user_id, days=WATER_HISTORY_DAYS):
+    """Total (litros) de cada um dos últimos `days` dias, do mais recente (hoje) ao mais antigo.
+
+    Lê só a tabela de totais diários mais o buffer ainda não gravado (inclusive o lote que está sendo
+    gravado); dias sem registro valem 0.
+    """
+    today = datetime.now().date()
+    start = (today - timedelta(days=days - 1)).isoformat()
+    with _WATER_LOCK:
+        with db_conn() as conn:
+            rows = conn.execute("SELECT day, liters FROM water_daily WHERE user_id = ? AND day >= ?", (user_id, start)).fetchall()
+        totals = {row['day']: row['liters'] for row in rows}
+        for pending_user, day, _, liters in _WATER_BUFFER['pending'] + _WATER_BUFFER.get('in_flight', []):
+            if pending_user == user_id and day >= start:
+                totals[day] = totals.get(day, 0.0) + liters
+    return [(day, round(totals.get(day, 0.0), 3)) for day in ((today - timedelta(days=i)).isoformat() for i in range(days))]
+
+def water_streak(daily, goal):
+    """Dias seguidos com a meta atingida até hoje; hoje só entra na conta depois de atingida."""
+    streak = 0
+    for i, (_, liters) in enumerate(daily):
+        if liters >= goal:
+            streak += 1
+        elif i > 0:
+            break
+    return streak
+
 # --- Estrutura das Páginas ---
 
+def pdf_export_button(label, digest, render, file_name, key):
+    """Gera o PDF só quando pedido; depois de gerado (ou se já estiver em cache) oferece o download."""
+    pdf_bytes = get_cached_pdf(digest)
+    if pdf_bytes is None:
+        if not st.button(label, key=f"{key}_render"):
+            return
+        with st.spinner("Gerando PDF..."):
+            pdf_bytes = render_cached_pdf(digest, render)
+    st.download_button(
+        label="⬇️ Baixar PDF",
+        data=pdf_bytes,
+        file_name=file_name,
+        mime="application/pdf",
+        type="primary",
+        key=f"{key}_download"
+    )
+
 def page_hidratacao_agua():
     user_id = st.session_state['user_id']
     st.header("💧 Calculadora de Hidratação (Água)")
     st.info("Calcule sua meta diária de ingestão de água com base em seu peso e idade, e acompanhe o consumo.")
     
     # 1. Recuperar dados do usuário
-    df_metrics = get_body_metrics(user_id)
+    latest_metric = get_latest_body_metric(user_id)
     profile = get_user_profile(user_id)
     
-    initial_weight = df_metrics.iloc[0]['weight'] if not df_metrics.empty else 75.0
+    initial_weight = latest_metric['weight'] if latest_metric else 75.0
     initial_age = int(profile.get('age')) if profile and profile.get('age') else 30
     
     with st.form("water_goal_form"):
@@ -553,12 +2366,8 @@ def page_hidratacao_agua():
         
         st.subheader("Acompanhamento Diário")
         
-        # Inicializa o log se a data for diferente (reset diário)
-        if 'water_log' not in st.session_state or datetime.now().date() != st.session_state.get('water_date'):
-            st.session_state['water_log'] = 0.0
-            st.session_state['water_date'] = datetime.now().date()
-            
-        current_log = st.session_state['water_log']
+        daily = get_water_daily(user_id, WATER_STREAK_MAX_DAYS)
+        current_log = daily[0][1]
         
         col_log, col_add = st.columns([2, 1])
         
@@ -572,7 +2381,7 @@ def page_hidratacao_agua():
         add_amount = col_add.selectbox("Adicionar (Litros)", [0.2, 0.5, 1.0], index=1)
         
         if col_add.button(f"Adicionar {add_amount} L", type="secondary", use_container_width=True):
-            st.session_state['water_log'] += add_amount
+            add_water_intake(user_id, add_amount)
             st.rerun()
             
         st.progress(min(current_log / goal, 1.0), text=f"Progresso: {min(current_log / goal * 100, 100):.0f}%")
@@ -580,6 +2389,16 @@ def page_hidratacao_agua():
         if current_log >= goal:
             st.balloons()
             st.success("🎉 Meta de hidratação atingida! Parabéns!")
+
+        st.markdown("---")
+        st.subheader("Histórico")
+        history = daily[:WATER_HISTORY_DAYS]
+        logged = [liters for _, liters in history if liters > 0]
+        col_streak, col_avg, col_hit = st.columns(3)
+        col_streak.metric("Sequência", f"{water_streak(daily, goal)} dia(s)", help="Dias seguidos com a meta atingida")
+        col_avg.metric("Média (dias com registro)", f"{sum(logged) / len(logged):.2f} L" if logged else "-")
+        col_hit.metric(f"Meta atingida ({WATER_HISTORY_DAYS} dias)", f"{sum(liters >= goal for _, liters in history)} dia(s)")
+        st.bar_chart({'Dia': [day for day, _ in reversed(history)], 'Litros': [liters for _, liters in reversed(history)]}, x='Dia', y='Litros')
     else:
         st.warning("Pressione 'Calcular Meta de Água' para iniciar o acompanhamento.")
 
@@ -597,9 +2416,9 @@ def page_planejador_principal():
         return
 
     profile = get_user_profile(user_id)
-    df_metrics = get_body_metrics(user_id)
+    latest_metric = get_latest_body_metric(user_id)
     
-    initial_weight = df_metrics.iloc[0]['weight'] if not df_metrics.empty else 75.0
+    initial_weight = latest_metric['weight'] if latest_metric else 75.0
     initial_gender = profile.get('gender') if profile else 'Masculino'
     initial_height = int(profile.get('height')) if profile and profile.get('height') else 175
     initial_age = int(profile.get('age')) if profile and profile.get('age') else 30
@@ -671,8 +2490,27 @@ def page_planejador_principal():
         # --- SEÇÃO 2: Construtor Manual de Refeições ---
         st.subheader(f"2. Construção Manual das Refeições ({targets['num_meals']} Refeições)")
         
-        all_food_names = targets['df_foods']['name'].tolist()
+        # O seletor só recebe os resultados da busca (top-k) e os alimentos já usados no plano,
+        # em vez do catálogo inteiro em cada editor
+        food_query = st.text_input(
+            "🔎 Buscar alimento (sem acentos, por início de palavra ou trecho do nome)",
+            key='food_search_man',
+            placeholder="Ex.: feijao, arroz int, frango grel"
+        )
+        used_food_names = sorted({
+            name for df_meal in st.session_state['manual_plan'].values()
+            for name in df_meal['Alimento'].dropna().tolist() if name
+        })
+        search_results = search_foods(user_id, food_query, FOOD_PICKER_TOP_K) if food_query else []
+        all_food_names = used_food_names + [name for name in search_results if name not in used_food_names]
+        if food_query:
+            st.caption(f"{len(search_results)} alimento(s) encontrados para '{food_query}' (máx. {FOOD_PICKER_TOP_K}); selecione-os na coluna Alimento.")
+        else:
+            st.caption("Digite na busca para listar alimentos no seletor das refeições.")
         daily_plan_df_list = []
+        meal_plans = {}
+        meal_total_slots = {}
+        meal_cal_target = int(targets['cal'] / targets['num_meals'])
         
         meal_cols = st.columns(targets['num_meals'])
         
@@ -725,9 +2563,6 @@ def page_planejador_principal():
                     )
                 }
                 
-                # Calcula a meta de calorias por refeição para exibição
-                meal_cal_target = int(targets['cal'] / targets['num_meals'])
-                
                 st.markdown(f"##### 🥣 {current_meal_key} (Meta por refeição: {meal_cal_target} kcal)")
                 
                 # Exibe o editor
@@ -743,42 +2578,51 @@ def page_planejador_principal():
                 # 4. Atualiza o Session State com o DataFrame editado usando a chave CORRETA
                 st.session_state['manual_plan'][current_meal_key] = df_edited
                 
-                # Recalcula e exibe os macros da refeição atual
-                meal_macros = calculate_macros_from_plan(df_edited, targets['df_foods'])
-                
-                # Feedback visual para a refeição
-                cal_delta = meal_macros['cal'] - meal_cal_target
-                
-                if abs(cal_delta) > meal_cal_target * 0.15 and meal_macros['cal'] > 0: # Delta maior que 15%
-                    delta_text = f"{'+' if cal_delta > 0 else ''}{cal_delta} kcal"
-                    color_style = 'color: #D35400;' if cal_delta > 0 else 'color: #1ABC9C;'
-                else:
-                    delta_text = "OK"
-                    color_style = 'color: #27AE60;'
-
-                # Exibe o total da refeição em uma caixa
-                st.markdown(f"""
-                <div style='border: 1px solid #ddd; padding: 10px; border-radius: 5px; margin-top: 10px; background-color: #f9f9f9;'>
-                    <h6 style='margin-top:0;'>Total {current_meal_key}</h6>
-                    <small>
-                        Cal: <strong>{meal_macros['cal']} kcal</strong> (<span style='{color_style}'>{delta_text}</span>) | 
-                        Prot: {meal_macros['prot']:.1f} g | 
-                        Carb: {meal_macros['carbs']:.1f} g |
-                        Sódio: {meal_macros['sodium']:.0f} mg
-                    </small>
-                </div>
-                """, unsafe_allow_html=True)
+                # Reserva o espaço da caixa de totais; os macros de todas as refeições são calculados juntos abaixo
+                meal_total_slots[current_meal_key] = st.empty()
+                meal_plans[current_meal_key] = df_edited
                 
                 # Adiciona o plano da refeição (com nome da refeição) à lista para cálculo total
                 df_edited['Refeição'] = current_meal_key
                 daily_plan_df_list.append(df_edited.copy())
 
+        # Só as refeições editadas desde o último rerun são recalculadas; o total diário é a soma dos vetores
+        meal_vector_cache = st.session_state.setdefault('meal_vectors_man', {})
+        meal_totals, daily_totals = calculate_macros_incremental(
+            meal_vector_cache, meal_plans, get_nutrient_matrix(user_id), FOOD_CACHE.version(user_id)
+        )
+
+        for meal_key, slot in meal_total_slots.items():
+            meal_macros = meal_totals[meal_key]
+            
+            # Feedback visual para a refeição
+            cal_delta = meal_macros['cal'] - meal_cal_target
+            
+            if abs(cal_delta) > meal_cal_target * 0.15 and meal_macros['cal'] > 0: # Delta maior que 15%
+                delta_text = f"{'+' if cal_delta > 0 else ''}{cal_delta} kcal"
+                color_style = 'color: #D35400;' if cal_delta > 0 else 'color: #1ABC9C;'
+            else:
+                delta_text = "OK"
+                color_style = 'color: #27AE60;'
+
+            # Exibe o total da refeição em uma caixa
+            slot.markdown(f"""
+            <div style='border: 1px solid #ddd; padding: 10px; border-radius: 5px; margin-top: 10px; background-color: #f9f9f9;'>
+                <h6 style='margin-top:0;'>Total {meal_key}</h6>
+                <small>
+                    Cal: <strong>{meal_macros['cal']} kcal</strong> (<span style='{color_style}'>{delta_text}</span>) | 
+                    Prot: {meal_macros['prot']:.1f} g | 
+                    Carb: {meal_macros['carbs']:.1f} g |
+                    Sódio: {meal_macros['sodium']:.0f} mg
+                </small>
+            </div>
+            """, unsafe_allow_html=True)
+
         st.markdown("---")
         
         # --- SEÇÃO 3: Totais Diários e Feedback ---
         if daily_plan_df_list:
             df_daily_plan = pd.concat(daily_plan_df_list)
-            daily_totals = calculate_macros_from_plan(df_daily_plan, targets['df_foods'])
             
             st.subheader("3. Totais Diários e Feedback")
             
@@ -826,28 +2670,207 @@ def page_planejador_principal():
             st.dataframe(df_daily_plan.groupby(['Refeição', 'Alimento'])['Gramas'].sum().reset_index(), hide_index=True, use_container_width=True)
 
 
+def page_planejador_otimizado():
+    user_id = st.session_state['user_id']
+    st.header("🤖 Planejador Automático (Otimizador)")
+    st.info("O otimizador escolhe alimentos do seu banco e as gramas de cada refeição para atingir as metas diárias.")
+
+    df_foods = get_all_foods(user_id)
+
+    if df_foods.empty:
+        st.warning(f"🚨 Por favor, **{st.session_state['username']}**, cadastre alimentos na página 'Banco de Alimentos (TACO)' antes de otimizar.")
+        return
+
+    profile = get_user_profile(user_id)
+    latest_metric = get_latest_body_metric(user_id)
+
+    initial_weight = latest_metric['weight'] if latest_metric else 75.0
+    initial_gender = profile.get('gender') if profile else 'Masculino'
+    initial_height = int(profile.get('height')) if profile and profile.get('height') else 175
+    initial_age = int(profile.get('age')) if profile and profile.get('age') else 30
+
+    gender_options = ['Masculino', 'Feminino']
+    gender_index = gender_options.index(initial_gender) if initial_gender in gender_options else 0
+
+    with st.form("metas_calc_form_opt"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            gender = st.selectbox("Gênero", gender_options, index=gender_index, key='plan_gender_opt')
+            weight = st.number_input("Peso (kg) - Última Métrica", min_value=30.0, value=initial_weight, format="%.1f", key='plan_weight_opt')
+            goal = st.selectbox("Objetivo", ['Manutenção', 'Déficit Calórico', 'Hipertrofia Muscular'], key='plan_goal_opt')
+        with col2:
+            height = st.number_input("Altura (cm)", min_value=100, value=initial_height, key='plan_height_opt')
+            age = st.number_input("Idade (anos)", min_value=15, value=initial_age, key='plan_age_opt')
+            num_meals = st.number_input("Número de Refeições/Dia", min_value=2, max_value=6, value=4, key='plan_num_meals_opt')
+        with col3:
+            activity_level = st.selectbox("Nível de Atividade", list(TDEE_FACTORS.keys()), key='plan_activity_opt')
+            tolerance = st.slider("Tolerância das Metas (%)", min_value=2, max_value=25, value=10, key='plan_tolerance_opt')
+            mode = st.radio("Modo", ['Dia Único', 'Semana (7 dias)'], horizontal=True, key='plan_mode_opt')
+            max_repeats = st.number_input("Máx. de dias com o mesmo alimento (Semana)", min_value=1, max_value=7, value=WEEK_MAX_REPEATS, key='plan_max_repeats_opt')
+
+        with st.expander("Opções do Solver (CBC)"):
+            col_t, col_g = st.columns(2)
+            time_limit = col_t.number_input("Tempo Máximo (s)", min_value=1, max_value=60, value=OPTIMIZER_TIME_LIMIT, key='plan_time_limit_opt')
+            gap = col_g.number_input("Gap Aceito", min_value=0.0, max_value=0.5, value=OPTIMIZER_GAP, step=0.01, format="%.2f", key='plan_gap_opt')
+
+        submitted = st.form_submit_button("Gerar Dieta Otimizada", type="primary")
+
+    if submitted:
+        target_cal, target_prot, target_carbs, target_fat, target_sodium = calculate_smart_macros(
+            gender, weight, height, age, TDEE_FACTORS[activity_level], goal
+        )
+        targets = {'cal': target_cal, 'prot': target_prot, 'carbs': target_carbs, 'fat': target_fat, 'sodium': target_sodium}
+
+        if mode == 'Semana (7 dias)':
+            with st.spinner("Otimizando os 7 dias em paralelo..."):
+                st.session_state['week_plan'] = optimize_week(targets, df_foods, int(num_meals), max_repeats=int(max_repeats),
+                                                              tolerance=tolerance / 100, time_limit=int(time_limit), gap=float(gap))
+                st.session_state['week_targets'] = targets
+        else:
+            with st.spinner("Otimizando..."):
+                result = optimize_diet(targets, df_foods, int(num_meals), tolerance=tolerance / 100,
+                                       time_limit=int(time_limit), gap=float(gap))
+
+            if result['feasible']:
+                st.session_state['targets'] = targets
+                st.session_state['final_totals'] = result['totals']
+                st.session_state['final_plan_df'] = result['plan']
+                st.session_state['optimizer_stats'] = result['stats']
+            else:
+                st.session_state.pop('final_plan_df', None)
+                st.session_state.pop('final_totals', None)
+                st.error(f"❌ Não foi possível gerar uma dieta ({result['status']}). Aumente a tolerância ou cadastre mais alimentos.")
+
+    if 'final_plan_df' in st.session_state:
+        targets = st.session_state['targets']
+        totals = st.session_state['final_totals']
+        stats = st.session_state.get('optimizer_stats', {})
+
+        st.subheader("Dieta Otimizada")
+        col_c, col_p, col_ca, col_g, col_f, col_s = st.columns(6)
+        col_c.metric(f"Calorias (Alvo: {targets['cal']})", f"{totals['cal']} kcal")
+        col_p.metric(f"Proteína (Alvo: {targets['prot']})", f"{totals['prot']:.1f} g")
+        col_ca.metric(f"Carboidratos (Alvo: {targets['carbs']})", f"{totals['carbs']:.1f} g")
+        col_g.metric(f"Gordura (Alvo: {targets['fat']})", f"{totals['fat']:.1f} g")
+        col_f.metric("Fibra", f"{totals['fiber']:.1f} g")
+        col_s.metric(f"Sódio (Máx: {targets['sodium']})", f"{totals['sodium']:.0f} mg")
+
+        st.dataframe(st.session_state['final_plan_df'], hide_index=True, use_container_width=True)
+
+        if stats:
+            st.caption(
+                f"Solver: {stats['candidates']} alimentos candidatos, {stats['variables']} variáveis, "
+                f"{stats['constraints']} restrições | montagem {stats['build_time']:.2f}s, "
+                f"solução {stats['solve_time']:.2f}s, total {stats['total_time']:.2f}s"
+            )
+
+        username = st.session_state['username']
+        df_plan = st.session_state['final_plan_df']
+        pdf_export_button(
+            "Exportar Dieta para PDF",
+            diet_pdf_digest(username, targets, df_plan, totals),
+            lambda: generate_diet_pdf(username, targets, df_plan, totals),
+            f"Dieta_EveFii_{username}_{datetime.now().strftime('%Y%m%d')}.pdf",
+            key='diet_pdf'
+        )
+
+    if 'week_plan' in st.session_state:
+        week = st.session_state['week_plan']
+        targets = st.session_state['week_targets']
+
+        st.subheader("Plano Semanal Otimizado")
+        st.caption(
+            f"{len(week['days'])} dias resolvidos com {week['workers']} solvers em paralelo: "
+            f"tempo total {week['wall_time']:.2f}s (soma dos dias: {week['solve_time_sum']:.2f}s)"
+        )
+
+        day_tabs = st.tabs([day['day'] for day in week['days']])
+        for tab, day in zip(day_tabs, week['days']):
+            with tab:
+                if not day['feasible']:
+                    st.error(f"Sem solução para {day['day']} ({day['status']}).")
+                    continue
+                totals = day['totals']
+                st.markdown(
+                    f"**{totals['cal']} kcal** (alvo {targets['cal']}) | Prot: {totals['prot']:.1f} g | "
+                    f"Carb: {totals['carbs']:.1f} g | Gord: {totals['fat']:.1f} g | Sódio: {totals['sodium']:.0f} mg"
+                )
+                st.dataframe(day['plan'], hide_index=True, use_container_width=True)
+                st.caption(f"Tempo do dia: {day['wall_time']:.2f}s (solver {day['stats']['solve_time']:.2f}s)")
+
+
 def page_receitas():
     user_id = st.session_state['user_id']
     st.header("🍚 Banco de Alimentos (TACO) - 100g")
     st.info(f"Gerencie seu banco de alimentos, **{st.session_state['username']}**. Fibra e Sódio são novos campos!")
     
-    df_foods = get_all_foods(user_id) 
-    
     st.subheader("1. Alimentos Cadastrados (por 100g)")
+    with st.expander("🔎 Filtrar e ordenar", expanded=False):
+        name_query = st.text_input("Nome contém", key='food_table_query')
+        col_f1, col_f2, col_f3 = st.columns(3)
+        with col_f1:
+            min_protein = st.number_input("Proteína mínima (g)", min_value=0.0, value=0.0, step=1.0, key='food_table_min_protein')
+            max_calories = st.number_input("Calorias máximas (kcal, 0 = sem limite)", min_value=0.0, value=0.0, step=10.0, key='food_table_max_calories')
+        with col_f2:
+            max_sodium = st.number_input("Sódio máximo (mg, 0 = sem limite)", min_value=0.0, value=0.0, step=10.0, key='food_table_max_sodium')
+            max_fat = st.number_input("Gordura máxima (g, 0 = sem limite)", min_value=0.0, value=0.0, step=1.0, key='food_table_max_fat')
+        with col_f3:
+            sort_label = st.selectbox("Ordenar por", list(FOOD_TABLE_SORT_COLUMNS), key='food_table_sort')
+            descending = st.checkbox("Ordem decrescente", key='food_table_desc')
+
+    min_values = {'protein': min_protein} if min_protein > 0 else {}
+    max_values = {col: limit for col, limit in (('calories', max_calories), ('sodium', max_sodium), ('fat', max_fat)) if limit > 0}
+
+    page_size = st.session_state.get('food_table_page_size', FOOD_TABLE_PAGE_SIZES[0])
+    page = st.session_state.get('food_table_page', 1)
+    df_foods, total = query_foods(
+        user_id, name_query, min_values, max_values,
+        sort_by=FOOD_TABLE_SORT_COLUMNS[sort_label], ascending=not descending,
+        page=page, page_size=page_size
+    )
+    num_pages = max(math.ceil(total / page_size), 1)
+    if page > num_pages:
+        # Filtros mudaram e a página atual deixou de existir: volta para a primeira
+        st.session_state['food_table_page'] = page = 1
+        df_foods, total = query_foods(
+            user_id, name_query, min_values, max_values,
+            sort_by=FOOD_TABLE_SORT_COLUMNS[sort_label], ascending=not descending,
+            page=page, page_size=page_size
+        )
+
     if not df_foods.empty:
         df_display = df_foods.copy()
         df_display.columns = ['ID', 'Nome', 'Custo (R$)', 'Calorias (kcal)/100g', 'Proteína (g)/100g', 'Carbohidratos (g)/100g', 'Gordura (g)/100g', 'Fibra (g)/100g', 'Sódio (mg)/100g']
-        st.dataframe(df_display[['ID', 'Nome', 'Calorias (kcal)/100g', 'Proteína (g)/100g', 'Carbohidratos (g)/100g', 'Gordura (g)/100g', 'Fibra (g)/100g', 'Sódio (mg)/100g']], hide_index=True)
+        df_display['Origem'] = ['Referência (TACO)' if id_ < 0 else 'Meu banco' for id_ in df_foods['id']]
+        st.dataframe(df_display[['ID', 'Nome', 'Origem', 'Calorias (kcal)/100g', 'Proteína (g)/100g', 'Carbohidratos (g)/100g', 'Gordura (g)/100g', 'Fibra (g)/100g', 'Sódio (mg)/100g']], hide_index=True)
+
+        col_p1, col_p2, col_p3 = st.columns([1, 1, 2])
+        with col_p1:
+            st.number_input("Página", min_value=1, max_value=num_pages, step=1, key='food_table_page')
+        with col_p2:
+            st.selectbox("Itens por página", FOOD_TABLE_PAGE_SIZES, key='food_table_page_size')
+        with col_p3:
+            st.caption(f"{total} alimento(s) encontrados · página {page} de {num_pages}")
+        st.caption("Itens da referência são compartilhados: ao editá-los, uma cópia é salva no seu banco; ao excluí-los, eles apenas deixam de aparecer para você.")
         
         st.markdown("---")
         st.subheader("2. Editar ou Excluir Alimento")
         
-        food_options = {id_: name for id_, name in zip(df_foods['id'], df_foods['name'])}
-        food_id_to_edit = st.selectbox(
-            "Selecione o ID do alimento para editar/excluir", 
-            options=[None] + list(food_options.keys()),
-            format_func=lambda x: f"ID: {x} - {food_options[x]}" if x else "Selecione um ID"
-        )
+        # Só os alimentos da página atual entram no seletor; qualquer outro pode ser aberto pelo ID
+        food_options = {int(id_): name for id_, name in zip(df_foods['id'], df_foods['name'])}
+        col_e1, col_e2 = st.columns([2, 1])
+        with col_e1:
+            food_id_from_page = st.selectbox(
+                "Selecione um alimento desta página",
+                options=[None] + list(food_options.keys()),
+                format_func=lambda x: f"ID: {x} - {food_options[x]}" if x else "Selecione um ID"
+            )
+        with col_e2:
+            food_id_typed = st.number_input("...ou informe o ID", value=0, step=1, key='food_edit_id')
+        food_id_to_edit = food_id_from_page or (int(food_id_typed) or None)
+        if food_id_to_edit and get_food_by_id(food_id_to_edit, user_id) is None:
+            st.warning(f"Nenhum alimento com ID {food_id_to_edit} no seu banco.")
+            food_id_to_edit = None
 
         if food_id_to_edit:
             food_to_edit = get_food_by_id(food_id_to_edit)
@@ -870,18 +2893,20 @@ def page_receitas():
                     submitted_edit = st.form_submit_button("Atualizar Alimento", type="primary")
                 with col_delete:
                     if st.form_submit_button("Excluir Alimento", type="secondary"):
-                         if delete_food(food_id_to_edit):
+                         if delete_food(food_id_to_edit, user_id):
                             st.success(f"Alimento '{food_to_edit['name']}' excluído.")
                             st.rerun()
                          else:
                             st.error("Erro ao excluir alimento.")
 
                 if submitted_edit:
-                    if update_food(food_id_to_edit, nome, calorias, proteina, carboidratos, gordura, fibra, sodium): 
+                    if update_food(food_id_to_edit, nome, calorias, proteina, carboidratos, gordura, fibra, sodium, user_id): 
                         st.success(f"Alimento '{nome}' atualizado com sucesso!")
                         st.rerun()
                     else:
                         st.error(f"Erro: Não foi possível atualizar. O nome '{nome}' pode já existir para você.")
+    elif total == 0 and (name_query or min_values or max_values):
+        st.info("Nenhum alimento corresponde aos filtros.")
     else:
         st.info("Nenhum alimento cadastrado ainda.")
     
@@ -895,14 +2920,34 @@ def page_receitas():
     )
     
     if uploaded_file is not None:
+        duplicate_mode = st.radio(
+            "Alimentos com nome já cadastrado",
+            ['Ignorar', 'Atualizar valores'],
+            horizontal=True, key='csv_duplicate_mode'
+        )
         if st.button("Importar Alimentos do CSV", type="secondary"):
-            count, error = import_foods_from_csv(user_id, uploaded_file)
+            summary, error = import_foods_from_csv(
+                user_id, uploaded_file, on_duplicate='upsert' if duplicate_mode == 'Atualizar valores' else 'skip'
+            )
             if error:
                 st.error(f"❌ Erro na Importação: {error}")
             else:
-                st.success(f"✅ Sucesso! **{count}** novos alimentos importados para **{st.session_state['username']}**.")
-                st.balloons()
+                # Guarda o resumo para exibi-lo após o rerun (que atualiza a tabela de alimentos acima)
+                st.session_state['csv_import_summary'] = summary
                 st.rerun()
+
+    if 'csv_import_summary' in st.session_state:
+        summary = st.session_state.pop('csv_import_summary')
+        st.success(
+            f"✅ Importação concluída para **{st.session_state['username']}**: **{summary['inserted']}** novos, "
+            f"**{summary['updated']}** atualizados, {summary['skipped']} ignorados (já existentes), "
+            f"{summary['rejected']} rejeitados."
+        )
+        if summary['encoding'] != CSV_IMPORT_ENCODINGS[0]:
+            st.caption(f"O arquivo não estava em UTF-8 e foi lido como {summary['encoding']}.")
+        if summary['errors']:
+            with st.expander(f"Linhas rejeitadas ({summary['rejected']})"):
+                st.dataframe(pd.DataFrame(summary['errors'], columns=['Linha', 'Motivo']), hide_index=True)
     
     st.markdown("---")
 
@@ -932,7 +2977,7 @@ def page_avaliacao_fisica():
     st.header(f"🏋️ Avaliação Física e Composição Corporal - {st.session_state['username']}")
     st.info("Monitore sua composição corporal e registre sua foto de evolução.")
     
-    df_metrics = get_body_metrics(user_id) 
+    latest_metric = get_latest_body_metric(user_id)
     
     initial_values = {
         'weight': 75.0, 'height': 175.0, 'age': 30, 'neck': 38.0, 'waist': 80.0, 'hip': 95.0,
@@ -944,10 +2989,9 @@ def page_avaliacao_fisica():
         initial_values['height'] = profile['height']
         initial_values['age'] = profile['age']
 
-    if not df_metrics.empty:
-        last = df_metrics.iloc[0]
-        initial_values['weight'] = last['weight']
-        initial_values['waist'] = last['waist_circ']
+    if latest_metric:
+        initial_values['weight'] = latest_metric['weight']
+        initial_values['waist'] = latest_metric['waist_circ']
 
     calculated_bf = None
     
@@ -1077,9 +3121,25 @@ def page_avaliacao_fisica():
     
     st.markdown("---")
 
-    df_metrics = df_metrics.sort_values(by='date')
-    st.line_chart(df_metrics, x='date', y=['weight', 'Massa Magra (kg)', 'Massa Gorda (kg)'])
-    st.line_chart(df_metrics, x='date', y=['body_fat_perc', 'bmi'])
+    col_range, col_granularity = st.columns(2)
+    range_label = col_range.radio("Período", list(METRIC_CHART_RANGES), index=len(METRIC_CHART_RANGES) - 1, horizontal=True, key='metrics_chart_range')
+    granularity_label = col_granularity.radio("Agrupamento", list(METRIC_CHART_GRANULARITIES), horizontal=True, key='metrics_chart_granularity')
+
+    days = METRIC_CHART_RANGES[range_label]
+    start = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d') if days else None
+    granularity = METRIC_CHART_GRANULARITIES[granularity_label]
+    if granularity:
+        df_chart = get_body_metric_rollup(user_id, granularity, start)
+    else:
+        df_chart = df_metrics if start is None else df_metrics[df_metrics['date'] >= start]
+    df_chart = df_chart.sort_values(by='date')
+
+    body_cols = ['weight', 'Massa Magra (kg)', 'Massa Gorda (kg)']
+    ratio_cols = ['body_fat_perc', 'bmi']
+    st.line_chart(downsample_metrics(df_chart, body_cols), x='date', y=body_cols)
+    st.line_chart(downsample_metrics(df_chart, ratio_cols), x='date', y=ratio_cols)
+    if len(df_chart) > CHART_MAX_POINTS:
+        st.caption(f"{len(df_chart)} registros no período; os gráficos mostram até {CHART_MAX_POINTS} pontos preservando picos e vales.")
 
 def page_relatorios():
     user_id = st.session_state['user_id']
@@ -1130,12 +3190,13 @@ def page_relatorios():
         
         st.markdown("---")
         
-        st.download_button(
-            label="Exportar Relatório de Evolução para PDF",
-            data=generate_metrics_pdf(st.session_state['username'], df_metrics),
-            file_name=f"Evolucao_EveFii_{st.session_state['username']}_{datetime.now().strftime('%Y%m%d')}.pdf",
-            mime="application/pdf",
-            type="primary"
+        username = st.session_state['username']
+        pdf_export_button(
+            "Exportar Relatório de Evolução para PDF",
+            metrics_pdf_digest(username, df_metrics),
+            lambda: generate_metrics_pdf(username, df_metrics),
+            f"Evolucao_EveFii_{username}_{datetime.now().strftime('%Y%m%d')}.pdf",
+            key='metrics_pdf'
         )
     
     st.markdown("---")
@@ -1147,19 +3208,34 @@ def page_relatorios():
     if photos.empty:
         st.info("Nenhuma foto de evolução registrada ainda. Registre uma na página 'Avaliação Física'.")
     else:
-        st.caption("Clique nas fotos para ampliar. (As fotos serão exibidas em ordem cronológica)")
-        photo_cols = st.columns(min(len(photos), 5)) 
+        st.caption("Use 🔍 para abrir a foto original. (As fotos serão exibidas em ordem cronológica)")
+        num_pages = max(math.ceil(len(photos) / GALLERY_PAGE_SIZE), 1)
+        if num_pages > 1:
+            page = st.number_input(f"Página da galeria (de {num_pages})", min_value=1, max_value=num_pages, value=num_pages, step=1, key='gallery_page')
+        else:
+            page = 1
+        page_photos = photos.iloc[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]
+        photo_cols = st.columns(5)
         
-        for i, row in photos.iterrows():
-            if row['photo_path']:
-                file_path = os.path.join(PHOTOS_DIR, row['photo_path'])
-                
-                try:
-                    with photo_cols[i % 5]:
-                        st.image(file_path, caption=row['date'].strftime('%d/%m/%Y'), use_container_width=True)
-                except Exception:
-                    with photo_cols[i % 5]:
-                        st.warning("Foto não disponível (Path Incorreto ou Restrito)")
+        for pos, row in enumerate(page_photos.itertuples(index=False)):
+            with photo_cols[pos % 5]:
+                thumb_path = None if photo_ingest_pending(row.photo_path) else get_thumbnail(row.photo_path, 'sm')
+                if thumb_path:
+                    st.image(thumb_path, caption=row.date.strftime('%d/%m/%Y'), use_container_width=True)
+                    if st.button("🔍", key=f"gallery_open_{page}_{pos}", help="Abrir a foto original"):
+                        st.session_state['gallery_open'] = row.photo_path
+                elif photo_ingest_pending(row.photo_path):
+                    st.info(f"⏳ {row.date.strftime('%d/%m/%Y')}: processando foto...")
+                else:
+                    st.warning("Foto não disponível (Path Incorreto ou Restrito)")
+
+        open_photo = st.session_state.get('gallery_open')
+        if open_photo in set(photos['photo_path']):
+            # Só a foto escolhida carrega em resolução total
+            st.image(os.path.join(PHOTOS_DIR, open_photo), use_container_width=True)
+            if st.button("Fechar foto", key='gallery_close'):
+                st.session_state.pop('gallery_open', None)
+                st.rerun()
 
     st.markdown("---")
 
@@ -1179,19 +3255,13 @@ def page_relatorios():
         
         st.dataframe(df_comparison, use_container_width=True)
 
-        df_plot = df_comparison.iloc[0:4][['Meta', 'Otimizado']].copy() 
-        fig, ax = plt.subplots(figsize=(8, 4))
-        df_plot.plot(kind='bar', ax=ax, rot=0)
-        ax.set_title('Comparação: Metas Diárias vs. Plano Otimizado (Macros)')
-        ax.set_ylabel('Valor (kcal/g)')
-        ax.legend(loc='upper right')
-        plt.tight_layout()
-        st.pyplot(fig)
+        df_plot = df_comparison.iloc[0:4][['Meta', 'Otimizado']].astype(float)
+        st.image(render_cached_chart(draw_targets_chart, df_plot), use_container_width=True)
         
         st.markdown(f"**Sódio Total Otimizado:** {finals['sodium']:.0f} mg (Limite Máximo: {targets['sodium']} mg)")
 
     else:
-        st.info("Gere um plano de dieta na página 'Planejador Principal' para visualizar esta análise.")
+        st.info("Gere um plano de dieta na página 'Planejador Automático (Otimizador)' para visualizar esta análise.")
         
     st.markdown("---")
     st.subheader("4. Distribuição de Nutrientes (Banco de Alimentos)")
@@ -1208,12 +3278,7 @@ def page_relatorios():
         data = [total_prot, total_carbs, total_fat, total_fiber] 
         labels = ['Proteína (g)', 'Carboidratos (g)', 'Gordura (g)', 'Fibra (g)'] 
         
-        fig, ax = plt.subplots()
-        ax.pie(data, labels=labels, autopct='%1.1f%%', startangle=90, colors=['#4CAF50', '#2196F3', '#FFC107', '#9E9E9E']) 
-        ax.axis('equal') 
-        ax.set_title('Distribuição Total dos Nutrientes (Por 100g de Alimento)')
-        
-        st.pyplot(fig)
+        st.image(render_cached_chart(draw_nutrient_pie, [float(v) for v in data], labels), use_container_width=True)
         
         st.markdown(f"**Sódio Total no Banco:** {total_sodium:.0f} mg")
 
@@ -1235,6 +3300,7 @@ def main_app():
     # Roteamento UNIFICADO: A página principal agora é a versão manual corrigida.
     PAGES = {
         "Planejador Principal (Manual Reativo)": page_planejador_principal,
+        "🤖 Planejador Automático (Otimizador)": page_planejador_otimizado,
         "Avaliação Física": page_avaliacao_fisica,
         "Banco de Alimentos (TACO)": page_receitas, 
         "💧 Hidratação (Água)": page_hidratacao_agua, # Função agora está completa!
@@ -1253,7 +3319,15 @@ def main_app():
         st.session_state.pop('targets_man', None) # Limpar a sessão do manual também
         st.session_state.pop('final_plan_df', None)
         st.session_state.pop('final_totals', None)
+        st.session_state.pop('optimizer_stats', None)
+        st.session_state.pop('week_plan', None)
+        st.session_state.pop('week_targets', None)
         st.session_state.pop('manual_plan', None)
+        st.session_state.pop('meal_vectors_man', None)
+        st.session_state.pop('gallery_open', None)
+        st.session_state.pop('water_goal', None)
+        st.session_state.pop('ml_per_kg', None)
+        flush_water_intake()  # não deixa consumo do usuário só no buffer ao sair
         st.rerun()
 
     PAGES[selection]()
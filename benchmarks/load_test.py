@@ -0,0 +1,382 @@
+"""Teste de carga headless: reruns das páginas do app com vários usuários simulados ao mesmo tempo.
+
+Semeia um evefii_v4.db novo (numa pasta temporária, ou em --workdir) com N usuários, cada um com
+catálogo de alimentos, perfil e histórico de métricas, e abre uma sessão do app por usuário com o
+AppTest do Streamlit (sem navegador). Cada sessão segue o roteiro: login, planejador manual (metas e
+edições das refeições), avaliação física (calcular e salvar uma métrica), hidratação (meta e consumo),
+relatório de evolução (com o PDF) e logout.
+
+A concorrência vem de --sessions processos, cada um executando a sua parte das sessões contra o mesmo
+arquivo SQLite. O AppTest troca estado global do Streamlit (o Runtime e a configuração) a cada rerun,
+então duas execuções na mesma thread-pool se atropelariam; com processos, a disputa pelo banco é a
+mesma de um servidor com várias sessões, mas cada processo tem os próprios caches.
+
+Cada rerun é cronometrado e atribuído à página em que aconteceu; o relatório traz p50/p95/p99 por
+página. As conexões SQLite do processo são instrumentadas: escritas que levam mais de
+--lock-threshold-ms contam como espera por lock (o busy_timeout do SQLite espera em silêncio) e erros
+"database is locked" são contados à parte. A memória por sessão é estimada pelo crescimento do RSS do
+processo com todas as suas sessões ainda abertas, dividido pelo número de sessões.
+
+Uso (a partir da raiz do repositório):
+    python benchmarks/load_test.py                            # 20 usuários, 4 processos simultâneos
+    python benchmarks/load_test.py --users 100 --sessions 16 --rounds 2 --out carga.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import multiprocessing
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "EveFii_v4_app.py")
+sys.path.insert(0, ROOT)
+
+# O AppTest reconfigura os loggers do Streamlit a cada execução; avisos de ScriptRunContext e de
+# parâmetros depreciados são esperados aqui e só poluiriam o relatório (as exceções do app são
+# lidas do próprio AppTest)
+logging.disable(logging.WARNING)
+
+import numpy as np
+import pandas as pd
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+# Cada rerun do AppTest criaria um ScriptCache novo e recompilaria o app, o que o servidor real não
+# faz (ele tem um cache só); sem isso a compilação entraria em todas as latências medidas.
+_SCRIPT_CACHE = ScriptCache()
+local_script_runner.ScriptCache = lambda: _SCRIPT_CACHE
+
+import EveFii_v4_app as app
+from microbench import synthetic_foods_csv
+
+PASSWORD = "carga"
+SEED = 20240101
+PAGES = {
+    'planejador': "Planejador Principal",
+    'avaliacao': "Avaliação Física",
+    'hidratacao': "Hidratação",
+    'relatorio': "Relatório de Evolução",
+}
+PERCENTILES = [50, 95, 99]
+WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN")
+
+
+class LockStats:
+    """Contadores das esperas por lock do SQLite, somados entre todas as threads."""
+    def __init__(self, threshold_s):
+        self.threshold_s = threshold_s
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.waits = 0
+        self.wait_s = 0.0
+        self.locked_errors = 0
+
+    def record(self, elapsed, error=None):
+        with self._lock:
+            self.writes += 1
+            if elapsed >= self.threshold_s:
+                self.waits += 1
+                self.wait_s += elapsed
+            if error is not None and "locked" in str(error):
+                self.locked_errors += 1
+
+
+def instrument_sqlite(stats):
+    """Faz as conexões abertas daqui em diante (inclusive as do pool do app) cronometrarem as escritas."""
+    class TimedConnection(sqlite3.Connection):
+        def _timed(self, method, sql, *args):
+            if not sql.lstrip().upper().startswith(WRITE_PREFIXES):
+                return method(sql, *args)
+            start = time.perf_counter()
+            try:
+                result = method(sql, *args)
+            except sqlite3.OperationalError as e:
+                stats.record(time.perf_counter() - start, e)
+                raise
+            stats.record(time.perf_counter() - start)
+            return result
+
+        def execute(self, sql, *args):
+            return self._timed(super().execute, sql, *args)
+
+        def executemany(self, sql, *args):
+            return self._timed(super().executemany, sql, *args)
+
+        def commit(self):
+            # Em WAL o commit de uma transação implícita também pode esperar pelo lock de escrita
+            if not self.in_transaction:
+                return super().commit()
+            start = time.perf_counter()
+            super().commit()
+            stats.record(time.perf_counter() - start)
+
+    connect = sqlite3.connect
+    sqlite3.connect = lambda *args, **kwargs: connect(*args, factory=TimedConnection, **kwargs)
+
+
+def current_rss_mb():
+    """RSS atual do processo (Linux: /proc); fora do Linux, o pico informado pelo getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def seed_users(n_users, n_foods, metric_days):
+    """Cria os usuários de carga no banco do diretório atual. Retorna a lista de nomes."""
+    app.init_db()
+    rng = np.random.default_rng(SEED)
+    csv_bytes = synthetic_foods_csv(n_foods)
+    start = date.today() - timedelta(days=metric_days)
+    usernames = []
+    for i in range(n_users):
+        username = f"carga_{i:04d}"
+        app.register_user(username, PASSWORD)
+        user_id = app.get_user_id(username)
+        app.import_foods_from_csv(user_id, io.BytesIO(csv_bytes))
+        app.save_user_profile(user_id, ['Masculino', 'Feminino'][i % 2], int(rng.integers(155, 190)), int(rng.integers(20, 60)))
+        weight = 70 + rng.normal(0, 8) + np.cumsum(rng.normal(-0.01, 0.2, metric_days))
+        for day in range(metric_days):
+            app.save_body_metric(user_id, (start + timedelta(days=day)).isoformat(), round(float(weight[day]), 1),
+                                 round(float(rng.normal(22, 3)), 1), round(float(rng.normal(85, 5)), 1), 24.0, None)
+        usernames.append(username)
+    return usernames
+
+
+class Recorder:
+    """Latências (s) de cada rerun por página e exceções levantadas pelo app."""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(list)
+
+    def rerun(self, at, page, action):
+        start = time.perf_counter()
+        action()
+        self.latencies[page].append(time.perf_counter() - start)
+        if at.exception:
+            self.errors[page].append(at.exception[0].message)
+
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+
+def _open_page(at, recorder, page):
+    radio = at.sidebar.radio[0]
+    option = next(o for o in radio.options if PAGES[page] in o)
+    recorder.rerun(at, page, lambda: radio.set_value(option).run())
+
+
+def simulate_session(username, rounds, edits, recorder, rng):
+    """Roteiro de um usuário. Retorna o AppTest (mantido vivo para a medição de memória)."""
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    recorder.rerun(at, 'login', at.run)
+    at.text_input[0].input(username)
+    at.text_input[1].input(PASSWORD)
+    recorder.rerun(at, 'login', lambda: at.button[0].click().run())
+
+    for _ in range(rounds):
+        # Planejador manual: metas e edições das refeições (o data_editor não é controlável pelo
+        # AppTest, então a edição entra direto no plano da sessão, como o editor faria)
+        _open_page(at, recorder, 'planejador')
+        recorder.rerun(at, 'planejador', lambda: _button(at, "Calcular Metas Diárias").click().run())
+        food_names = app.get_all_foods(app.get_user_id(username))['name'].to_numpy()
+        for _ in range(edits):
+            plan = at.session_state['manual_plan']
+            meals = list(plan.keys())
+            meal = meals[int(rng.integers(len(meals)))]
+            picks = rng.choice(len(food_names), size=int(rng.integers(1, 6)), replace=False)
+            plan[meal] = pd.DataFrame({'Alimento': food_names[picks], 'Gramas': rng.integers(20, 250, len(picks)).astype('int32')})
+            at.session_state['manual_plan'] = plan
+            at.text_input(key='food_search_man').input(str(food_names[picks[0]])[:8])
+            recorder.rerun(at, 'planejador', at.run)
+
+        # Avaliação física: calcula a composição e salva a métrica do dia
+        _open_page(at, recorder, 'avaliacao')
+        recorder.rerun(at, 'avaliacao', lambda: _button(at, "Calcular Composição Corporal").click().run())
+        recorder.rerun(at, 'avaliacao', lambda: _button(at, "Salvar Métrica no Histórico").click().run())
+
+        # Hidratação: meta e alguns consumos seguidos
+        _open_page(at, recorder, 'hidratacao')
+        recorder.rerun(at, 'hidratacao', lambda: _button(at, "Calcular Meta de Água").click().run())
+        for _ in range(3):
+            recorder.rerun(at, 'hidratacao', lambda: next(b for b in at.button if b.label.startswith("Adicionar")).click().run())
+
+        # Relatório de evolução, com a geração do PDF
+        _open_page(at, recorder, 'relatorio')
+        render = [b for b in at.button if b.key == 'metrics_pdf_render']
+        if render:
+            recorder.rerun(at, 'relatorio', lambda: render[0].click().run())
+
+    recorder.rerun(at, 'logout', lambda: _button(at, "Logout").click().run())
+    return at
+
+
+def run_worker(workdir, usernames, rounds, edits, lock_threshold_s, seed):
+    """Executa as sessões de um processo, uma após a outra, e devolve as medições para somar."""
+    os.chdir(workdir)  # o app usa evefii_v4.db e photos/ relativos ao diretório atual
+    app.DB_PATH = "evefii_v4.db"
+    stats = LockStats(lock_threshold_s)
+    instrument_sqlite(stats)
+
+    # Aquecimento fora da medição: compila o app e carrega os módulos, como num servidor já no ar
+    AppTest.from_file(APP_PATH, default_timeout=120).run()
+    rss_before = current_rss_mb()
+    recorder = Recorder()
+    sessions, failed = [], []
+    for i, username in enumerate(usernames):
+        try:
+            sessions.append(simulate_session(username, rounds, edits, recorder, np.random.default_rng(seed + i)))
+        except Exception as e:
+            failed.append(f"{username}: {type(e).__name__}: {e}")
+    rss_after = current_rss_mb()
+    # Os consumos de água ficam no buffer do app até o flush agendado; o processo não pode sair antes
+    time.sleep(app.WATER_FLUSH_DELAY + 0.5)
+    return {
+        'latencies': dict(recorder.latencies),
+        'errors': dict(recorder.errors),
+        'lock': (stats.writes, stats.waits, stats.wait_s, stats.locked_errors),
+        'rss_before_mb': rss_before,
+        'rss_after_mb': rss_after,
+        'sessions': len(sessions),
+        'failed': failed,
+    }
+
+
+def percentiles_ms(samples):
+    values = np.percentile(np.asarray(samples) * 1000, PERCENTILES)
+    return {f"p{p}": round(float(v), 1) for p, v in zip(PERCENTILES, values)}
+
+
+def run_load(args, workdir):
+    os.chdir(workdir)
+    app.DB_PATH = "evefii_v4.db"
+    print(f"Semeando {args.users} usuário(s) em {os.path.join(workdir, app.DB_PATH)}...", flush=True)
+    start = time.perf_counter()
+    usernames = seed_users(args.users, args.foods, args.metric_days)
+    app.get_pool().close_all()
+    print(f"Banco semeado em {time.perf_counter() - start:.1f}s", flush=True)
+
+    # spawn: processos novos, sem herdar as conexões SQLite abertas pela semeadura
+    groups = [usernames[i::args.sessions] for i in range(args.sessions) if usernames[i::args.sessions]]
+    latencies, errors = defaultdict(list), defaultdict(list)
+    writes = waits = locked_errors = sessions = 0
+    wait_s = rss_growth = rss_after = 0.0
+    failed = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=len(groups), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(run_worker, workdir, group, args.rounds, args.edits, args.lock_threshold_ms / 1000, SEED + 1000 * i)
+                   for i, group in enumerate(groups)]
+        for future in as_completed(futures):
+            result = future.result()
+            for page, samples in result['latencies'].items():
+                latencies[page].extend(samples)
+            for page, messages in result['errors'].items():
+                errors[page].extend(messages)
+            w, n_waits, w_s, n_locked = result['lock']
+            writes, waits, wait_s, locked_errors = writes + w, waits + n_waits, wait_s + w_s, locked_errors + n_locked
+            sessions += result['sessions']
+            rss_growth += result['rss_after_mb'] - result['rss_before_mb']
+            rss_after = max(rss_after, result['rss_after_mb'])
+            failed.extend(result['failed'])
+    wall_s = time.perf_counter() - start
+    for failure in failed:
+        print(f"[erro] {failure}", file=sys.stderr)
+
+    pages = {}
+    for page, samples in sorted(latencies.items()):
+        pages[page] = {'reruns': len(samples), **percentiles_ms(samples), 'max': round(max(samples) * 1000, 1),
+                       'errors': len(errors[page])}
+    total_reruns = sum(len(s) for s in latencies.values())
+    return {
+        'users': args.users,
+        'sessions': len(groups),
+        'rounds': args.rounds,
+        'wall_s': round(wall_s, 2),
+        'reruns_per_s': round(total_reruns / wall_s, 2),
+        'pages': pages,
+        'sqlite': {
+            'writes': writes,
+            'lock_waits': waits,
+            'lock_wait_ms': round(wait_s * 1000, 1),
+            'locked_errors': locked_errors,
+            'lock_threshold_ms': args.lock_threshold_ms,
+        },
+        'memory': {
+            'rss_max_process_mb': round(rss_after, 1),
+            'per_session_mb': round(rss_growth / max(sessions, 1), 2),
+        },
+        'failed_sessions': failed,
+        'errors': {page: messages[:3] for page, messages in errors.items() if messages},
+    }
+
+
+def print_report(report):
+    print()
+    print(f"{report['users']} usuário(s), {report['sessions']} processo(s) simultâneos, {report['rounds']} rodada(s): "
+          f"{report['wall_s']:.1f}s, {report['reruns_per_s']:.1f} reruns/s")
+    print(f"  {'página':<12} {'reruns':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'máx.':>9} {'erros':>6}  (ms)")
+    for page, row in report['pages'].items():
+        print(f"  {page:<12} {row['reruns']:>7} {row['p50']:>9.1f} {row['p95']:>9.1f} {row['p99']:>9.1f} {row['max']:>9.1f} {row['errors']:>6}")
+    sqlite_stats = report['sqlite']
+    print(f"SQLite: {sqlite_stats['writes']} escritas, {sqlite_stats['lock_waits']} esperas por lock "
+          f"(≥ {sqlite_stats['lock_threshold_ms']} ms, total {sqlite_stats['lock_wait_ms']:.0f} ms), "
+          f"{sqlite_stats['locked_errors']} erro(s) 'database is locked'")
+    memory = report['memory']
+    print(f"Memória: ~{memory['per_session_mb']:.2f} MB por sessão aberta "
+          f"(maior RSS de um processo: {memory['rss_max_process_mb']:.0f} MB)")
+    for page, messages in report['errors'].items():
+        print(f"[erro] {page}: {messages[0]}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga headless das páginas do app (AppTest).")
+    parser.add_argument("--users", type=int, default=20, help="Usuários semeados (uma sessão por usuário)")
+    parser.add_argument("--sessions", type=int, default=4, help="Sessões executando ao mesmo tempo (processos)")
+    parser.add_argument("--rounds", type=int, default=1, help="Repetições do roteiro por sessão")
+    parser.add_argument("--edits", type=int, default=5, help="Edições de refeição por rodada no planejador")
+    parser.add_argument("--foods", type=int, default=500, help="Alimentos no catálogo de cada usuário")
+    parser.add_argument("--metric-days", type=int, default=180, help="Dias de métricas no histórico de cada usuário")
+    parser.add_argument("--lock-threshold-ms", type=float, default=50.0, help="Escrita mais lenta que isto conta como espera por lock")
+    parser.add_argument("--workdir", help="Pasta do banco semeado (padrão: temporária, apagada ao final)")
+    parser.add_argument("--out", help="Grava o relatório neste JSON")
+    args = parser.parse_args(argv)
+    out_path = os.path.abspath(args.out) if args.out else None
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        report = run_load(args, os.path.abspath(args.workdir))
+    else:
+        with tempfile.TemporaryDirectory(prefix="evefii_carga_") as workdir:
+            report = run_load(args, workdir)
+            os.chdir(ROOT)
+    report.update({
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+    })
+    print_report(report)
+    if out_path:
+        with open(out_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Relatório gravado em {out_path}")
+    return 1 if report['failed_sessions'] or report['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
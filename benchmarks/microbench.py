@@ -0,0 +1,297 @@
+"""Microbenchmarks do núcleo de cálculo, banco e relatórios do app.
+
+Gera dados sintéticos reprodutíveis (semente fixa) num SQLite temporário: catálogos de alimentos de
+100 a 50 mil itens e históricos de métricas corporais de 1 a 10 anos (uma medição por dia). Mede cada
+função em vários tamanhos, grava os resultados num JSON e compara com a linha de base
+(`microbench_baseline.json`), pelo menor tempo de cada caso. Falha (código de saída 1) se algum caso passar da base mais a tolerância.
+
+Funções rápidas (cálculos de macros e % de gordura) são executadas em laço, como no timeit, e o tempo
+por chamada é a média do laço; as demais são medidas uma chamada por vez. "frio" limpa o cache do app
+antes de cada medição (leitura do SQLite); "quente" mede a leitura já em cache.
+
+Uso (a partir da raiz do repositório):
+    python benchmarks/microbench.py                     # mede tudo e compara com a base
+    python benchmarks/microbench.py --quick             # só os tamanhos menores
+    python benchmarks/microbench.py --only pdf          # só os casos cujo nome contém "pdf"
+    python benchmarks/microbench.py --update-baseline   # regrava a base nesta máquina
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pandas as pd
+import streamlit.logger
+
+# Fora do `streamlit run` os caches do app avisam que não há ScriptRunContext; o aviso é esperado aqui.
+# set_log_level vale também para os loggers que o Streamlit ainda vai criar (o dos caches, no import do app).
+streamlit.logger.set_log_level("error")
+
+import EveFii_v4_app as app
+
+SEED = 20240101
+FOOD_SIZES = [100, 1_000, 10_000, 50_000]
+METRIC_YEARS = [1, 5, 10]
+QUICK_FOOD_SIZES = [100, 1_000]
+QUICK_METRIC_YEARS = [1]
+PLAN_ROWS = 20  # linhas do plano usado nos cálculos de macros e no PDF da dieta
+
+
+def synthetic_foods_csv(n_foods, seed=SEED):
+    """CSV (bytes) com n_foods alimentos plausíveis: macros por 100 g e calorias coerentes com eles."""
+    rng = np.random.default_rng(seed + n_foods)
+    protein = rng.gamma(2.0, 5.0, n_foods).round(1)
+    carbs = (rng.gamma(1.5, 15.0, n_foods) * (rng.random(n_foods) < 0.7)).round(1)
+    fat = (rng.gamma(1.2, 8.0, n_foods) * (rng.random(n_foods) < 0.6)).round(1)
+    foods = pd.DataFrame({
+        'name': [f'Alimento sintético {i:05d}' for i in range(n_foods)],
+        'calories': (4 * protein + 4 * carbs + 9 * fat).round().astype(int),
+        'protein': protein,
+        'carbs': carbs,
+        'fat': fat,
+        'fiber': rng.gamma(1.0, 2.0, n_foods).round(1),
+        'sodium': rng.exponential(120.0, n_foods).round(),
+    })
+    return foods.to_csv(index=False).encode()
+
+
+def seed_metrics(user_id, years, seed=SEED):
+    """Uma medição por dia durante `years` anos, gravada pelo caminho normal do app (save_body_metric)."""
+    rng = np.random.default_rng(seed + years)
+    days = years * 365
+    start = date(2015, 1, 1)
+    weight = 85 + np.cumsum(rng.normal(-0.005, 0.25, days))
+    body_fat = np.clip(25 + np.cumsum(rng.normal(-0.002, 0.08, days)), 8, 45)
+    waist = 90 + np.cumsum(rng.normal(-0.003, 0.15, days))
+    for i in range(days):
+        app.save_body_metric(user_id, (start + timedelta(days=i)).isoformat(), round(float(weight[i]), 1),
+                             round(float(body_fat[i]), 1), round(float(waist[i]), 1),
+                             round(float(weight[i]) / 1.75 ** 2, 2), None)
+
+
+def sample_plan(df_foods, rows=PLAN_ROWS, seed=SEED):
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(df_foods), size=min(rows, len(df_foods)), replace=False)
+    return pd.DataFrame({
+        'Refeição': [f'Refeição {i % 4 + 1}' for i in range(len(picks))],
+        'Alimento': df_foods['name'].to_numpy()[picks],
+        'Gramas': rng.integers(20, 250, len(picks)),
+    })
+
+
+def time_loop(fn, min_time):
+    """Tempo por chamada (s) de funções rápidas: laço calibrado pelo autorange do timeit."""
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()
+    loops = max(loops, int(loops * min_time / 0.2))
+    return timer.timeit(loops) / loops
+
+
+def calibrate(min_time):
+    """Tempo (ms) de uma carga fixa em Python puro, medido antes dos casos.
+
+    A comparação com a base é escalada pela razão entre as calibrações, descontando diferenças de
+    velocidade da máquina (frequência da CPU, outra carga no computador) entre as duas execuções.
+    """
+    return float(f"{min(time_loop(lambda: sorted(range(2000, 0, -1)), min_time) for _ in range(5)) * 1000:.4g}")
+
+
+def time_call(fn, setup=None):
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+class Suite:
+    def __init__(self, repeat, min_time, only=None):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.only = only
+        self.results = {}
+
+    def wanted(self, name):
+        return self.only is None or self.only in name
+
+    def _record(self, name, samples):
+        self.results[name] = {
+            'median_ms': float(f"{statistics.median(samples) * 1000:.4g}"),
+            'min_ms': float(f"{min(samples) * 1000:.4g}"),
+            'runs': len(samples),
+        }
+        print(f"  {name:<52} {self.results[name]['median_ms']:>12.4g} ms  (mín. {self.results[name]['min_ms']:.4g})", flush=True)
+
+    def loop(self, name, fn):
+        if self.wanted(name):
+            self._record(name, [time_loop(fn, self.min_time) for _ in range(self.repeat)])
+
+    def call(self, name, fn, setup=None):
+        if self.wanted(name):
+            time_call(fn, setup)  # aquecimento: imports sob demanda, fontes do PDF
+            self._record(name, [time_call(fn, setup) for _ in range(self.repeat)])
+
+
+def run_suite(suite, food_sizes, metric_years, workdir):
+    app.DB_PATH = os.path.join(workdir, "bench.db")
+    app.REFERENCE_CATALOG_PATH = os.path.join(workdir, "sem_referencia.csv")  # só os alimentos sintéticos
+    app.init_db()
+
+    print("Cálculos", flush=True)
+    suite.loop("calculate_smart_macros", lambda: app.calculate_smart_macros('Feminino', 68.0, 165, 34, 1.55, 'Déficit Calórico'))
+    suite.loop("calculate_body_fat_navy", lambda: app.calculate_body_fat_navy('Feminino', 165, 33, 78, 98))
+    suite.loop("calculate_body_fat_jp7", lambda: app.calculate_body_fat_jp7('Masculino', 34, 12, 10, 14, 11, 13, 20, 15))
+
+    food_cases = ["import_foods_from_csv", "get_all_foods frio", "get_all_foods quente",
+                  "calculate_macros_from_plan DataFrame", "calculate_macros_from_plan matriz"]
+    for n_foods in food_sizes:
+        if not any(suite.wanted(f"{case}[foods={n_foods}]") for case in food_cases):
+            continue  # semear catálogos grandes só vale se algum caso deles for medido
+        print(f"Catálogo com {n_foods} alimentos", flush=True)
+        csv_bytes = synthetic_foods_csv(n_foods)
+        app.register_user(f"bench_foods_{n_foods}", "bench")
+        user_id = app.get_user_id(f"bench_foods_{n_foods}")
+        summary, error = app.import_foods_from_csv(user_id, io.BytesIO(csv_bytes))
+        if error or summary['inserted'] != n_foods:
+            raise RuntimeError(f"falha ao semear {n_foods} alimentos: {error or summary}")
+
+        import_users = []
+
+        def new_import_user():
+            # Cada medição importa num usuário novo (a importação sem repetidos é o caso comum)
+            username = f"bench_import_{n_foods}_{len(import_users)}"
+            app.register_user(username, "bench")
+            import_users.append(app.get_user_id(username))
+
+        suite.call(f"import_foods_from_csv[foods={n_foods}]",
+                   lambda: app.import_foods_from_csv(import_users[-1], io.BytesIO(csv_bytes)), setup=new_import_user)
+        suite.call(f"get_all_foods frio[foods={n_foods}]", lambda: app.get_all_foods(user_id), setup=lambda: app.FOOD_CACHE.bump(user_id))
+        suite.loop(f"get_all_foods quente[foods={n_foods}]", lambda: app.get_all_foods(user_id))
+
+        df_foods = app.get_all_foods(user_id)
+        plan = sample_plan(df_foods)
+        matrix = app.get_nutrient_matrix(user_id)
+        suite.call(f"calculate_macros_from_plan DataFrame[foods={n_foods}]", lambda: app.calculate_macros_from_plan(plan, df_foods))
+        suite.loop(f"calculate_macros_from_plan matriz[foods={n_foods}]", lambda: app.calculate_macros_from_plan(plan, matrix))
+
+    if suite.wanted("generate_diet_pdf"):
+        print("PDF da dieta", flush=True)
+        totals = {'cal': 1850, 'prot': 130.0, 'carbs': 190.0, 'fat': 60.0, 'fiber': 28.0, 'sodium': 1900.0}
+        plan = sample_plan(pd.read_csv(io.BytesIO(synthetic_foods_csv(food_sizes[0]))))
+        suite.call("generate_diet_pdf", lambda: app.generate_diet_pdf("bench", dict(totals), plan, totals))
+
+    metric_cases = ["get_body_metrics frio", "get_body_metrics quente", "generate_metrics_pdf"]
+    for years in metric_years:
+        if not any(suite.wanted(f"{case}[years={years}]") for case in metric_cases):
+            continue
+        print(f"Métricas de {years} ano(s)", flush=True)
+        username = f"bench_metrics_{years}"
+        app.register_user(username, "bench")
+        user_id = app.get_user_id(username)
+        seed_metrics(user_id, years)
+        suite.call(f"get_body_metrics frio[years={years}]", lambda: app.get_body_metrics(user_id), setup=lambda: app.METRICS_CACHE.invalidate(user_id))
+        suite.loop(f"get_body_metrics quente[years={years}]", lambda: app.get_body_metrics(user_id))
+        df_metrics = app.get_body_metrics(user_id)
+        suite.call(f"generate_metrics_pdf[years={years}]", lambda: app.generate_metrics_pdf(username, df_metrics))
+
+
+def compare(results, baseline, tolerance, speed=1.0):
+    """Casos cujo menor tempo passou da base mais a tolerância: lista de (nome, atual, base ajustada).
+
+    Compara o mínimo (como o startup_time.py), menos sensível a ruído da máquina que a mediana.
+    speed é a razão entre a calibração atual e a da base (>1: máquina mais lenta agora).
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"  {name}: novo (sem base)")
+        elif result['min_ms'] > base['min_ms'] * speed * (1 + tolerance):
+            regressions.append((name, result['min_ms'], base['min_ms'] * speed))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks do app com dados sintéticos, comparados com a linha de base.")
+    parser.add_argument("--quick", action="store_true", help="Só catálogos e históricos pequenos")
+    parser.add_argument("--only", help="Só os casos cujo nome contém este trecho")
+    parser.add_argument("--repeat", type=int, default=5, help="Medições por caso (compara o menor tempo)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Duração mínima (s) de cada laço das funções rápidas")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Regressão aceita sobre a base (fração)")
+    parser.add_argument("--out", help="Grava os resultados neste JSON")
+    parser.add_argument("--update-baseline", action="store_true", help="Grava as medições atuais como nova base")
+    args = parser.parse_args(argv)
+
+    food_sizes = QUICK_FOOD_SIZES if args.quick else FOOD_SIZES
+    metric_years = QUICK_METRIC_YEARS if args.quick else METRIC_YEARS
+    calibration_ms = calibrate(args.min_time)
+    print(f"Calibração: {calibration_ms:.4g} ms", flush=True)
+    suite = Suite(args.repeat, args.min_time, args.only)
+    with tempfile.TemporaryDirectory(prefix="evefii_bench_") as workdir:
+        run_suite(suite, food_sizes, metric_years, workdir)
+        app.flush_water_intake()
+        app.get_pool().close_all()
+
+    record = {
+        "benchmarks": suite.results,
+        "calibration_ms": calibration_ms,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(record, f, indent=2)
+            f.write("\n")
+        print(f"Resultados gravados em {args.out}")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH) and (args.quick or args.only):
+            with open(BASELINE_PATH) as f:
+                baseline = json.load(f)
+            # Uma execução parcial atualiza só os casos que mediu, na escala de velocidade da base
+            speed = calibration_ms / baseline["calibration_ms"]
+            record["benchmarks"] = {**baseline["benchmarks"], **{
+                name: {**result, 'min_ms': float(f"{result['min_ms'] / speed:.4g}"), 'median_ms': float(f"{result['median_ms'] / speed:.4g}")}
+                for name, result in suite.results.items()
+            }}
+            record["calibration_ms"] = baseline["calibration_ms"]
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(record, f, indent=2)
+            f.write("\n")
+        print(f"Base gravada em {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("Sem base gravada; rode com --update-baseline para criá-la.")
+        return 0
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    speed = calibration_ms / baseline["calibration_ms"]
+    print(f"Velocidade relativa à base: {1 / speed:.2f}x")
+    regressions = compare(suite.results, baseline["benchmarks"], args.tolerance, speed)
+    for name, current, base in regressions:
+        print(f"FALHA: {name}: {current:.4g} ms vs. base {base:.4g} ms ({current / base - 1:+.0%})")
+    if not regressions:
+        print(f"Nenhuma regressão acima de {args.tolerance:.0%} em {len(suite.results)} caso(s).")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Verificação de regressão do tempo de inicialização (import) do app.
+
+Mede `import EveFii_v4_app` em processos novos (python -X importtime), guarda o melhor tempo num JSON
+e compara com a linha de base. O mínimo das execuções é usado (como no timeit) por ser o menos
+sensível a ruído da máquina. Como calibração, a mesma saída traz o tempo do `import streamlit` feito
+pelo app: a base é escalada pela razão entre esse tempo agora e o gravado nela, para descontar uma
+máquina mais lenta ou mais carregada (como a calibração do microbench.py). Falha (código de saída 1)
+se o import passar da base escalada mais a tolerância, ou se algum dos módulos pesados que devem ser
+carregados sob demanda aparecer já no import.
+
+Uso (a partir da raiz do repositório):
+    python benchmarks/startup_time.py                     # mede e compara com a base
+    python benchmarks/startup_time.py --update-baseline   # regrava a base nesta máquina
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+APP_MODULE = "EveFii_v4_app"
+CALIBRATION_MODULE = "streamlit"
+
+# Devem ficar fora do import: carregados só quando uma página ou função precisa deles
+LAZY_MODULES = ["pandas", "numpy", "matplotlib", "pulp", "fpdf", "PIL"]
+
+
+def measure_import_us():
+    """Tempos cumulativos (µs) do import do app e do streamlit dentro dele, num processo novo (-X importtime)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {APP_MODULE}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        parts = [p.strip() for p in line.split("|")]
+        if len(parts) == 3 and parts[2] in (APP_MODULE, CALIBRATION_MODULE):
+            times[parts[2]] = int(parts[1])
+    missing = {APP_MODULE, CALIBRATION_MODULE} - times.keys()
+    if missing:
+        raise RuntimeError(f"import de {', '.join(sorted(missing))} não encontrado na saída do -X importtime")
+    return times[APP_MODULE], times[CALIBRATION_MODULE]
+
+
+def eagerly_imported():
+    """Módulos de LAZY_MODULES que já estão carregados logo após o import do app."""
+    code = f"import sys, {APP_MODULE}; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede o tempo de import do app e compara com a linha de base.")
+    parser.add_argument("--runs", type=int, default=7, help="Processos medidos (usa o menor tempo)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Regressão aceita sobre a base (fração)")
+    parser.add_argument("--update-baseline", action="store_true", help="Grava a medição atual como nova base")
+    args = parser.parse_args(argv)
+
+    runs = [measure_import_us() for _ in range(args.runs)]
+    samples = [app_us for app_us, _ in runs]
+    best_ms = min(samples) / 1000
+    calibration_ms = min(calibration_us for _, calibration_us in runs) / 1000
+    eager = eagerly_imported()
+    record = {
+        "import_ms": round(best_ms, 1),
+        "median_ms": round(statistics.median(samples) / 1000, 1),
+        "samples_ms": [round(s / 1000, 1) for s in samples],
+        "calibration_ms": round(calibration_ms, 1),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+    }
+    print(f"import {APP_MODULE}: {best_ms:.0f} ms (melhor de {args.runs}; mediana {record['median_ms']:.0f} ms)")
+    print(f"calibração (import {CALIBRATION_MODULE}): {calibration_ms:.0f} ms; "
+          f"custo próprio do app: {best_ms - calibration_ms:.0f} ms")
+
+    failed = False
+    if eager:
+        print(f"FALHA: módulos pesados importados na inicialização: {', '.join(eager)}")
+        failed = True
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(record, f, indent=2)
+            f.write("\n")
+        print(f"Base gravada em {BASELINE_PATH}")
+    elif os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        # Máquina mais lenta agora -> scale > 1 -> a base é ajustada para cima (e vice-versa)
+        scale = calibration_ms / baseline["calibration_ms"] if baseline.get("calibration_ms") else 1.0
+        expected_ms = baseline["import_ms"] * scale
+        limit = expected_ms * (1 + args.tolerance)
+        print(f"Base: {baseline['import_ms']:.0f} ms x {scale:.2f} (calibração) = {expected_ms:.0f} ms (limite {limit:.0f} ms)")
+        if best_ms > limit:
+            print(f"FALHA: import {best_ms / expected_ms - 1:+.0%} mais lento que a base calibrada")
+            failed = True
+    else:
+        print("Sem base gravada; rode com --update-baseline para criá-la.")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Exportação em lote dos relatórios em PDF de todos os usuários (sem interface).
+
+Gera o relatório de evolução corporal de cada usuário com métricas cadastradas e, com --diet, também
+um plano de dieta otimizado a partir do perfil salvo. Os PDFs são renderizados em paralelo num pool
+de processos (o FPDF é Python puro, limitado pela CPU) e gravados num único .zip à medida que ficam
+prontos, sem acumular todos os relatórios em memória.
+
+Uso:
+    python export_reports.py --out relatorios_semana.zip
+    python export_reports.py --diet --goal "Déficit Calórico" --workers 4
+"""
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+# Fora do `streamlit run` os caches do app avisam que não há ScriptRunContext; o aviso é esperado aqui
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import EveFii_v4_app as app
+
+
+def _init_worker(db_path):
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    app.DB_PATH = db_path
+
+
+def migrate(db_path):
+    """Aplica as migrações pendentes uma única vez, aqui no processo pai, antes de criar os workers.
+
+    Um banco de uma versão anterior do app (sem hidden_reference_foods, por exemplo) faria as
+    consultas dos workers falharem; como o app, o script só lê o banco depois de migrá-lo.
+    """
+    app.DB_PATH = db_path
+    with app.db_conn() as conn:
+        applied = app.migrate_db(conn)
+    # Os workers abrem as próprias conexões: nenhuma conexão do pai é herdada no fork
+    app.get_pool().close_all()
+    return applied
+
+
+def list_users(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT id, username FROM users ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def _safe_name(username):
+    # Nomes de usuário são livres; no zip viram pasta e parte do nome do arquivo
+    return re.sub(r'[^\w.-]+', '_', username).strip('.') or 'usuario'
+
+
+def render_user_reports(user_id, username, diet_options=None):
+    """Renderiza os PDFs de um usuário. Retorna uma lista de (nome no zip, bytes, segundos)."""
+    reports = []
+    folder = _safe_name(username)
+    df_metrics = app.get_body_metrics(user_id)
+    if not df_metrics.empty:
+        start = time.perf_counter()
+        pdf_bytes = app.generate_metrics_pdf(username, df_metrics)
+        reports.append((f"{folder}/Evolucao_EveFii_{folder}.pdf", pdf_bytes, time.perf_counter() - start))
+
+    profile = app.get_user_profile(user_id)
+    if diet_options and profile and not df_metrics.empty:
+        start = time.perf_counter()
+        targets = dict(zip(['cal', 'prot', 'carbs', 'fat', 'sodium'], app.calculate_smart_macros(
+            profile['gender'], df_metrics.iloc[0]['weight'], profile['height'], profile['age'],
+            app.TDEE_FACTORS[diet_options['activity']], diet_options['goal']
+        )))
+        result = app.optimize_diet(targets, app.get_all_foods(user_id), diet_options['meals'])
+        if result['feasible']:
+            pdf_bytes = app.generate_diet_pdf(username, targets, result['plan'], result['totals'])
+            reports.append((f"{folder}/Dieta_EveFii_{folder}.pdf", pdf_bytes, time.perf_counter() - start))
+    return reports
+
+
+def export_reports(db_path, out_path, workers=None, diet_options=None):
+    """Exporta os relatórios de todos os usuários para out_path. Retorna (nº de PDFs, usuários com erro)."""
+    migrate(db_path)
+    users = list_users(db_path)
+    written = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(db_path,)) as pool, \
+            zipfile.ZipFile(out_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        futures = {pool.submit(render_user_reports, user_id, username, diet_options): username for user_id, username in users}
+        for future in as_completed(futures):
+            username = futures[future]
+            try:
+                reports = future.result()
+            except Exception as e:
+                failed.append(username)
+                print(f"[erro] {username}: {e}", file=sys.stderr)
+                continue
+            for arcname, pdf_bytes, seconds in reports:
+                archive.writestr(arcname, pdf_bytes)
+                written += 1
+                print(f"{arcname}: {seconds * 1000:.0f} ms, {len(pdf_bytes) / 1024:.0f} KB", flush=True)
+    return written, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta os relatórios em PDF de todos os usuários para um .zip.")
+    parser.add_argument("--db", default=app.DB_PATH, help="Banco SQLite do app (padrão: %(default)s)")
+    parser.add_argument("--out", default=f"relatorios_evefii_{datetime.now().strftime('%Y%m%d')}.zip", help="Arquivo .zip de saída")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processos em paralelo (padrão: nº de CPUs)")
+    parser.add_argument("--diet", action="store_true", help="Também gera um plano de dieta otimizado por usuário com perfil salvo")
+    parser.add_argument("--goal", default="Manutenção", choices=['Manutenção', 'Déficit Calórico', 'Hipertrofia Muscular'])
+    parser.add_argument("--activity", default=list(app.TDEE_FACTORS)[1], choices=list(app.TDEE_FACTORS))
+    parser.add_argument("--meals", type=int, default=4, choices=sorted(app.MEAL_CALORIE_SPLITS))
+    args = parser.parse_args(argv)
+
+    diet_options = {'goal': args.goal, 'activity': args.activity, 'meals': args.meals} if args.diet else None
+    start = time.perf_counter()
+    written, failed = export_reports(args.db, args.out, args.workers, diet_options)
+    print(f"{written} relatório(s) em {args.out} ({time.perf_counter() - start:.1f}s, {args.workers} processos)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
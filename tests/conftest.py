@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+import streamlit.logger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+streamlit.logger.set_log_level("error")
+
+import EveFii_v4_app as evefii  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """O módulo do app apontando para um banco (e pasta de fotos) novo em tmp_path, sem catálogo de referência."""
+    monkeypatch.setattr(evefii, 'DB_PATH', str(tmp_path / 'evefii_v4.db'))
+    monkeypatch.setattr(evefii, 'REFERENCE_CATALOG_PATH', str(tmp_path / 'taco_reference.npz'))
+    monkeypatch.setattr(evefii, 'PHOTOS_DIR', str(tmp_path / 'photos'))
+    monkeypatch.setattr(evefii, 'FOOD_CACHE', evefii.FoodCatalogCache())
+    evefii.USER_ID_CACHE.clear()
+    evefii.PROFILE_CACHE.clear()
+    evefii._PHOTO_INGEST_PENDING.clear()
+    with evefii.db_conn() as conn:
+        evefii.migrate_db(conn)
+    yield evefii
+    evefii.get_pool().close_all()
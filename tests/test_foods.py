@@ -0,0 +1,195 @@
+import io
+import os
+
+import pytest
+
+
+def _csv(*rows):
+    header = "name,calories,protein,carbs,fat,fiber,sodium\n"
+    return io.StringIO(header + "".join(row + "\n" for row in rows))
+
+
+def test_import_rejects_non_finite_values(app):
+    csv_file = _csv(
+        "Arroz,130,2.7,28,0.3,0.4,1",
+        "Infinito,inf,1,1,1,0,0",
+        "Proteína infinita,100,inf,1,1,0,0",
+        "Gordura negativa,100,1,1,-inf,0,0",
+        "Sódio enorme,100,1,1,1,0,1e999",
+    )
+    summary, error = app.import_foods_from_csv(1, csv_file)
+
+    assert error is None
+    assert summary['inserted'] == 1
+    assert summary['rejected'] == 4
+    assert [line for line, _ in summary['errors']] == [3, 4, 5, 6]
+    assert app.get_all_foods(1)['name'].tolist() == ['Arroz']
+
+
+def test_import_skips_malformed_lines_and_keeps_line_numbers(app):
+    csv_file = _csv(
+        "Arroz,130,2.7,28,0.3,0.4,1",
+        "Quebrada,100,1,1,1,0,0,extra,extra",
+        "Feijão,76,4.8,13.6,0.5,8.5,2",
+        "Negativo,-5,1,1,1,0,0",
+        "Campos vazios a mais,100,1,1,1,0,0,,",
+        "Batata,77,2,17,0.1,2.2,6",
+    )
+    summary, error = app.import_foods_from_csv(1, csv_file, chunk_rows=2)
+
+    assert error is None
+    assert summary['inserted'] == 3
+    assert summary['rejected'] == 3
+    assert [line for line, _ in summary['errors']] == [3, 5, 6]
+    assert 'expected 7 fields, saw 9' in summary['errors'][0][1]
+    assert sorted(app.get_all_foods(1)['name']) == ['Arroz', 'Batata', 'Feijão']
+
+
+def test_import_falls_back_to_latin1(app):
+    content = "name,calories,protein,carbs,fat,fiber,sodium\nFeijão,76,4.8,13.6,0.5,8.5,2\n"
+    summary, error = app.import_foods_from_csv(1, io.BytesIO(content.encode('latin-1')))
+
+    assert error is None
+    assert summary['inserted'] == 1
+    assert summary['encoding'] == 'latin-1'
+    assert app.get_all_foods(1)['name'].tolist() == ['Feijão']
+
+
+def _build_reference(app, *rows, mtime):
+    app.build_reference_catalog(_csv(*rows), out_path=app.REFERENCE_CATALOG_PATH)
+    os.utime(app.REFERENCE_CATALOG_PATH, (mtime, mtime))
+
+
+def test_rebuilt_reference_invalidates_cached_catalogs(app):
+    _build_reference(app, "Arroz,130,2.7,28,0.3,0.4,1", mtime=1_000_000)
+    app.save_food(1, 'Bolo da vó', 350, 5, 50, 15, 1, 200)
+    assert sorted(app.get_all_foods(1)['name']) == ['Arroz', 'Bolo da vó']
+    version = app.FOOD_CACHE.version(1)
+
+    _build_reference(app, "Arroz,130,2.7,28,0.3,0.4,1", "Feijão,76,4.8,13.6,0.5,8.5,2", mtime=2_000_000)
+    assert app.FOOD_CACHE.version(1) != version
+    assert sorted(app.get_all_foods(1)['name']) == ['Arroz', 'Bolo da vó', 'Feijão']
+
+
+def test_deleting_edited_reference_food_keeps_it_hidden(app):
+    _build_reference(app, "Arroz,130,2.7,28,0.3,0.4,1", "Feijão,76,4.8,13.6,0.5,8.5,2", mtime=1_000_000)
+    foods = app.get_all_foods(1).set_index('name')
+    assert app.update_food(int(foods.loc['Arroz', 'id']), 'Arroz', 128, 2.5, 28, 0.2, 1.6, 1, user_id=1)
+
+    copy = app.get_all_foods(1).set_index('name').loc['Arroz']
+    assert copy['id'] > 0 and copy['calories'] == 128
+    assert app.delete_food(int(copy['id']), user_id=1)
+
+    assert app.get_all_foods(1)['name'].tolist() == ['Feijão']
+
+
+def test_renaming_edited_reference_food_keeps_it_hidden(app):
+    _build_reference(app, "Arroz,130,2.7,28,0.3,0.4,1", "Feijão,76,4.8,13.6,0.5,8.5,2", mtime=1_000_000)
+    foods = app.get_all_foods(1).set_index('name')
+    assert app.update_food(int(foods.loc['Arroz', 'id']), 'Arroz', 128, 2.5, 28, 0.2, 1.6, 1, user_id=1)
+
+    copy = app.get_all_foods(1).set_index('name').loc['Arroz']
+    assert app.update_food(int(copy['id']), 'Arroz integral', 124, 2.6, 25.8, 1.0, 2.7, 1, user_id=1)
+
+    assert sorted(app.get_all_foods(1)['name']) == ['Arroz integral', 'Feijão']
+
+
+def test_food_cache_versions_stay_bounded(app):
+    cache = app.FoodCatalogCache(max_users=4)
+    for user_id in range(100):
+        cache.get(user_id, lambda uid: f"catálogo {uid}")
+        cache.bump(user_id)
+        cache.get(user_id, lambda uid: f"catálogo {uid}")
+    assert len(cache._entries) == 4
+    assert len(cache._versions) <= 2 * cache.max_users
+    assert cache.get(99, lambda uid: "recarregado") == "catálogo 99"
+
+
+def test_food_cache_drops_loads_raced_by_a_write(app):
+    cache = app.FoodCatalogCache(max_users=2)
+
+    def load_then_write(user_id):
+        # Escrita concorrente no meio da carga, seguida de escritas de outros usuários que
+        # forçam o descarte das versões antigas
+        cache.bump(user_id)
+        for other in range(100, 110):
+            cache.bump(other)
+        return "antigo"
+
+    assert cache.get(1, load_then_write) == "antigo"
+    assert cache.get(1, lambda uid: "novo") == "novo"
+
+
+def test_food_cache_builds_derived_structures_outside_the_lock(app):
+    cache = app.FoodCatalogCache()
+    cache.get(1, lambda uid: "catálogo")
+
+    def builder(df):
+        # Outro usuário consegue ler o cache enquanto a estrutura é construída
+        assert cache._lock.acquire(blocking=False)
+        cache._lock.release()
+        return f"índice de {df}"
+
+    assert cache.get_derived(1, lambda uid: "catálogo", 'search', builder) == "índice de catálogo"
+    assert cache.get_derived(1, lambda uid: "outro", 'search', lambda df: "reconstruído") == "índice de catálogo"
+
+
+REFERENCE_ROWS = (
+    "Arroz,130,2.7,28,0.3,0.4,1",
+    "Feijão,76,4.8,13.6,0.5,8.5,2",
+    "Frango grelhado,165,31,0,3.6,0,74",
+    "Banana prata,89,1.1,23,0.3,2.6,1",
+)
+
+
+def _user_with_overlay(app, user_id):
+    """Usuário com um alimento próprio, um item da referência editado e outro oculto."""
+    foods = app.get_all_foods(user_id).set_index('name')
+    app.save_food(user_id, 'Bolo da vó', 350, 5, 50, 15, 1, 200)
+    app.update_food(int(foods.loc['Arroz', 'id']), 'Arroz', 128, 2.5, 28, 0.2, 1.6, 1, user_id=user_id)
+    app.delete_food(int(foods.loc['Banana prata', 'id']), user_id=user_id)
+
+
+def test_catalog_overlays_user_rows_on_the_shared_reference(app):
+    _build_reference(app, *REFERENCE_ROWS, mtime=1_000_000)
+    _user_with_overlay(app, 1)
+
+    foods = app.get_all_foods(1)
+    assert foods['name'].tolist() == ['Arroz', 'Bolo da vó', 'Feijão', 'Frango grelhado']
+    assert foods.set_index('name').loc['Arroz', 'calories'] == 128
+    assert app.get_all_foods(2)['name'].tolist() == [name.split(',')[0] for name in REFERENCE_ROWS]
+
+    # Mesmos totais que uma NutrientMatrix montada sobre a visão mesclada
+    plan = ['Arroz', 'Banana prata', 'Bolo da vó', int(foods.loc[2, 'id']), 'Inexistente', -4]
+    grams = [100, 50, 30, 200, 10, 80]
+    expected = app.NutrientMatrix(foods).totals(plan, grams)
+    assert app.get_nutrient_matrix(1).totals(plan, grams) == pytest.approx(expected)
+    by_meal = app.get_nutrient_matrix(1).totals_by_group(plan, grams, [0, 1, 0, 1, 0, 1], 2)
+    assert by_meal.sum(axis=0) == pytest.approx(expected)
+
+
+def test_catalog_search_and_paging_hide_masked_reference_rows(app):
+    _build_reference(app, *REFERENCE_ROWS, mtime=1_000_000)
+    _user_with_overlay(app, 1)
+
+    assert app.search_foods(1, 'banana') == []
+    assert app.search_foods(2, 'banana') == ['Banana prata']
+    assert app.search_foods(1, 'f') == ['Feijão', 'Frango grelhado']
+    assert app.search_foods(1, 'da') == ['Bolo da vó']
+
+    page, total = app.query_foods(1, sort_by='calories', ascending=False, page=1, page_size=3)
+    assert total == 4
+    assert page['name'].tolist() == ['Bolo da vó', 'Frango grelhado', 'Arroz']
+    page, total = app.query_foods(1, name_query='f', min_values={'protein': 5})
+    assert (page['name'].tolist(), total) == (['Frango grelhado'], 1)
+    page, _ = app.query_foods(1, page=2, page_size=2)
+    assert page['name'].tolist() == ['Feijão', 'Frango grelhado']
+
+
+def test_reference_structures_are_shared_between_users(app):
+    _build_reference(app, *REFERENCE_ROWS, mtime=1_000_000)
+    _user_with_overlay(app, 1)
+
+    assert app.get_nutrient_matrix(1).reference is app.get_nutrient_matrix(2).reference
+    assert app._food_search_index(1).reference is app._food_search_index(2).reference
+    assert app.FOOD_CACHE.get(1, app._load_foods).reference is app.get_reference_catalog()
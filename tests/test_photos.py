@@ -0,0 +1,62 @@
+import io
+import logging
+import os
+import time
+
+from PIL import Image
+
+
+def _jpeg(size=(3000, 2000), color=(200, 120, 80)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', quality=95)
+    return buffer
+
+
+def _wait_ingest(app, relative_path):
+    with app._PHOTO_INGEST_LOCK:
+        future = app._PHOTO_INGEST_PENDING.get(relative_path)
+    if future is not None:
+        future.exception(timeout=30)
+
+
+def test_original_is_on_disk_before_the_metric_is_saved(app, monkeypatch):
+    # Segura a recompressão: o arquivo precisa existir mesmo com ela ainda pendente
+    monkeypatch.setattr(app, 'ingest_photo', lambda relative_path: relative_path)
+    upload = _jpeg()
+    relative_path = app.save_uploaded_photo(upload, 1)
+
+    file_path = os.path.join(app.PHOTOS_DIR, relative_path)
+    with open(file_path, 'rb') as f:
+        assert f.read() == upload.getvalue()
+    assert app.save_body_metric(1, '2024-01-01', 70.0, 20.0, 80.0, 22.0, relative_path)
+
+
+def test_ingest_recompresses_in_background(app):
+    relative_path = app.save_uploaded_photo(_jpeg(), 1)
+    _wait_ingest(app, relative_path)
+
+    assert not app.photo_ingest_pending(relative_path)
+    with Image.open(os.path.join(app.PHOTOS_DIR, relative_path)) as image:
+        assert max(image.size) == app.PHOTO_MAX_SIDE
+    assert os.path.exists(app.get_thumbnail(relative_path, 'sm'))
+
+
+def test_ingest_failure_is_logged_and_keeps_the_original(app, monkeypatch, caplog):
+    def broken(relative_path):
+        raise OSError("disco cheio")
+
+    monkeypatch.setattr(app, 'ingest_photo', broken)
+    with caplog.at_level(logging.ERROR, logger='evefii'):
+        relative_path = app.save_uploaded_photo(_jpeg(), 1)
+        _wait_ingest(app, relative_path)
+        # O callback roda na thread do pool logo depois de o Future terminar
+        deadline = time.monotonic() + 5
+        while not caplog.records and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    assert any(relative_path in record.getMessage() for record in caplog.records)
+    assert os.path.exists(os.path.join(app.PHOTOS_DIR, relative_path))
+
+
+def test_non_image_upload_is_rejected(app):
+    assert app.save_uploaded_photo(io.BytesIO(b'not an image'), 1) is None
@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+
+def _db_profile(app, user_id):
+    with app.db_conn() as conn:
+        return dict(conn.execute("SELECT gender, height, age FROM user_profile WHERE user_id = ?", (user_id,)).fetchone())
+
+
+def test_save_user_profile_only_writes_changes(app):
+    assert app.save_user_profile(1, 'Feminino', 165, 30)
+    assert not app.save_user_profile(1, 'Feminino', 165.0, 30)
+    assert app.save_user_profile(1, 'Feminino', 165, 31)
+    assert _db_profile(app, 1) == {'gender': 'Feminino', 'height': 165.0, 'age': 31}
+
+
+def test_save_user_profile_with_null_columns(app):
+    with app.db_conn() as conn:
+        conn.execute("INSERT INTO user_profile (user_id, gender, height, age) VALUES (1, 'Masculino', NULL, NULL)")
+        conn.commit()
+
+    assert app.save_user_profile(1, 'Masculino', 180, 40)
+    assert _db_profile(app, 1) == {'gender': 'Masculino', 'height': 180.0, 'age': 40}
+
+
+def test_save_user_profile_ignores_stale_cache(app):
+    app.save_user_profile(1, 'Feminino', 165, 30)
+    # Outra instância do app alterou o banco; o cache deste processo ainda tem a idade antiga
+    with app.db_conn() as conn:
+        conn.execute("UPDATE user_profile SET age = 35 WHERE user_id = 1")
+        conn.commit()
+
+    assert app.save_user_profile(1, 'Feminino', 165, 30)
+    assert _db_profile(app, 1)['age'] == 30
+
+
+def test_unchanged_profile_save_does_not_wait_for_the_write_lock(app):
+    app.save_user_profile(1, 'Feminino', 165, 30)
+    other = sqlite3.connect(app.DB_PATH, isolation_level=None)
+    try:
+        other.execute("BEGIN IMMEDIATE")  # outro processo no meio de uma escrita
+        start = time.perf_counter()
+        assert not app.save_user_profile(1, 'Feminino', 165.0, 30)
+        assert time.perf_counter() - start < 0.5
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
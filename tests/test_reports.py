@@ -0,0 +1,19 @@
+import pytest
+
+
+def test_pdf_requires_pinned_fpdf(app, monkeypatch):
+    import fpdf
+
+    app._pdf_class.cache_clear()
+    monkeypatch.setattr(fpdf, '__version__', '2.7.0')
+    with pytest.raises(RuntimeError, match=app.FPDF_VERSION):
+        app._pdf_class()
+    app._pdf_class.cache_clear()
+
+
+def test_pdf_renders_with_pinned_fpdf(app):
+    pdf = app.new_pdf()
+    pdf.add_page()
+    pdf.use_font('', 10)
+    pdf.cell_utf8(0, 10, 'Feijão — 100 g', 0, 1)
+    assert pdf.output(dest='S').startswith('%PDF')
@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def water(app, monkeypatch):
+    # Intervalos longos: o teste chama o flush direto e os timers não devem disparar no meio dele
+    monkeypatch.setattr(app, 'WATER_FLUSH_DELAY', 10.0)
+    monkeypatch.setattr(app, 'WATER_FLUSH_MAX_DELAY', 30.0)
+    app._WATER_BUFFER.update(pending=[], in_flight=[], timer=None, failures=0)
+    yield app
+    with app._WATER_LOCK:
+        if app._WATER_BUFFER['timer'] is not None:
+            app._WATER_BUFFER['timer'].cancel()
+        app._WATER_BUFFER.update(pending=[], in_flight=[], timer=None, failures=0)
+
+
+def test_flush_writes_events_and_daily_total(water):
+    when = datetime(2024, 5, 1, 8, 0)
+    water.add_water_intake(1, 0.25, when)
+    water.add_water_intake(1, 0.5, when)
+
+    assert water.flush_water_intake() == 2
+    with water.db_conn() as conn:
+        row = conn.execute("SELECT liters, entries FROM water_daily WHERE user_id = 1 AND day = '2024-05-01'").fetchone()
+    assert (row['liters'], row['entries']) == (0.75, 2)
+    assert water._WATER_BUFFER['pending'] == []
+
+
+def test_failed_flush_keeps_events_and_retries_with_backoff(water, monkeypatch):
+    water.add_water_intake(1, 0.3, datetime(2024, 5, 1, 8, 0))
+    working_db_conn = water.db_conn
+
+    @contextmanager
+    def locked_db_conn():
+        raise sqlite3.OperationalError("database is locked")
+        yield
+
+    monkeypatch.setattr(water, 'db_conn', locked_db_conn)
+    assert water.flush_water_intake() == 0
+    first_retry = water._WATER_BUFFER['timer']
+    assert first_retry is not None and first_retry.interval == water.WATER_FLUSH_DELAY * 2
+    assert water.flush_water_intake() == 0
+    assert water._WATER_BUFFER['timer'].interval == water.WATER_FLUSH_MAX_DELAY
+    assert len(water._WATER_BUFFER['pending']) == 1
+
+    monkeypatch.setattr(water, 'db_conn', working_db_conn)
+    assert water.flush_water_intake() == 1
+    assert water._WATER_BUFFER['failures'] == 0
+    assert water._WATER_BUFFER['timer'] is None
+
+
+def test_intake_does_not_wait_for_a_flush_blocked_on_the_database(water):
+    today = datetime.now()
+    water.add_water_intake(1, 0.25, today)
+    other = sqlite3.connect(water.DB_PATH, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")  # outro processo segura o lock de escrita
+    flush = threading.Thread(target=water.flush_water_intake)
+    flush.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not water._WATER_BUFFER['in_flight'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        water.add_water_intake(1, 0.5, today)
+        assert time.perf_counter() - start < 0.2
+        # O lote em gravação continua somado às leituras
+        assert water.get_water_daily(1, days=1)[0][1] == 0.75
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+        flush.join()
+
+    assert water.get_water_daily(1, days=1)[0][1] == 0.75
+    assert water.flush_water_intake() == 1
+    assert water.get_water_daily(1, days=1)[0][1] == 0.75